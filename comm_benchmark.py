@@ -0,0 +1,268 @@
+import argparse
+import json
+import os
+import threading
+import time
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+import communication
+
+"""
+Microbenchmark of the stage-to-stage communication path.
+
+Ranks are paired up (0, 1), (2, 3), ...; in every pair, the even rank sends
+a message to the odd rank, which sends it back. Each configuration sweeps
+message size, dtype, transport and number of concurrent helper threads,
+each thread using its own channel. Messages go through communication._send
+and _recv (with the shape handshake) for broadcasts, and through the
+P2PTransport and SharedMemoryTransport objects otherwise.
+
+Latency is half the round-trip time of a message; bandwidth counts the bytes
+moved in both directions. Rank 0 prints the results of its pair as JSON.
+
+    python comm_benchmark.py --backend gloo --num_processes 2
+"""
+
+DTYPES = {
+    'float32': torch.float32,
+    'float16': torch.float16,
+    'bfloat16': torch.bfloat16,
+    'int64': torch.int64,
+}
+TRANSPORTS = [communication.BROADCAST, communication.ISEND,
+              communication.SHM]
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    index = min(int(fraction * len(values)), len(values) - 1)
+    return values[index]
+
+
+class Channel(object):
+    """ One direction of a benchmark channel between two ranks. """
+    def __init__(self, transport, src_rank, dst_rank, tag, group, backend,
+                 cache_tensor_shapes, pack_tensors, device):
+        self.transport = transport
+        self.src_rank = src_rank
+        self.dst_rank = dst_rank
+        self.backend = backend
+        self.pack_tensors = pack_tensors
+        self.group = group
+        self.tag = tag
+        self.shape_cache = None
+        if cache_tensor_shapes:
+            self.shape_cache = communication.ShapeCache()
+        self.stream = communication._new_stream()
+        self.scratch = {}
+        self.connection = None
+        self.buffer_pool = None
+        rank = dist.get_rank()
+        if transport == communication.ISEND:
+            self.connection = communication.P2PTransport(
+                dst_rank if rank == src_rank else src_rank, tag, backend,
+                device, max_outstanding=1)
+        elif transport == communication.SHM:
+            self.connection = communication.SharedMemoryTransport(
+                "cpm-benchmark-%d-%d-%d" % (src_rank, dst_rank, tag),
+                dst_rank if rank == src_rank else src_rank, tag,
+                rank == src_rank, device)
+            # Received messages are consumed before the next one arrives.
+            self.buffer_pool = communication.RecvBufferPool(device)
+            self.buffer_pool.reset(1, True)
+
+    def send(self, tensor_list):
+        if self.connection is not None:
+            self.connection.send(tensor_list, packed=self.pack_tensors)
+            return
+        communication._send(
+            tensor_list, {"out0": [self.dst_rank]},
+            {"out0": tensor_list[0].dtype}, "out0", self.src_rank,
+            self.dst_rank, tag=self.tag, sub_process_group=self.group,
+            backend=self.backend, shape_cache=self.shape_cache,
+            packed=self.pack_tensors, stream=self.stream,
+            scratch=self.scratch)
+
+    def recv(self, tensor_shape, dtype):
+        if self.connection is not None:
+            return self.connection.recv(packed=self.pack_tensors,
+                                        buffer_pool=self.buffer_pool)
+        return communication._recv(
+            "out0", {"out0": [self.src_rank]}, {"out0": dtype},
+            self.src_rank, tensor_shape=tensor_shape, dtype=torch.float32,
+            tag=self.tag, sub_process_group=self.group,
+            backend=self.backend, shape_cache=self.shape_cache,
+            packed=self.pack_tensors, stream=self.stream,
+            scratch=self.scratch)
+
+    def release(self):
+        """ Returns the buffers of the last received message to the pool. """
+        if self.buffer_pool is not None:
+            self.buffer_pool.release()
+
+    def flush(self):
+        if self.connection is not None:
+            self.connection.flush()
+
+
+def ping_pong(forward, backward, is_sender, tensor, num_warmup,
+              num_iterations, latencies):
+    for i in range(num_warmup + num_iterations):
+        start_time = time.time()
+        if is_sender:
+            forward.send([tensor])
+            backward.recv(list(tensor.shape), tensor.dtype)
+            backward.release()
+        else:
+            tensor_list = forward.recv(list(tensor.shape), tensor.dtype)
+            backward.send(tensor_list)
+            forward.release()
+        if i >= num_warmup:
+            latencies.append((time.time() - start_time) / 2)
+    forward.flush()
+    backward.flush()
+
+
+def run_config(args, groups, transport, dtype_name, size, num_threads,
+               device):
+    rank = dist.get_rank()
+    peer = rank + 1 if rank % 2 == 0 else rank - 1
+    is_sender = rank % 2 == 0
+    src_rank, dst_rank = min(rank, peer), max(rank, peer)
+    dtype = DTYPES[dtype_name]
+    tensor = torch.ones(size, dtype=dtype, device=device)
+
+    threads = []
+    latencies = [[] for _ in range(num_threads)]
+    for i in range(num_threads):
+        forward_group, backward_group = None, None
+        if transport == communication.BROADCAST:
+            forward_group, backward_group = groups[(src_rank, i)]
+        forward = Channel(transport, src_rank, dst_rank, 2 * i,
+                          forward_group, args.backend,
+                          args.cache_tensor_shapes, args.pack_tensors,
+                          device)
+        backward = Channel(transport, dst_rank, src_rank, 2 * i + 1,
+                           backward_group, args.backend,
+                           args.cache_tensor_shapes, args.pack_tensors,
+                           device)
+        threads.append(threading.Thread(
+            target=ping_pong,
+            args=(forward, backward, is_sender, tensor, args.num_warmup,
+                  args.num_iterations, latencies[i])))
+
+    dist.barrier()
+    start_time = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed_time = time.time() - start_time
+    dist.barrier()
+
+    latencies = sum(latencies, [])
+    nbytes = tensor.element_size() * tensor.nelement()
+    # Warmup messages are included in the elapsed time.
+    total_bytes = 2 * nbytes * num_threads * (args.num_warmup +
+                                              args.num_iterations)
+    return {
+        'transport': transport,
+        'dtype': dtype_name,
+        'size': size,
+        'bytes': nbytes,
+        'threads': num_threads,
+        'latency_p50_us': percentile(latencies, 0.5) * 1e6,
+        'latency_p90_us': percentile(latencies, 0.9) * 1e6,
+        'latency_p99_us': percentile(latencies, 0.99) * 1e6,
+        'bandwidth_gbps': total_bytes / elapsed_time / 1e9,
+    }
+
+
+def create_groups(world_size, max_threads):
+    """ Creates a forward and a backward broadcast group per pair and per
+    thread, in the same order on every rank.
+    """
+    groups = {}
+    for i in range(max_threads):
+        for src_rank in range(0, world_size, 2):
+            ranks = [src_rank, src_rank + 1]
+            groups[(src_rank, i)] = (dist.new_group(ranks=ranks),
+                                     dist.new_group(ranks=ranks))
+    return groups
+
+
+def run(rank, args):
+    os.environ['MASTER_ADDR'] = args.master_addr
+    os.environ['MASTER_PORT'] = str(args.master_port)
+    dist.init_process_group(args.backend, rank=rank,
+                            world_size=args.num_processes)
+    communication.LOG_MESSAGES = False
+    if args.backend == communication.NCCL:
+        torch.cuda.set_device(rank % torch.cuda.device_count())
+        device = torch.device('cuda', torch.cuda.current_device())
+    else:
+        device = torch.device('cpu')
+
+    groups = {}
+    if communication.BROADCAST in args.transports:
+        groups = create_groups(args.num_processes, max(args.threads))
+
+    results = []
+    for transport in args.transports:
+        for dtype_name in args.dtypes:
+            for num_threads in args.threads:
+                for size in args.sizes:
+                    result = run_config(args, groups, transport, dtype_name,
+                                        size, num_threads, device)
+                    results.append(result)
+                    if rank == 0:
+                        print(json.dumps(result), flush=True)
+
+    if rank == 0 and args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'backend': args.backend,
+                       'num_processes': args.num_processes,
+                       'cache_tensor_shapes': args.cache_tensor_shapes,
+                       'pack_tensors': args.pack_tensors,
+                       'results': results}, f, indent=2)
+    dist.barrier()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the pipeline communication library')
+    parser.add_argument("--backend", type=str, default='gloo',
+                        help="Backend")
+    parser.add_argument("--num_processes", type=int, default=2,
+                        help="Number of local processes (must be even)")
+    parser.add_argument("--master_addr", type=str, default='localhost',
+                        help="IP address of master")
+    parser.add_argument('-p', "--master_port", type=int, default=12346,
+                        help="Port used to communicate tensors")
+    parser.add_argument("--sizes", type=int, nargs='+',
+                        default=[1000, 100000, 10000000],
+                        help="Message sizes, in elements")
+    parser.add_argument("--dtypes", type=str, nargs='+',
+                        default=['float32'], choices=sorted(DTYPES),
+                        help="Tensor dtypes")
+    parser.add_argument("--threads", type=int, nargs='+', default=[1],
+                        help="Numbers of concurrent helper threads")
+    parser.add_argument("--transports", type=str, nargs='+',
+                        default=TRANSPORTS, choices=TRANSPORTS,
+                        help="Transports")
+    parser.add_argument("--num_warmup", type=int, default=5,
+                        help="Untimed round trips per thread")
+    parser.add_argument("--num_iterations", type=int, default=50,
+                        help="Timed round trips per thread")
+    parser.add_argument("--cache_tensor_shapes", action='store_true',
+                        help="Negotiate shapes once per channel")
+    parser.add_argument("--pack_tensors", action='store_true',
+                        help="Send messages as one packed buffer")
+    parser.add_argument("--output", type=str, default=None,
+                        help="Path of the JSON report")
+
+    args = parser.parse_args()
+    assert args.num_processes % 2 == 0, "--num_processes must be even"
+    mp.spawn(run, args=(args,), nprocs=args.num_processes)
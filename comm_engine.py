@@ -0,0 +1,355 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import collections
+import threading
+import time
+import torch
+import torch.distributed as dist
+
+import communication
+
+"""
+Communication engine: one thread per worker that drives every channel.
+
+Instead of one helper thread per (tensor, peer, direction), the engine owns
+all channels of the worker and advances them with asynchronous collectives
+(broadcast with async_op=True on two-rank groups, or isend/irecv on the
+default group). A pass over the channels never blocks: a channel starts a
+message when its queue has one and fewer than max_in_flight of its messages
+are in flight, and retires messages whose requests completed. When no
+channel made progress, the engine sleeps until the compute thread enqueues
+or consumes a message, or until POLL_INTERVAL has passed if requests are in
+flight.
+
+Messages always use the packed format: a header with the layout of the
+message, then one byte buffer. The engine thread is started once and serves
+the channels of every epoch.
+"""
+
+POLL_INTERVAL = 0.0002
+
+
+class CommEngine(object):
+    def __init__(self, backend, local_rank):
+        self.backend = backend
+        if torch.cuda.is_available():
+            self.device = torch.device('cuda', local_rank)
+        else:
+            self.device = torch.device('cpu')
+        self.local_rank = local_rank
+        self.channels = []
+        self.finished_channels = []
+        self.cv = threading.Condition()
+        self.thread = None
+
+    def add_channel(self, sending, args, max_in_flight):
+        """ Adds a channel built from the arguments of send_helper_thread
+        or recv_helper_thread.
+        """
+        if sending:
+            channel = SendChannel(self, max_in_flight, *args)
+        else:
+            channel = RecvChannel(self, max_in_flight, *args)
+        with self.cv:
+            self.channels.append(channel)
+            self.cv.notify_all()
+        self.start()
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.loop,
+                                           name="comm-engine")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def notify(self):
+        """ Wakes the engine up; called after the compute thread enqueued
+        or consumed a message.
+        """
+        with self.cv:
+            self.cv.notify_all()
+
+    def loop(self):
+        if torch.cuda.is_available():
+            torch.cuda.set_device(self.local_rank)
+        while True:
+            with self.cv:
+                channels = list(self.channels)
+            progress = False
+            in_flight = False
+            for channel in channels:
+                progress = channel.step() or progress
+                in_flight = in_flight or channel.num_in_flight() > 0
+                if channel.finished():
+                    with self.cv:
+                        self.channels.remove(channel)
+                        self.finished_channels.append(channel)
+                    channel.counter.decrement()
+            if progress:
+                continue
+            with self.cv:
+                if in_flight:
+                    self.cv.wait(POLL_INTERVAL)
+                else:
+                    self.cv.wait(POLL_INTERVAL * 10)
+
+    def stats(self):
+        """ Returns the number of messages and the maximum number of
+        messages in flight of every channel, keyed by
+        direction/tensor_name/peer.
+        """
+        with self.cv:
+            channels = self.finished_channels + self.channels
+        stats = {}
+        for channel in channels:
+            name = channel.name()
+            channel_stats = stats.setdefault(
+                name, {'messages': 0, 'max_in_flight': 0})
+            channel_stats['messages'] += channel.num_messages
+            channel_stats['max_in_flight'] = max(
+                channel_stats['max_in_flight'], channel.max_in_flight_seen)
+        return stats
+
+    def header_tensor(self, staging_device=None):
+        device = staging_device
+        if device is None:
+            device = self.device if self.backend == communication.NCCL \
+                else torch.device('cpu')
+        return torch.zeros(communication.PACKED_HEADER_SIZE,
+                           dtype=torch.int64, device=device)
+
+
+class Channel(object):
+    """ One direction of a link, driven by the engine. Links use either a
+    two-rank broadcast group or, if transport is a P2PTransport, tagged
+    isend/irecv. Links with neither carry empty messages.
+    """
+    def __init__(self, engine, max_in_flight, queue, counter, tensor_name,
+                 peer, sub_process_group, transport, compressor,
+                 channel_trace, num_iterations):
+        self.engine = engine
+        self.max_in_flight = max(max_in_flight, 1)
+        self.queue = queue
+        self.counter = counter
+        self.tensor_name = tensor_name
+        self.peer = peer
+        self.sub_process_group = sub_process_group
+        self.transport = transport
+        self.compressor = compressor
+        self.channel_trace = channel_trace
+        self.num_iterations = num_iterations
+        self.num_messages = 0
+        self.max_in_flight_seen = 0
+        # Messages in flight, oldest first.
+        self.in_flight = collections.deque()
+
+    def num_in_flight(self):
+        return len(self.in_flight)
+
+    def finished(self):
+        return self.num_messages == self.num_iterations
+
+    def device(self):
+        if self.transport is not None:
+            return self.transport.staging_device
+        return self.engine.device
+
+    def start_op(self, tensor, src_rank, sending):
+        """ Starts an asynchronous operation on the link; returns its
+        request, or None for empty tensors.
+        """
+        if tensor.numel() == 0:
+            return None
+        if self.transport is not None:
+            if sending:
+                return dist.isend(tensor, self.transport.peer,
+                                  tag=self.transport.tag)
+            return dist.irecv(tensor, self.transport.peer,
+                              tag=self.transport.tag)
+        return dist.broadcast(tensor=tensor, src=src_rank,
+                              group=self.sub_process_group, async_op=True)
+
+    def track_in_flight(self):
+        self.max_in_flight_seen = max(self.max_in_flight_seen,
+                                      len(self.in_flight))
+
+
+def _completed(requests):
+    return all(request is None or request.is_completed()
+               for request in requests)
+
+
+class SendChannel(Channel):
+    def __init__(self, engine, max_in_flight, queue, rank_list,
+                 training_tensor_dtypes, counter, local_rank, tensor_name,
+                 src_rank, dst_rank, tag, sub_process_group, transport,
+                 shape_cache, release_queue, compressor, packed,
+                 channel_trace, num_iterations):
+        Channel.__init__(self, engine, max_in_flight, queue, counter,
+                         tensor_name, dst_rank, sub_process_group, transport,
+                         compressor, channel_trace, num_iterations)
+        self.src_rank = src_rank
+        self.release_queue = release_queue
+        self.num_started = 0
+
+    def name(self):
+        return "send/%s/%d" % (self.tensor_name, self.peer)
+
+    def step(self):
+        progress = False
+        # Retire sent messages in order.
+        while len(self.in_flight) > 0 and _completed(self.in_flight[0][0]):
+            (requests, _, buffer_pools, record, start_time, nbytes) = \
+                self.in_flight.popleft()
+            for request in requests:
+                if request is not None:
+                    request.wait()
+            for buffer_pool in buffer_pools:
+                buffer_pool.release()
+            if record is not None:
+                self.channel_trace.finish(record, start=start_time,
+                                          end=time.time(), bytes=nbytes)
+            self.num_messages += 1
+            progress = True
+
+        while self.num_started < self.num_iterations and \
+                len(self.in_flight) < self.max_in_flight:
+            (available, tensor_list) = self.queue.try_remove()
+            if not available:
+                break
+            self.start_message(tensor_list)
+            progress = True
+        return progress
+
+    def start_message(self, tensor_list):
+        record = None
+        if self.channel_trace is not None:
+            record = self.channel_trace.dequeued()
+        buffer_pools = []
+        if self.release_queue is not None:
+            # Added before the message by CommunicationHandler.send().
+            buffer_pools = self.release_queue.remove()
+        start_time = time.time()
+        if self.sub_process_group is None and self.transport is None:
+            self.in_flight.append(([], [], buffer_pools, record, start_time,
+                                   0))
+            self.num_started += 1
+            return
+        if self.compressor is not None:
+            tensor_list = self.compressor.encode(tensor_list)
+
+        layout = communication._message_layout(tensor_list)
+        header = self.engine.header_tensor(
+            self.device() if self.transport is not None else None)
+        header.copy_(torch.tensor(
+            communication._encode_packed_header(layout), dtype=torch.int64))
+        _, nbytes = communication._packed_offsets(layout)
+        buffer = torch.empty(nbytes, dtype=torch.uint8, device=self.device())
+        communication.pack_tensors(tensor_list, layout, buffer)
+        if buffer.is_cuda:
+            # Collectives run on their own streams.
+            torch.cuda.current_stream().synchronize()
+
+        requests = [self.start_op(header, self.src_rank, sending=True),
+                    self.start_op(buffer, self.src_rank, sending=True)]
+        # The tensors are kept alive until the requests complete.
+        self.in_flight.append((requests, [header, buffer], buffer_pools,
+                               record, start_time, nbytes))
+        self.num_started += 1
+        self.track_in_flight()
+
+
+class RecvChannel(Channel):
+    def __init__(self, engine, max_in_flight, queue, rank_list,
+                 training_tensor_dtypes, counter, local_rank, tensor_name,
+                 src_rank, tag, tensor_shape, dtype, sub_process_group,
+                 transport, shape_cache, buffer_pool, compressor, packed,
+                 channel_trace, num_iterations):
+        Channel.__init__(self, engine, max_in_flight, queue, counter,
+                         tensor_name, src_rank, sub_process_group, transport,
+                         compressor, channel_trace, num_iterations)
+        self.src_rank = src_rank
+        self.buffer_pool = buffer_pool
+        self.num_posted = 0
+        # (request, header tensor, start time) of the header being
+        # received, posted once the previous payload is posted.
+        self.pending_header = None
+
+    def name(self):
+        return "recv/%s/%d" % (self.tensor_name, self.peer)
+
+    def step(self):
+        progress = False
+        # Hand received messages to the compute thread in order.
+        while len(self.in_flight) > 0 and \
+                _completed(self.in_flight[0][0]) and self.queue.has_room():
+            self.finish_message(self.in_flight.popleft())
+            progress = True
+
+        if self.sub_process_group is None and self.transport is None:
+            # Links without a group carry empty messages.
+            while self.num_posted < self.num_iterations and \
+                    self.queue.has_room():
+                self.queue.add([])
+                self.num_posted += 1
+                self.num_messages += 1
+                progress = True
+            return progress
+
+        if self.pending_header is not None:
+            (request, header, start_time) = self.pending_header
+            if request.is_completed():
+                request.wait()
+                self.pending_header = None
+                self.post_payload(header, start_time)
+                progress = True
+
+        if self.pending_header is None and \
+                self.num_posted < self.num_iterations and \
+                len(self.in_flight) < self.max_in_flight and \
+                (self.buffer_pool is None or
+                 self.buffer_pool.try_begin_message()):
+            header = self.engine.header_tensor(
+                self.device() if self.transport is not None else None)
+            start_time = time.time()
+            self.pending_header = (
+                self.start_op(header, self.src_rank, sending=False), header,
+                start_time)
+            self.num_posted += 1
+            progress = True
+        return progress
+
+    def num_in_flight(self):
+        return len(self.in_flight) + int(self.pending_header is not None)
+
+    def post_payload(self, header, start_time):
+        layout, offsets, nbytes = communication._decode_packed_header(
+            header.tolist())
+        buffer = communication._new_buffer(self.buffer_pool, [nbytes],
+                                           torch.uint8, self.engine.device)
+        staged = buffer
+        if self.device() != self.engine.device:
+            staged = torch.empty(nbytes, dtype=torch.uint8,
+                                 device=self.device())
+        request = self.start_op(staged, self.src_rank, sending=False)
+        self.in_flight.append(([request], buffer, staged, layout, offsets,
+                               nbytes, start_time))
+        self.track_in_flight()
+
+    def finish_message(self, message):
+        (requests, buffer, staged, layout, offsets, nbytes, start_time) = \
+            message
+        for request in requests:
+            if request is not None:
+                request.wait()
+        if staged is not buffer:
+            buffer.copy_(staged)
+        tensor_list = communication.unpack_tensors(buffer, layout, offsets)
+        if self.channel_trace is not None:
+            self.channel_trace.enqueued(start=start_time, end=time.time(),
+                                        bytes=nbytes)
+        if self.compressor is not None:
+            tensor_list = self.compressor.decode(tensor_list)
+        self.queue.add(tensor_list)
+        self.num_messages += 1
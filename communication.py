@@ -1,20 +1,67 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT license.
 
+import atexit
+import collections
+import itertools
 import os
+import tempfile
 import threading
+import time
 import torch
 import torch.distributed as dist
 import sys
 
+import compression
 import threadsafe_counter
 import threadsafe_queue
+import tracing
 
 #import ndist
 
 NCCL='nccl'
 GLOO='gloo'
 
+# Transports for stage-to-stage messages: broadcasts on two-rank process
+# groups, or tagged isend/irecv on the default process group.
+BROADCAST='broadcast'
+ISEND='isend'
+P2P_TRANSPORTS = [BROADCAST, ISEND]
+
+# Shape handshake layout: at most MAX_TENSOR_DIMS dimensions per tensor and
+# MAX_TENSORS_PER_MESSAGE tensors per message.
+MAX_TENSOR_DIMS = 10
+MAX_TENSORS_PER_MESSAGE = 16
+# Wire codes for the dtypes that can be negotiated in a shape handshake.
+HANDSHAKE_DTYPES = [torch.float32, torch.float16, torch.float64,
+                    torch.bfloat16, torch.int64, torch.int32, torch.int16,
+                    torch.int8, torch.uint8, torch.bool]
+ELEMENT_SIZES = {dtype: torch.tensor([], dtype=dtype).element_size()
+                 for dtype in HANDSHAKE_DTYPES}
+# Packed messages: every tensor starts at a multiple of PACKED_ALIGNMENT bytes
+# of the payload, so that it can be viewed in place with its own dtype. The
+# header holds the number of tensors, the payload size, and (dtype, offset,
+# ndims, dims) of every tensor.
+PACKED_ALIGNMENT = 8
+PACKED_HEADER_SIZE = 2 + MAX_TENSORS_PER_MESSAGE * (3 + MAX_TENSOR_DIMS)
+
+# Shared-memory rings, used for links between ranks on the same server when
+# shm_transport is set.
+SHM='shm'
+SHM_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+# A ring file starts with the sequence number of the last message consumed by
+# the receiver, followed by the slots. A slot holds a packed header and the
+# packed payload of one message.
+SHM_RING_HEADER_BYTES = 64
+SHM_SLOT_HEADER_BYTES = PACKED_HEADER_SIZE * 8
+SHM_MIN_SLOT_BYTES = 1 << 20
+SHM_POLL_INTERVAL = 0.0001
+# A doorbell is [seq, slot, nbytes, generation, slot_bytes, num_slots, owner].
+SHM_DOORBELL_SIZE = 7
+
+# Print every tensor sent and received with broadcasts.
+LOG_MESSAGES = True
+
 
 class CommunicationHandler(object):
     """ Handles communication between stages.
@@ -24,10 +71,61 @@ class CommunicationHandler(object):
     """
     def __init__(self, master_addr, master_port, rank,
                  local_rank, num_ranks_in_server,
-                 world_size, fp16, backend):
+                 world_size, fp16, backend, cache_tensor_shapes=False,
+                 pack_tensors=False, recv_buffer_pool=False,
+                 p2p_transport=BROADCAST, queue_capacity=None,
+                 shm_transport=False, compression_config=None,
+                 tracer=None, comm_engine=False, link_process_groups=None):
         """ Set up process groups.
 
         Note: To turn off broadcasting, set num_ranks_in_server = 1.
+
+        If cache_tensor_shapes is set, the shapes and dtypes of a message are
+        negotiated once per (tensor name, peer, direction) channel and only
+        renegotiated when the sender produces a different layout.
+
+        If pack_tensors is set, all tensors of a message are copied into one
+        contiguous byte buffer and sent with a single collective; receivers
+        get views into the received buffer.
+
+        If recv_buffer_pool is set, received tensors are written into
+        buffers recycled once the runtime has consumed the microbatch, instead
+        of freshly allocated ones.
+
+        p2p_transport selects how messages travel: BROADCAST uses a pair of
+        two-rank process groups per (rank pair, tag), ISEND uses tagged
+        isend/irecv on the default group without creating any groups, and
+        lets up to the number of in-flight microbatches be outstanding per
+        channel. ISEND requires the gloo backend, since NCCL ignores tags.
+
+        Queues between the compute thread and helper threads hold at most
+        queue_capacity messages, and producers block when they are full. If
+        queue_capacity is None, the capacity is the pipeline depth of the
+        stage; if it is 0, queues are unbounded.
+
+        If shm_transport is set, links to ranks on the same server exchange
+        messages through shared-memory rings, and only a small doorbell goes
+        through the default process group, which must use gloo.
+
+        compression_config, as loaded by compression.load_config(), selects
+        the codec of every tensor sent by this worker. Encoded messages are
+        self-describing, so they need a transport that sends dtypes: shape
+        caching, packed messages, isend, or shared memory.
+
+        If tracer, a tracing.Tracer, is set, every message sent or received
+        by helper threads is recorded.
+
+        If comm_engine is set, a single comm_engine.CommEngine thread drives
+        all channels with asynchronous collectives, instead of one helper
+        thread per channel. Messages are then always packed, and the
+        shared-memory transport is not supported.
+
+        link_process_groups, as built by create_link_process_groups(), gives
+        the groups of the links of an interleaved virtual stage, keyed by
+        (connected rank, whether the connected rank is upstream). They
+        replace the groups of create_process_groups(), which are keyed by
+        rank pair only and so can't tell apart several links between the
+        same ranks.
         """
         self.rank = rank
         self.local_rank = local_rank
@@ -35,7 +133,57 @@ class CommunicationHandler(object):
         self.num_ranks_in_server = num_ranks_in_server
         self.world_size = world_size
         self.fp16 = fp16
+        self.cache_tensor_shapes = cache_tensor_shapes
+        self.pack_tensors = pack_tensors
+        self.recv_buffer_pool = recv_buffer_pool
+        self.pipeline_depth = 1
+        self.queue_capacity = queue_capacity
+        self.p2p_transport = p2p_transport
         assert num_ranks_in_server > 0
+        assert p2p_transport in P2P_TRANSPORTS, p2p_transport
+        assert p2p_transport != ISEND or backend == GLOO, \
+            "isend transport requires the gloo backend"
+        self.shm_transport = shm_transport
+        assert not shm_transport or backend == GLOO, \
+            "shared-memory transport requires the gloo backend"
+        self.master_port = master_port
+        self.compression_config = compression_config
+        self.link_process_groups = link_process_groups
+        assert link_process_groups is None or (
+            p2p_transport == BROADCAST and not shm_transport), \
+            "links of interleaved stages need the broadcast transport"
+        self.comm_engine = None
+        if comm_engine:
+            assert not shm_transport, \
+                "the communication engine doesn't support shared memory"
+            # The engine always sends packed messages.
+            self.pack_tensors = True
+        assert compression_config is None or cache_tensor_shapes or \
+            pack_tensors or comm_engine or p2p_transport == ISEND, \
+            "compression requires shape caching, packing or isend"
+
+        # Fail here rather than at the first message, in a helper thread.
+        if self.pack_tensors or shm_transport:
+            _check_dtype_views()
+        if comm_engine:
+            from comm_engine import CommEngine
+            self.comm_engine = CommEngine(backend, local_rank)
+
+        # Stores negotiated message layouts, keyed by
+        # (tensor_name, connected_rank, direction).
+        self.shape_caches = {}
+        # Stores receive buffers, keyed like the shape caches.
+        self.buffer_pools = {}
+        # Stores compressors, keyed like the shape caches.
+        self.compressors = {}
+        # Pools holding the buffers of received microbatches not yet
+        # consumed by the runtime, oldest first.
+        self.forward_buffers_in_use = collections.deque()
+        self.backward_buffers_in_use = collections.deque()
+        self.tracer = tracer
+        # Stores traces of messages in flight, keyed by
+        # (tensor_name, index, backward, sending).
+        self.channel_traces = {}
 
         # Initialize the distributed environment.
         # os.environ['MASTER_ADDR'] = master_addr
@@ -68,21 +216,31 @@ class CommunicationHandler(object):
         assert len(self.ranks_in_server) == num_ranks_in_server - 1, \
             self.ranks_in_server
 
+    def link_transport(self, connected_rank):
+        """ Returns the transport used on the link to connected_rank. """
+        if self.shm_transport and connected_rank in self.ranks_in_server:
+            return SHM
+        return self.p2p_transport
+
     def is_gpu_to_gpu_comm(self, connected_rank):
-        return True
+        """ Whether the link to connected_rank uses broadcasts on two-rank
+        process groups. """
+        return self.link_transport(connected_rank) == BROADCAST
 
     def register_tensor(self, connected_rank, tag):
         """
-        Builds connections list of tensors that are communicated GPU to GPU.
+        Builds connections list of ranks that tensors are communicated with
+        GPU to GPU.
 
         For tensors that are sent GPU-to-GPU (intra-server for GLOO backend),
-        make a list of destination/source ranks and the corresponding tag.
-        This information is then used to crate process groups.
+        make a list of destination/source ranks. Process groups are shared
+        by all tags of a rank pair, so each rank appears once. This
+        information is then used to crate process groups.
         """
         if not self.is_gpu_to_gpu_comm(connected_rank=connected_rank):
             return
-        connection_info = [tag, connected_rank]
-        self.connection_list.append(connection_info)
+        if connected_rank not in self.connection_list:
+            self.connection_list.append(connected_rank)
 
     def initialize(self, receive_ranks, send_ranks,
                    tensor_tags, target_tensor_names,
@@ -124,6 +282,7 @@ class CommunicationHandler(object):
         self.backward_receive_queues = {}
         self.forward_send_queues = {}
         self.backward_send_queues = {}
+        self.backward_send_releases = {}
         self.num_forward_threads = 0
         self.num_backward_threads = 0
 
@@ -133,11 +292,14 @@ class CommunicationHandler(object):
         for input_name in self.receive_ranks:
             self.forward_receive_queues[input_name] = []
             self.backward_send_queues[input_name] = []
+            self.backward_send_releases[input_name] = []
             for i in range(len(self.receive_ranks[input_name])):
                 self.forward_receive_queues[input_name].append(
                     threadsafe_queue.Queue())
                 self.backward_send_queues[input_name].append(
                     threadsafe_queue.Queue())
+                self.backward_send_releases[input_name].append(
+                    threadsafe_queue.Queue())
                 target_receive_rank = self.receive_ranks[input_name][i]
                 self.register_tensor(
                     connected_rank=target_receive_rank,
@@ -216,6 +378,35 @@ class CommunicationHandler(object):
     def set_tensor_shapes(self, tensor_shapes):
         self.tensor_shapes = tensor_shapes
 
+    def set_pipeline_depth(self, pipeline_depth):
+        """ Sets the number of microbatches in flight at this stage. It
+        bounds the received microbatches whose buffers can be in use at the
+        same time on each channel, the messages outstanding on each channel,
+        and by default the capacity of queues.
+        """
+        self.pipeline_depth = pipeline_depth
+
+    def all_queues(self):
+        """ Yields (name, queue) for every queue between the compute
+        thread and helper threads.
+        """
+        for (direction, queues) in [
+                ('forward_receive', self.forward_receive_queues),
+                ('forward_send', self.forward_send_queues),
+                ('backward_receive', self.backward_receive_queues),
+                ('backward_send', self.backward_send_queues)]:
+            for tensor_name in sorted(queues):
+                for (index, queue) in enumerate(queues[tensor_name]):
+                    yield ("%s/%s/%d" % (direction, tensor_name, index),
+                           queue)
+
+    def queue_stats(self):
+        """ Returns the occupancy stats of every queue, keyed by
+        direction/tensor_name/index.
+        """
+        return dict((name, queue.stats()) for (name, queue) in
+                    self.all_queues())
+
     def set_counter(self, counter):
         self.counter = threadsafe_counter.Counter(counter)
 
@@ -270,6 +461,26 @@ class CommunicationHandler(object):
             if "ack" in self.send_ranks:
                 del self.send_ranks["ack"]
 
+        # Buffers are only recycled in training, where consuming a microbatch
+        # in run_backward is a well-defined point. Shared-memory channels
+        # recycle them even without --recv_buffer_pool: copying out of the
+        # ring into a fresh allocation per message costs what the ring saves.
+        for ((_, connected_rank, _), buffer_pool) in self.buffer_pools.items():
+            reuse = self.recv_buffer_pool or \
+                self.link_transport(connected_rank) == SHM
+            buffer_pool.reset(self.pipeline_depth,
+                              reuse and not forward_only)
+        self.forward_buffers_in_use.clear()
+        self.backward_buffers_in_use.clear()
+        self.channel_traces = {}
+
+        queue_capacity = self.queue_capacity
+        if queue_capacity is None:
+            queue_capacity = self.pipeline_depth
+        for (_, queue) in self.all_queues():
+            queue.set_capacity(queue_capacity if queue_capacity > 0 else None)
+            queue.reset_stats()
+
         (num_iterations_for_forward_threads,
          num_iterations_for_backward_threads) = \
             self.num_iterations_for_helper_threads(
@@ -361,6 +572,10 @@ class CommunicationHandler(object):
         """
         args_func_args += [num_iterations]
         args = args_func(*args_func_args)
+        if self.comm_engine is not None:
+            self.comm_engine.add_channel(func == send_helper_thread, args,
+                                         max_in_flight=self.pipeline_depth)
+            return
         helper_thread = threading.Thread(target=func,
                                          args=args)
         helper_thread.start()
@@ -371,13 +586,13 @@ class CommunicationHandler(object):
         To create process groups in the same order, each worker collects
         the connection_list of all other workers. To do this, every worker
         gathers the largest size of all other worker's connection_lists (L).
-        Then every worker creates a tensor of size Lx2, where each row
-        represents a connection, and fills up this tensor depending on how
+        Then every worker creates a tensor of size L, where each element
+        is a connected rank, and fills up this tensor depending on how
         large its own connection list is. The worker(s) w/ the largest
         connection list will fill up the entire tensor.
 
         After constructing this list, an all_gather is performed, after which
-        each worker has an identical NxLx2 output, where N is the number of
+        each worker has an identical NxL output, where N is the number of
         workers (world_size), and each index of output represents a worker's
         connection list. For i=self.rank, the output will be identical to the
         workers local connection list.
@@ -388,10 +603,22 @@ class CommunicationHandler(object):
         doesn't exist for that connection, for both the forward and backward
         direction. Since ranks within process groups must always be identical,
         the smaller rank always goes first, followed by the larger rank.
+
+        Groups are keyed by rank pair and direction only, and shared by all
+        tags: every boundary tensor travels in the single "control" message,
+        so at most one helper thread broadcasts on each group.
         """
         if self.num_ranks_in_server == 1:
             return
 
+        if self.link_process_groups is not None:
+            # Created for all links of the pipeline by the runtime.
+            return
+
+        if self.p2p_transport == ISEND:
+            # Tagged isend/irecv use the default process group.
+            return
+
         print("Setting up process groups for broadcasts...")
 
         # Figure out the size of the largest connection list that any worker
@@ -412,7 +639,7 @@ class CommunicationHandler(object):
             return 
 
         # Build tensor to send local connection list to all other workers.
-        connection_list_tensor = torch.ones([max_connection_list_size, 2],
+        connection_list_tensor = torch.ones([max_connection_list_size],
                                             dtype=torch.int) * -1
         if self.backend == NCCL:
             connection_list_tensor = connection_list_tensor.cuda()
@@ -433,11 +660,9 @@ class CommunicationHandler(object):
 
         for src_rank in range(len(aggregated_connection_list)):
             for connection in aggregated_connection_list[src_rank]:
-                tag = int(connection[0])
-                dst_rank = int(connection[1])
+                dst_rank = int(connection)
 
-                if tag == -1:
-                    assert dst_rank == -1
+                if dst_rank == -1:
                     continue
 
                 min_rank = min(src_rank, dst_rank)
@@ -448,15 +673,12 @@ class CommunicationHandler(object):
                     self.process_groups[min_rank] = {}
 
                 if max_rank not in self.process_groups[min_rank]:
-                    self.process_groups[min_rank][max_rank] = {}
-
-                if tag not in self.process_groups[min_rank][max_rank]:
                     sub_process_group_fwd = dist.new_group(
                         ranks=[min_rank, max_rank])
                     sub_process_group_bwd = dist.new_group(
                         ranks=[min_rank, max_rank])
 
-                    self.process_groups[min_rank][max_rank][tag] = {
+                    self.process_groups[min_rank][max_rank] = {
                         'forward': sub_process_group_fwd,
                         'backward': sub_process_group_bwd
                     }
@@ -464,6 +686,8 @@ class CommunicationHandler(object):
                     if min_rank == self.rank or max_rank == self.rank:
                         local_rank_connections += 1
 
+        print("Created %d process groups for broadcasts" % (
+            2 * sum(len(groups) for groups in self.process_groups.values())))
         print(self.connection_list)
         assert local_rank_connections == len(self.connection_list)
 
@@ -542,16 +766,14 @@ class CommunicationHandler(object):
             src_rank = self.receive_ranks[tensor_name][index]
 
         sub_process_group = None
+        transport = None
         tag = self.tensor_tags[tensor_name]
-        if self.is_gpu_to_gpu_comm(connected_rank=src_rank) and tensor_name != "ack":
-            min_rank = min(self.rank, src_rank)
-            max_rank = max(self.rank, src_rank)
-            if src_rank > self.rank:
-                sub_process_group = \
-                    self.process_groups[min_rank][max_rank][tag]['backward']
-            else:
-                sub_process_group = \
-                    self.process_groups[min_rank][max_rank][tag]['forward']
+        if tensor_name != "ack":
+            transport = self.get_transport(src_rank, tag, backward,
+                                           sending=False)
+        if transport is None and self.is_gpu_to_gpu_comm(connected_rank=src_rank) and tensor_name != "ack":
+            sub_process_group = self.get_sub_process_group(
+                src_rank, backward, sending=False)
             assert sub_process_group
 
         if backward:
@@ -564,10 +786,20 @@ class CommunicationHandler(object):
 
             rank_list = self.receive_ranks
         tensor_shape = self.tensor_shapes[tensor_name]
+        shape_cache = self.get_shape_cache(tensor_name, src_rank, backward)
+        buffer_pool = None
+        if sub_process_group is not None or transport is not None:
+            buffer_pool = self.get_buffer_pool(tensor_name, src_rank, backward)
+
+        compressor = self.get_compressor(tensor_name, src_rank, backward,
+                                         sending=False)
+        channel_trace = self.get_channel_trace(tensor_name, index, src_rank,
+                                               backward, sending=False)
 
         return (queue, rank_list, self.training_tensor_dtypes, self.counter, self.local_rank, tensor_name,
                 src_rank, tag, tensor_shape, dtype, sub_process_group,
-                num_iterations)
+                transport, shape_cache, buffer_pool, compressor,
+                self.pack_tensors, channel_trace, num_iterations)
 
     def send_helper_thread_args(self, tensor_name, index,
                                 backward, num_iterations):
@@ -579,27 +811,204 @@ class CommunicationHandler(object):
             num_ranks_in_connected_stage = self.num_ranks_in_next_stage
 
         sub_process_group = None
+        transport = None
         tag = self.tensor_tags[tensor_name]
-        if self.is_gpu_to_gpu_comm(connected_rank=dst_rank) and tensor_name != "ack":
-            min_rank = min(self.rank, dst_rank)
-            max_rank = max(self.rank, dst_rank)
-            if dst_rank > self.rank:
-                sub_process_group = \
-                     self.process_groups[min_rank][max_rank][tag]['forward']
-            else:
-                sub_process_group = \
-                    self.process_groups[min_rank][max_rank][tag]['backward']
+        if tensor_name != "ack":
+            transport = self.get_transport(dst_rank, tag, backward,
+                                           sending=True)
+        if transport is None and self.is_gpu_to_gpu_comm(connected_rank=dst_rank) and tensor_name != "ack":
+            sub_process_group = self.get_sub_process_group(
+                dst_rank, backward, sending=True)
             assert sub_process_group
 
+        release_queue = None
         if backward:
             queue = self.backward_send_queues[tensor_name][index]
+            if tensor_name != "ack":
+                release_queue = self.backward_send_releases[tensor_name][index]
             rank_list = self.receive_ranks
         else:
             queue = self.forward_send_queues[tensor_name][index]
             rank_list = self.send_ranks
+        shape_cache = self.get_shape_cache(tensor_name, dst_rank, backward)
+        compressor = self.get_compressor(tensor_name, dst_rank, backward,
+                                         sending=True)
+        channel_trace = self.get_channel_trace(tensor_name, index, dst_rank,
+                                               backward, sending=True)
 
         return (queue, rank_list, self.training_tensor_dtypes, self.counter, self.local_rank, tensor_name, self.rank,
-                dst_rank, tag, sub_process_group, num_iterations)
+                dst_rank, tag, sub_process_group, transport, shape_cache,
+                release_queue, compressor, self.pack_tensors, channel_trace,
+                num_iterations)
+
+    def get_sub_process_group(self, connected_rank, backward, sending):
+        """ Returns the group carrying forward or backward messages between
+        this rank and connected_rank.
+        """
+        direction = 'backward' if backward else 'forward'
+        if self.link_process_groups is not None:
+            # Forward messages come from upstream and go downstream.
+            upstream = sending == backward
+            return self.link_process_groups[(connected_rank, upstream)][
+                direction]
+        # Without interleaving, upstream ranks are the smaller ranks.
+        min_rank = min(self.rank, connected_rank)
+        max_rank = max(self.rank, connected_rank)
+        return self.process_groups[min_rank][max_rank][direction]
+
+    def get_shape_cache(self, tensor_name, connected_rank, backward):
+        """ Returns the ShapeCache of a channel, or None if shapes are not
+        cached. Caches outlive helper threads, so layouts negotiated in one
+        epoch are reused in the next.
+        """
+        if not self.cache_tensor_shapes or tensor_name == "ack":
+            return None
+        key = (tensor_name, connected_rank,
+               "backward" if backward else "forward")
+        if key not in self.shape_caches:
+            self.shape_caches[key] = ShapeCache()
+        return self.shape_caches[key]
+
+    def get_channel_trace(self, tensor_name, index, connected_rank, backward,
+                          sending):
+        """ Returns the ChannelTrace of a helper thread's queue, or None if
+        tracing is off.
+        """
+        if self.tracer is None:
+            return None
+        key = (tensor_name, index, backward, sending)
+        self.channel_traces[key] = self.tracer.channel(
+            tensor_name, connected_rank, backward, sending)
+        return self.channel_traces[key]
+
+    def get_transport(self, connected_rank, tag, backward, sending):
+        """ Returns the transport object of one helper thread, or None if
+        the link uses broadcasts. Forward and backward messages of a tag use
+        distinct wire tags, so that both directions between a rank pair can
+        be in flight at the same time.
+        """
+        if torch.cuda.is_available():
+            device = torch.device('cuda', self.local_rank)
+        else:
+            device = torch.device('cpu')
+        wire_tag = 2 * tag + int(backward)
+        link_transport = self.link_transport(connected_rank)
+        if link_transport == ISEND:
+            return P2PTransport(connected_rank, wire_tag,
+                                self.backend, device,
+                                max_outstanding=self.pipeline_depth)
+        if link_transport == SHM:
+            if sending:
+                src_rank, dst_rank = self.rank, connected_rank
+            else:
+                src_rank, dst_rank = connected_rank, self.rank
+            return SharedMemoryTransport(
+                "cpm-%d-%d-%d-%d" % (self.master_port, src_rank, dst_rank,
+                                     wire_tag),
+                connected_rank, wire_tag, sending, device,
+                num_slots=self.pipeline_depth)
+        return None
+
+    def message_tensor_names(self, backward):
+        """ Returns the names of the tensors in the messages this worker
+        sends, in the order StageRuntime puts them in the message.
+        """
+        if backward:
+            return [tensor_name for tensor_name in self.receive_ranks
+                    if tensor_name not in self.target_tensor_names and
+                    "input" not in tensor_name]
+        return [tensor_name for tensor_name in self.send_ranks]
+
+    def get_compressor(self, tensor_name, connected_rank, backward, sending):
+        """ Returns the Compressor of a channel, or None if compression is
+        off. Compressors outlive helper threads, so error-feedback residuals
+        carry over across epochs.
+        """
+        if self.compression_config is None or tensor_name == "ack":
+            return None
+        key = (tensor_name, connected_rank,
+               "backward" if backward else "forward")
+        if key not in self.compressors:
+            codecs = None
+            if sending:
+                codecs = compression.codecs_for(
+                    self.compression_config,
+                    self.message_tensor_names(backward), backward)
+            self.compressors[key] = compression.Compressor(
+                codecs, self.compression_config.get(
+                    'block_size', compression.DEFAULT_BLOCK_SIZE))
+        return self.compressors[key]
+
+    def compression_stats(self):
+        """ Returns the bytes saved by compression and the time spent
+        encoding and decoding, across all channels of this worker.
+        """
+        stats = {'bytes_saved': 0, 'encode_time': 0.0, 'decode_time': 0.0}
+        for compressor in self.compressors.values():
+            stats['bytes_saved'] += compressor.stats['original_bytes'] - \
+                compressor.stats['wire_bytes']
+            stats['encode_time'] += compressor.stats['encode_time']
+            stats['decode_time'] += compressor.stats['decode_time']
+        return stats
+
+    def get_buffer_pool(self, tensor_name, connected_rank, backward):
+        """ Returns the RecvBufferPool of a channel. Pools are created even
+        if buffers are not recycled, to count allocations.
+        """
+        key = (tensor_name, connected_rank,
+               "backward" if backward else "forward")
+        if key not in self.buffer_pools:
+            if torch.cuda.is_available():
+                device = torch.device('cuda', self.local_rank)
+            else:
+                device = torch.device('cpu')
+            self.buffer_pools[key] = RecvBufferPool(device)
+        return self.buffer_pools[key]
+
+    def buffer_pool_stats(self):
+        """ Returns the number of receive buffers allocated and reused
+        across all channels of this worker.
+        """
+        stats = {'allocated': 0, 'reused': 0}
+        for buffer_pool in self.buffer_pools.values():
+            stats['allocated'] += buffer_pool.num_allocations
+            stats['reused'] += buffer_pool.num_reuses
+        return stats
+
+    def take_buffers_in_use(self):
+        """ Returns the pools holding the buffers of the oldest microbatch
+        consumed by the runtime.
+        """
+        buffer_pools = []
+        if len(self.forward_buffers_in_use) > 0:
+            buffer_pools.append(self.forward_buffers_in_use.popleft())
+        if len(self.backward_buffers_in_use) > 0:
+            buffer_pools.append(self.backward_buffers_in_use.popleft())
+        return buffer_pools
+
+    def release_buffers(self):
+        """ Recycles the buffers of the oldest microbatch consumed by the
+        runtime. Stages that send gradients upstream don't call this, since
+        the gradients can alias received buffers; the backward send helper
+        thread recycles them once the gradients are sent.
+        """
+        for buffer_pool in self.take_buffers_in_use():
+            buffer_pool.release()
+        self.notify_comm_engine()
+
+    def notify_comm_engine(self):
+        if self.comm_engine is not None:
+            self.comm_engine.notify()
+
+    def handshake_stats(self):
+        """ Returns the number of shape handshakes performed and skipped
+        across all channels of this worker.
+        """
+        stats = {'performed': 0, 'skipped': 0}
+        for shape_cache in self.shape_caches.values():
+            stats['performed'] += shape_cache.num_handshakes
+            stats['skipped'] += shape_cache.num_skipped_handshakes
+        return stats
 
     def recv(self, tensor_name, forward_minibatch_id,
              backward_minibatch_id, backward=False):
@@ -608,11 +1017,17 @@ class CommunicationHandler(object):
                 len(self.backward_receive_queues[tensor_name])
             tensor = self.backward_receive_queues[tensor_name][
                 index].remove()
+            self.notify_comm_engine()
+            self.trace_dequeued(tensor_name, index, backward, sending=False)
+            self.track_buffers_in_use(tensor_name, index, backward)
             return tensor
         else:
             index = self.get_messaging_index(sending=False)
             tensor_list = self.forward_receive_queues[tensor_name][
                 index].remove()
+            self.notify_comm_engine()
+            self.trace_dequeued(tensor_name, index, backward, sending=False)
+            self.track_buffers_in_use(tensor_name, index, backward)
             for tensor in tensor_list:
                 if tensor.dtype == torch.float32:
                     tensor = tensor.requires_grad_()
@@ -623,45 +1038,703 @@ class CommunicationHandler(object):
         if backward:
             index = self.get_messaging_index(sending=True)
             dst_rank = self.receive_ranks[tensor_name][index]
+            if tensor_name != "ack":
+                self.backward_send_releases[tensor_name][index].add(
+                    self.take_buffers_in_use())
+            self.trace_enqueued(tensor_name, index, backward, sending=True)
             self.backward_send_queues[tensor_name][index].add(tensor)
+            self.notify_comm_engine()
         else:
             index = (forward_minibatch_id + self.rank_in_stage) % \
                 len(self.send_ranks[tensor_name])
+            self.trace_enqueued(tensor_name, index, backward, sending=True)
             self.forward_send_queues[tensor_name][index].add(tensor)
+            self.notify_comm_engine()
+
+    def trace_enqueued(self, tensor_name, index, backward, sending):
+        channel_trace = self.channel_traces.get(
+            (tensor_name, index, backward, sending))
+        if channel_trace is not None:
+            channel_trace.enqueued()
+
+    def trace_dequeued(self, tensor_name, index, backward, sending):
+        channel_trace = self.channel_traces.get(
+            (tensor_name, index, backward, sending))
+        if channel_trace is not None:
+            channel_trace.finish(channel_trace.dequeued())
+
+    def track_buffers_in_use(self, tensor_name, index, backward):
+        if tensor_name == "ack":
+            return
+        if backward:
+            src_rank = self.send_ranks[tensor_name][index]
+            buffers_in_use = self.backward_buffers_in_use
+        else:
+            src_rank = self.receive_ranks[tensor_name][index]
+            buffers_in_use = self.forward_buffers_in_use
+        key = (tensor_name, src_rank, "backward" if backward else "forward")
+        if key in self.buffer_pools:
+            buffers_in_use.append(self.buffer_pools[key])
+
+
+def create_link_process_groups(links, rank):
+    """ Creates a forward and a backward two-rank group for every link,
+    given as (upstream stage, upstream rank, downstream rank) in the same
+    order on every rank. Returns the groups of the links of rank, keyed by
+    link.
+    """
+    link_process_groups = {}
+    for link in links:
+        (_, upstream_rank, downstream_rank) = link
+        ranks = sorted([upstream_rank, downstream_rank])
+        groups = {
+            'forward': dist.new_group(ranks=ranks),
+            'backward': dist.new_group(ranks=ranks)
+        }
+        if rank in ranks:
+            link_process_groups[link] = groups
+    print("Created %d process groups for broadcasts" % (2 * len(links)))
+    return link_process_groups
+
+class RecvBufferPool(object):
+    """ Receive buffers of one channel.
+
+    Buffers of a received message are acquired between begin_message() and
+    the return of _recv(), and are returned to the pool by release(), in the
+    order the messages were received. At most `capacity` messages can hold
+    buffers at a time; the receiving helper thread blocks in begin_message()
+    until the runtime has consumed the oldest one. If reuse is disabled,
+    every buffer is freshly allocated and release() is a no-op, but
+    allocations are still counted.
+    """
+    def __init__(self, device):
+        self.device = device
+        self.capacity = 1
+        self.reuse = False
+        self.num_allocations = 0
+        self.num_reuses = 0
+        self.free_buffers = {}
+        self.messages = collections.deque()
+        self.cv = threading.Condition()
+
+    def reset(self, capacity, reuse):
+        with self.cv:
+            self.capacity = capacity
+            self.reuse = reuse
+            self.messages.clear()
+            self.cv.notify_all()
+
+    def begin_message(self):
+        with self.cv:
+            if self.reuse:
+                while len(self.messages) >= self.capacity:
+                    self.cv.wait()
+            self.messages.append([])
+
+    def try_begin_message(self):
+        """ Like begin_message(), but returns False instead of blocking. """
+        with self.cv:
+            if self.reuse and len(self.messages) >= self.capacity:
+                return False
+            self.messages.append([])
+            return True
+
+    def acquire(self, shape, dtype):
+        key = (tuple(shape), dtype)
+        with self.cv:
+            free_buffers = self.free_buffers.get(key)
+            if self.reuse and free_buffers:
+                buffer = free_buffers.pop()
+                self.num_reuses += 1
+            else:
+                buffer = torch.empty(shape, dtype=dtype, device=self.device)
+                self.num_allocations += 1
+            if self.reuse:
+                self.messages[-1].append(buffer)
+        # Hand out an alias, so that autograd state set on a received tensor
+        # (requires_grad, .grad) doesn't stick to the buffer.
+        return buffer.detach()
+
+    def release(self):
+        with self.cv:
+            if not self.reuse or len(self.messages) == 0:
+                return
+            for buffer in self.messages.popleft():
+                key = (tuple(buffer.shape), buffer.dtype)
+                free_buffers = self.free_buffers.setdefault(key, [])
+                if len(free_buffers) < self.capacity:
+                    free_buffers.append(buffer)
+            self.cv.notify_all()
+
+class P2PTransport(object):
+    """ Sends or receives the messages of one channel with tagged
+    isend/irecv on the default process group.
+
+    A message is a header, in the packed header format, followed by one
+    payload tensor per message tensor, or a single packed payload. All of
+    them use the channel's tag, and are matched in order. Sends return
+    without waiting; the requests of up to max_outstanding messages are kept
+    along with the tensors they read from, and are reaped on later sends or
+    by flush(). Gloo only sends CPU tensors, so CUDA tensors are staged
+    through host memory.
+    """
+    def __init__(self, peer, tag, backend, device, max_outstanding=1):
+        self.peer = peer
+        self.tag = tag
+        self.device = device
+        self.max_outstanding = max(max_outstanding, 1)
+        if backend == GLOO:
+            self.staging_device = torch.device('cpu')
+        else:
+            self.staging_device = device
+        self.header = torch.zeros(PACKED_HEADER_SIZE, dtype=torch.int64,
+                                  device=self.staging_device)
+        # (requests, tensors, buffer_pools) of every message in flight,
+        # oldest first.
+        self.outstanding = collections.deque()
+        self.num_messages = 0
+        self.max_in_flight = 0
+
+    def send(self, tensor_list, packed=False, buffer_pools=()):
+        """ Starts sending a message. The pools in buffer_pools are
+        released once the message has been sent.
+        """
+        self.reap()
+        while len(self.outstanding) >= self.max_outstanding:
+            self.complete_oldest()
+
+        layout = _message_layout(tensor_list)
+        header = torch.tensor(_encode_packed_header(layout),
+                              dtype=torch.int64).to(self.staging_device)
+        tensors = [header]
+        if packed:
+            _, nbytes = _packed_offsets(layout)
+            buffer = torch.empty(nbytes, dtype=torch.uint8,
+                                 device=self.staging_device)
+            pack_tensors(tensor_list, layout, buffer)
+            tensors.append(buffer)
+        else:
+            for tensor in tensor_list:
+                if tensor.dtype == torch.bool:
+                    tensor = tensor.to(torch.int8)
+                tensor = tensor.detach().to(self.staging_device).contiguous()
+                tensors.append(tensor)
+
+        requests = [dist.isend(tensor, self.peer, tag=self.tag)
+                    for tensor in tensors if tensor.numel() > 0]
+        self.outstanding.append((requests, tensors, list(buffer_pools)))
+        self.num_messages += 1
+        self.max_in_flight = max(self.max_in_flight, len(self.outstanding))
+
+    def recv(self, packed=False, buffer_pool=None):
+        """ Receives a message and returns its list of tensors. """
+        if buffer_pool is not None:
+            buffer_pool.begin_message()
+        dist.irecv(self.header, self.peer, tag=self.tag).wait()
+        layout, offsets, nbytes = _decode_packed_header(self.header.tolist())
+
+        if packed:
+            wire_layout = [([nbytes], torch.uint8)]
+        else:
+            wire_layout = [(shape, torch.int8 if dtype == torch.bool else dtype)
+                           for (shape, dtype) in layout]
+        buffers = [_new_buffer(buffer_pool, shape, dtype, self.device)
+                   for (shape, dtype) in wire_layout]
+        if self.staging_device == self.device:
+            staged = buffers
+        else:
+            staged = [torch.empty(shape, dtype=dtype,
+                                  device=self.staging_device)
+                      for (shape, dtype) in wire_layout]
+        requests = [dist.irecv(tensor, self.peer, tag=self.tag)
+                    for tensor in staged if tensor.numel() > 0]
+        for request in requests:
+            request.wait()
+        if staged is not buffers:
+            for (buffer, tensor) in zip(buffers, staged):
+                buffer.copy_(tensor)
+        self.num_messages += 1
+
+        if packed:
+            return unpack_tensors(buffers[0], layout, offsets)
+        return [buffer.bool() if dtype == torch.bool else buffer
+                for (buffer, (_, dtype)) in zip(buffers, layout)]
+
+    def reap(self):
+        """ Retires the oldest messages whose requests have completed. """
+        while len(self.outstanding) > 0 and all(
+                request.is_completed() for request in self.outstanding[0][0]):
+            self.complete_oldest()
+
+    def complete_oldest(self):
+        requests, _, buffer_pools = self.outstanding.popleft()
+        for request in requests:
+            request.wait()
+        for buffer_pool in buffer_pools:
+            buffer_pool.release()
+
+    def flush(self):
+        """ Waits for all messages in flight. """
+        while len(self.outstanding) > 0:
+            self.complete_oldest()
+
+# Generations of shared-memory rings created by this process.
+_shm_generations = itertools.count()
+# Ring files created by this process that the receiver hasn't mapped (and
+# unlinked) yet; removed at exit, so that a failed job doesn't leak them.
+_shm_ring_paths = set()
+
+def _unlink_ring(path):
+    _shm_ring_paths.discard(path)
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+@atexit.register
+def _unlink_rings():
+    for path in list(_shm_ring_paths):
+        _unlink_ring(path)
+
+def _map_shared_file(path, nbytes):
+    if hasattr(torch, 'from_file'):
+        return torch.from_file(path, shared=True, size=nbytes,
+                               dtype=torch.uint8)
+    return torch.ByteTensor(torch.ByteStorage.from_file(path, True, nbytes))
+
+class SharedMemoryTransport(object):
+    """ Sends or receives the messages of one channel between two ranks on
+    the same server through a ring of slots in a shared-memory file.
+
+    The sender packs a message into the next free slot and sends a doorbell
+    [seq, slot, nbytes, generation, slot_bytes, num_slots, owner] with a
+    tagged isend.
+    The receiver copies the message out of the slot, into a buffer of
+    buffer_pool if given, and stores seq at the start of the file, which
+    frees the slot. The receiver unlinks a ring file as soon as it mapped it,
+    once both sides hold the mapping; the sender unlinks files not mapped yet
+    at exit. When a message doesn't fit in a
+    slot, the sender waits for the ring to drain and replaces it with a ring
+    of larger slots, identified by a new generation; the receiver maps the
+    file named by the doorbell.
+    """
+    def __init__(self, name, peer, tag, sending, device, num_slots=1):
+        self.name = name
+        self.peer = peer
+        self.tag = tag
+        self.sending = sending
+        self.device = device
+        self.num_slots = max(num_slots, 1)
+        self.seq = 0
+        self.generation = None
+        self.slot_bytes = 0
+        self.ring = None
+        self.consumed = None
+        self.path = None
+        # Doorbells in flight, oldest first.
+        self.outstanding = collections.deque()
+        self.doorbell = torch.zeros(SHM_DOORBELL_SIZE, dtype=torch.int64)
+        self.num_messages = 0
+        self.num_generations = 0
+
+    def ring_path(self, owner, generation):
+        return os.path.join(SHM_DIR, "%s-%d-%d" % (self.name, owner,
+                                                   generation))
+
+    def map_ring(self, owner, generation, slot_bytes, num_slots, create):
+        nbytes = SHM_RING_HEADER_BYTES + num_slots * slot_bytes
+        path = self.ring_path(owner, generation)
+        if create:
+            _shm_ring_paths.add(path)
+            with open(path, 'wb') as f:
+                f.truncate(nbytes)
+        self.ring = _map_shared_file(path, nbytes)
+        if not create:
+            # The sender created and mapped the file, so nobody opens it
+            # again.
+            _unlink_ring(path)
+        self.consumed = self.ring[:8].view(torch.int64)
+        self.path = path
+        self.generation = generation
+        self.slot_bytes = slot_bytes
+        self.num_generations += 1
+
+    def slot(self, index):
+        start = SHM_RING_HEADER_BYTES + index * self.slot_bytes
+        return self.ring[start:start + self.slot_bytes]
+
+    def wait_consumed(self, seq):
+        while int(self.consumed[0]) < seq:
+            time.sleep(SHM_POLL_INTERVAL)
+
+    def send(self, tensor_list, packed=False, buffer_pools=()):
+        """ Copies a message into the ring and rings the doorbell. The
+        message is copied before returning, so buffer_pools are released
+        right away.
+        """
+        layout = _message_layout(tensor_list)
+        _, nbytes = _packed_offsets(layout)
+        if nbytes + SHM_SLOT_HEADER_BYTES > self.slot_bytes:
+            slot_bytes = max(nbytes + SHM_SLOT_HEADER_BYTES,
+                             2 * self.slot_bytes, SHM_MIN_SLOT_BYTES)
+            slot_bytes = (slot_bytes + PACKED_ALIGNMENT - 1) // \
+                PACKED_ALIGNMENT * PACKED_ALIGNMENT
+            if self.ring is not None:
+                self.wait_consumed(self.seq)
+                _unlink_ring(self.path)
+            self.map_ring(os.getpid(), next(_shm_generations), slot_bytes,
+                          self.num_slots, create=True)
+            self.consumed.fill_(self.seq)
+
+        self.seq += 1
+        self.wait_consumed(self.seq - self.num_slots)
+        index = (self.seq - 1) % self.num_slots
+        slot = self.slot(index)
+        slot[:SHM_SLOT_HEADER_BYTES].view(torch.int64).copy_(
+            torch.tensor(_encode_packed_header(layout), dtype=torch.int64))
+        pack_tensors(tensor_list, layout, slot[SHM_SLOT_HEADER_BYTES:])
+        for buffer_pool in buffer_pools:
+            buffer_pool.release()
+
+        self.reap()
+        doorbell = torch.tensor([self.seq, index, nbytes, self.generation,
+                                 self.slot_bytes, self.num_slots,
+                                 os.getpid()],
+                                dtype=torch.int64)
+        self.outstanding.append(
+            (dist.isend(doorbell, self.peer, tag=self.tag), doorbell))
+        self.num_messages += 1
+
+    def recv(self, packed=False, buffer_pool=None):
+        """ Receives a message and returns its list of tensors. """
+        if buffer_pool is not None:
+            buffer_pool.begin_message()
+        dist.irecv(self.doorbell, self.peer, tag=self.tag).wait()
+        (seq, index, nbytes, generation, slot_bytes, num_slots,
+         owner) = self.doorbell.tolist()
+        if generation != self.generation:
+            # The sender's ring size depends on its own pipeline depth.
+            self.map_ring(owner, generation, slot_bytes, num_slots,
+                          create=False)
+
+        slot = self.slot(index)
+        layout, offsets, _ = _decode_packed_header(
+            slot[:SHM_SLOT_HEADER_BYTES].view(torch.int64).tolist())
+        buffer = _new_buffer(buffer_pool, [nbytes], torch.uint8, self.device)
+        buffer.copy_(slot[SHM_SLOT_HEADER_BYTES:
+                          SHM_SLOT_HEADER_BYTES + nbytes])
+        self.consumed.fill_(seq)
+        self.num_messages += 1
+        return unpack_tensors(buffer, layout, offsets)
+
+    def reap(self):
+        while len(self.outstanding) > 0 and \
+                self.outstanding[0][0].is_completed():
+            self.outstanding.popleft()
+
+    def flush(self):
+        """ Waits for the receiver to consume all messages, and removes the
+        ring file.
+        """
+        while len(self.outstanding) > 0:
+            self.outstanding.popleft()[0].wait()
+        if self.sending and self.ring is not None:
+            self.wait_consumed(self.seq)
+            _unlink_ring(self.path)
+            self.ring = None
+            self.consumed = None
+
+class ShapeCache(object):
+    """ Layout of the last message exchanged on one channel.
+
+    A message layout is the list of (shape, dtype) of the tensors in the
+    message. Before every payload the sender broadcasts a one-element flag:
+    0 means the cached layout is still valid, k > 0 means a new layout of k
+    tensors follows in a single handshake tensor. Each channel is driven by a
+    single helper thread, so no locking is needed.
+    """
+    def __init__(self):
+        self.layout = None
+        self.num_handshakes = 0
+        self.num_skipped_handshakes = 0
+        # Persistent flag and handshake buffers, allocated on first use.
+        self.flag = None
+        self.handshake = None
+
+    def buffers(self, backend):
+        if self.flag is None:
+            self.flag = torch.zeros(1, dtype=torch.int)
+            self.handshake = torch.zeros(
+                1 + MAX_TENSORS_PER_MESSAGE * (2 + MAX_TENSOR_DIMS),
+                dtype=torch.int)
+            if backend == NCCL:
+                self.flag = self.flag.cuda()
+                self.handshake = self.handshake.cuda()
+        return self.flag, self.handshake
+
+
+def _encode_layout(layout):
+    assert len(layout) <= MAX_TENSORS_PER_MESSAGE, len(layout)
+    values = [len(layout)]
+    for (shape, dtype) in layout:
+        assert len(shape) <= MAX_TENSOR_DIMS, shape
+        values.append(HANDSHAKE_DTYPES.index(dtype))
+        values.append(len(shape))
+        values.extend(shape)
+        values.extend([0] * (MAX_TENSOR_DIMS - len(shape)))
+    return values
+
+def _decode_layout(values):
+    layout = []
+    offset = 1
+    for _ in range(values[0]):
+        dtype = HANDSHAKE_DTYPES[values[offset]]
+        ndims = values[offset + 1]
+        shape = values[offset + 2:offset + 2 + ndims]
+        layout.append((shape, dtype))
+        offset += 2 + MAX_TENSOR_DIMS
+    return layout
+
+def _send_layout(layout, src_rank, sub_process_group, stream,
+                 shape_cache, backend):
+    """ Sends the layout flag, and the layout itself if it changed. """
+    flag, handshake = shape_cache.buffers(backend)
+    changed = layout != shape_cache.layout
+    flag.fill_(len(layout) if changed else 0)
+    with torch.cuda.stream(stream):
+        dist.broadcast(tensor=flag, src=src_rank, group=sub_process_group)
+    _synchronize(stream)
+    if not changed:
+        shape_cache.num_skipped_handshakes += 1
+        return
+
+    values = _encode_layout(layout)
+    handshake.zero_()
+    handshake[:len(values)].copy_(torch.tensor(values, dtype=torch.int))
+    with torch.cuda.stream(stream):
+        dist.broadcast(tensor=handshake, src=src_rank,
+                       group=sub_process_group)
+    _synchronize(stream)
+    shape_cache.layout = layout
+    shape_cache.num_handshakes += 1
+
+def _recv_layout(src_rank, sub_process_group, stream, shape_cache, backend):
+    """ Receives the layout flag and returns the layout of the message. """
+    flag, handshake = shape_cache.buffers(backend)
+    with torch.cuda.stream(stream):
+        dist.broadcast(tensor=flag, src=src_rank, group=sub_process_group)
+    _synchronize(stream)
+    if int(flag) == 0:
+        assert shape_cache.layout is not None
+        shape_cache.num_skipped_handshakes += 1
+        return shape_cache.layout
+
+    with torch.cuda.stream(stream):
+        dist.broadcast(tensor=handshake, src=src_rank,
+                       group=sub_process_group)
+    _synchronize(stream)
+    shape_cache.layout = _decode_layout(handshake.tolist())
+    shape_cache.num_handshakes += 1
+    return shape_cache.layout
+
+def _new_stream():
+    if torch.cuda.is_available():
+        return torch.cuda.Stream()
+    return None
+
+def _synchronize(stream):
+    if stream is not None:
+        stream.synchronize()
+
+def _current_device():
+    if torch.cuda.is_available():
+        return torch.cuda.current_device()
+    return torch.device('cpu')
+
+def _new_buffer(buffer_pool, shape, dtype, device):
+    # Received messages overwrite the whole buffer.
+    if buffer_pool is not None:
+        return buffer_pool.acquire(shape, dtype)
+    return torch.empty(shape, dtype=dtype, device=device)
+
+def _scratch_tensor(scratch, key, size, dtype, backend):
+    """ Returns a tensor of `size` elements that persists across calls made
+    with the same scratch dict, or a new one if scratch is None.
+    """
+    if scratch is not None and key in scratch and \
+            scratch[key].numel() == size:
+        return scratch[key]
+    tensor = torch.zeros(size, dtype=dtype)
+    if backend == NCCL:
+        tensor = tensor.cuda()
+    if scratch is not None:
+        scratch[key] = tensor
+    return tensor
+
+def _check_dtype_views():
+    """ Packed messages reinterpret byte buffers with Tensor.view(dtype). """
+    try:
+        torch.zeros(2, dtype=torch.float32).view(torch.uint8).view(
+            torch.float32)
+    except (TypeError, RuntimeError):
+        raise RuntimeError("Packed tensor messages require Tensor.view(dtype) "
+                           "between dtypes of different sizes; "
+                           "upgrade PyTorch or disable tensor packing "
+                           "(--pack_tensors, --shm_transport, --comm_engine)")
+
+def _message_layout(tensor_list):
+    return [(list(tensor.shape), tensor.dtype) for tensor in tensor_list]
+
+def _packed_offsets(layout):
+    """ Returns the byte offset of every tensor and the payload size. """
+    offsets = []
+    nbytes = 0
+    for (shape, dtype) in layout:
+        offsets.append(nbytes)
+        numel = 1
+        for dim in shape:
+            numel *= dim
+        tensor_nbytes = numel * ELEMENT_SIZES[dtype]
+        nbytes += (tensor_nbytes + PACKED_ALIGNMENT - 1) // \
+            PACKED_ALIGNMENT * PACKED_ALIGNMENT
+    return offsets, nbytes
+
+def _encode_packed_header(layout):
+    assert len(layout) <= MAX_TENSORS_PER_MESSAGE, len(layout)
+    offsets, nbytes = _packed_offsets(layout)
+    values = [len(layout), nbytes]
+    for ((shape, dtype), offset) in zip(layout, offsets):
+        assert len(shape) <= MAX_TENSOR_DIMS, shape
+        values.append(HANDSHAKE_DTYPES.index(dtype))
+        values.append(offset)
+        values.append(len(shape))
+        values.extend(shape)
+        values.extend([0] * (MAX_TENSOR_DIMS - len(shape)))
+    values.extend([0] * (PACKED_HEADER_SIZE - len(values)))
+    return values
+
+def _decode_packed_header(values):
+    layout = []
+    offsets = []
+    offset = 2
+    for _ in range(values[0]):
+        dtype = HANDSHAKE_DTYPES[values[offset]]
+        ndims = values[offset + 2]
+        layout.append((values[offset + 3:offset + 3 + ndims], dtype))
+        offsets.append(values[offset + 1])
+        offset += 3 + MAX_TENSOR_DIMS
+    return layout, offsets, values[1]
+
+def pack_tensors(tensor_list, layout, buffer):
+    """ Copies the tensors of a message into the byte buffer `buffer`. """
+    offsets, _ = _packed_offsets(layout)
+    for (tensor, offset) in zip(tensor_list, offsets):
+        tensor_nbytes = tensor.numel() * tensor.element_size()
+        if tensor_nbytes == 0:
+            continue
+        buffer[offset:offset + tensor_nbytes].copy_(
+            tensor.detach().reshape(-1).view(torch.uint8))
+    return buffer
+
+def unpack_tensors(buffer, layout, offsets):
+    """ Returns views of the tensors of a message packed into `buffer`. """
+    tensor_list = []
+    for ((shape, dtype), offset) in zip(layout, offsets):
+        numel = 1
+        for dim in shape:
+            numel *= dim
+        tensor_bytes = buffer[offset:offset + numel * ELEMENT_SIZES[dtype]]
+        tensor_list.append(tensor_bytes.view(dtype).view(shape))
+    return tensor_list
 
 def recv_helper_thread(queue, rank_list, training_tensor_dtypes, counter, local_rank, tensor_name,
                        src_rank, tag, tensor_shape, dtype,
-                       sub_process_group, num_iterations):
-    torch.cuda.set_device(local_rank)
+                       sub_process_group, transport, shape_cache, buffer_pool,
+                       compressor, packed, channel_trace, num_iterations):
+    stream = None
+    if torch.cuda.is_available():
+        torch.cuda.set_device(local_rank)
+        stream = torch.cuda.Stream()
+    scratch = {}
     # This method is to be executed from a helper daemon thread.
     for i in range(num_iterations):
-        tensor = _recv(
-            tensor_name, rank_list, training_tensor_dtypes, src_rank, tensor_shape=tensor_shape,
-            dtype=dtype, tag=tag,
-            sub_process_group=sub_process_group)
+        start_time = time.time()
+        if transport is not None:
+            tensor = transport.recv(packed=packed, buffer_pool=buffer_pool)
+        else:
+            tensor = _recv(
+                tensor_name, rank_list, training_tensor_dtypes, src_rank, tensor_shape=tensor_shape,
+                dtype=dtype, tag=tag,
+                sub_process_group=sub_process_group,
+                shape_cache=shape_cache, packed=packed, stream=stream,
+                scratch=scratch, buffer_pool=buffer_pool)
+        if channel_trace is not None:
+            channel_trace.enqueued(start=start_time, end=time.time(),
+                                   bytes=tracing.message_bytes(tensor))
+        if compressor is not None:
+            tensor = compressor.decode(tensor)
         queue.add(tensor)
     counter.decrement()
 
 def send_helper_thread(queue, rank_list, training_tensor_dtypes, counter, local_rank, tensor_name,
                        src_rank, dst_rank, tag,
-                       sub_process_group, num_iterations):
-    torch.cuda.set_device(local_rank)
+                       sub_process_group, transport, shape_cache, release_queue,
+                       compressor, packed, channel_trace, num_iterations):
+    stream = None
+    if torch.cuda.is_available():
+        torch.cuda.set_device(local_rank)
+        stream = torch.cuda.Stream()
+    scratch = {}
     # This method is to be executed from a helper daemon thread.
     for i in range(num_iterations):
         tensor = queue.remove()
-        _send(tensor, rank_list, training_tensor_dtypes, tensor_name, src_rank, dst_rank,
-              tag=tag,
-              sub_process_group=sub_process_group)
+        record = None
+        if channel_trace is not None:
+            record = channel_trace.dequeued()
+        if compressor is not None:
+            tensor = compressor.encode(tensor)
+        # The message may alias buffers received for the same microbatch,
+        # which can only be recycled once it is sent.
+        buffer_pools = []
+        if release_queue is not None:
+            buffer_pools = release_queue.remove()
+        start_time = time.time()
+        if transport is not None:
+            # Asynchronous transports return once the message is posted.
+            transport.send(tensor, packed=packed, buffer_pools=buffer_pools)
+        else:
+            _send(tensor, rank_list, training_tensor_dtypes, tensor_name, src_rank, dst_rank,
+                  tag=tag,
+                  sub_process_group=sub_process_group,
+                  shape_cache=shape_cache, packed=packed, stream=stream,
+                  scratch=scratch)
+            for buffer_pool in buffer_pools:
+                buffer_pool.release()
+        if record is not None:
+            channel_trace.finish(record, start=start_time, end=time.time(),
+                                 bytes=tracing.message_bytes(tensor))
+    if transport is not None:
+        transport.flush()
     counter.decrement()
 
 def _recv(tensor_name, rank_list, training_tensor_dtypes ,src_rank, tensor_shape=None, dtype=torch.float32,
-          tensor=None, tag=None, sub_process_group=None, backend=NCCL):
+          tensor=None, tag=None, sub_process_group=None, backend=NCCL,
+          shape_cache=None, packed=False, stream=None, scratch=None,
+          buffer_pool=None):
     """
     Receives tensor by calling PyTorch's recv() call.
 
     Tensor will be copied to GPU prior to return.
+
+    Helper threads pass their own stream and scratch dict, which persist
+    across calls, and the channel's buffer pool to receive into.
     """
-    s = torch.cuda.Stream()
+    s = stream if stream is not None else _new_stream()
+    if buffer_pool is not None:
+        buffer_pool.begin_message()
+
+    def new_buffer(shape, dtype):
+        return _new_buffer(buffer_pool, shape, dtype, _current_device())
 
     assert tag is not None
     if tensor is None:
@@ -670,21 +1743,61 @@ def _recv(tensor_name, rank_list, training_tensor_dtypes ,src_rank, tensor_shape
         assert dtype != torch.float16
 
     tensor_list = []
+    if sub_process_group is not None and packed:
+        if shape_cache is not None:
+            layout = _recv_layout(src_rank, sub_process_group, s,
+                                  shape_cache, backend)
+            offsets, nbytes = _packed_offsets(layout)
+        else:
+            header = _scratch_tensor(scratch, 'packed_header',
+                                     PACKED_HEADER_SIZE, torch.int64, backend)
+            with torch.cuda.stream(s):
+                dist.broadcast(tensor=header,
+                               src=src_rank,
+                               group=sub_process_group)
+            _synchronize(s)
+            layout, offsets, nbytes = _decode_packed_header(header.tolist())
+
+        buffer = new_buffer([nbytes], torch.uint8)
+        if nbytes > 0:
+            with torch.cuda.stream(s):
+                dist.broadcast(tensor=buffer,
+                               src=src_rank,
+                               group=sub_process_group)
+            _synchronize(s)
+        return unpack_tensors(buffer, layout, offsets)
+
+    if sub_process_group is not None and shape_cache is not None:
+        for (received_tensor_shape, received_dtype) in _recv_layout(
+                src_rank, sub_process_group, s, shape_cache, backend):
+            if received_dtype == torch.bool:
+                tensor = new_buffer(received_tensor_shape, torch.int8)
+            else:
+                tensor = new_buffer(received_tensor_shape, received_dtype)
+
+            with torch.cuda.stream(s):
+                dist.broadcast(tensor=tensor,
+                               src=src_rank,
+                               group=sub_process_group)
+            _synchronize(s)
+            if received_dtype == torch.bool:
+                tensor = tensor.bool()
+            tensor_list.append(tensor)
+        return tensor_list
+
     if sub_process_group is not None:
         # Receive tensor shape.
         for name in rank_list:
             #print("len(tensor_shape) ", len(tensor_shape))
-            received_tensor_shape = torch.zeros(10,
-                                            dtype=torch.int)
-            if backend == NCCL:
-                received_tensor_shape = received_tensor_shape.cuda()
+            received_tensor_shape = _scratch_tensor(
+                scratch, 'shape', MAX_TENSOR_DIMS, torch.int, backend)
 
             with torch.cuda.stream(s):
                 dist.broadcast(tensor=received_tensor_shape,
                             src=src_rank,
                             group=sub_process_group)
 
-            s.synchronize()
+            _synchronize(s)
             received_tensor_shape = list(map(lambda x: int(x),
                                              received_tensor_shape))
 
@@ -693,9 +1806,10 @@ def _recv(tensor_name, rank_list, training_tensor_dtypes ,src_rank, tensor_shape
             #print("received_tensorshape ", received_tensor_shape)
             # Receive tensor.
             if dtype == torch.bool:
-                tensor = torch.zeros(received_tensor_shape, dtype=torch.int8, device=torch.cuda.current_device())
+                tensor = new_buffer(received_tensor_shape, torch.int8)
             else:
-                tensor = torch.zeros(received_tensor_shape, dtype=training_tensor_dtypes[name], device=torch.cuda.current_device())
+                tensor = new_buffer(received_tensor_shape,
+                                    training_tensor_dtypes[name])
         
             if backend == NCCL:
                 tensor = tensor.cuda()
@@ -704,45 +1818,80 @@ def _recv(tensor_name, rank_list, training_tensor_dtypes ,src_rank, tensor_shape
                 dist.broadcast(tensor=tensor,
                             src=src_rank,
                             group=sub_process_group)
-            s.synchronize()
+            _synchronize(s)
             tensor_list.append(tensor)
-            print("received ", tensor.size(), "from ", src_rank)
+            if LOG_MESSAGES:
+                print("received ", tensor.size(), "from ", src_rank)
 
     for tensor in tensor_list:
-        assert tensor.is_cuda
+        assert tensor.is_cuda or not torch.cuda.is_available()
         if dtype == torch.bool:
             tensor = tensor.bool()
     return tensor_list
 
-def _send(tensor_list, rank_list, training_tensor_dtypes, tensor_name, src_rank, dst_rank, tag, sub_process_group=None, backend=NCCL):
+def _send(tensor_list, rank_list, training_tensor_dtypes, tensor_name, src_rank, dst_rank, tag, sub_process_group=None, backend=NCCL,
+          shape_cache=None, packed=False, stream=None, scratch=None):
     """
     Sends tensor by calling PyTorch's send() call.
 
     If tensor is being sent not via broadcast(), it will
     be first copied to the CPU.
     """
-    s = torch.cuda.Stream()
+    s = stream if stream is not None else _new_stream()
+
+    if sub_process_group is not None and packed:
+        layout = _message_layout(tensor_list)
+        if shape_cache is not None:
+            _send_layout(layout, src_rank, sub_process_group, s,
+                         shape_cache, backend)
+        else:
+            header = _scratch_tensor(scratch, 'packed_header',
+                                     PACKED_HEADER_SIZE, torch.int64, backend)
+            header.copy_(torch.tensor(_encode_packed_header(layout),
+                                      dtype=torch.int64))
+            with torch.cuda.stream(s):
+                dist.broadcast(tensor=header, src=src_rank,
+                               group=sub_process_group)
+            _synchronize(s)
+
+        # Packing copies every tensor, so no clone is needed for gloo.
+        _, nbytes = _packed_offsets(layout)
+        # Each broadcast completes before _send returns, so the payload buffer
+        # can be reused by the next message.
+        buffer = _scratch_tensor(scratch, 'packed', nbytes, torch.uint8,
+                                 backend)
+        pack_tensors(tensor_list, layout, buffer)
+        if nbytes > 0:
+            with torch.cuda.stream(s):
+                dist.broadcast(tensor=buffer, src=src_rank,
+                               group=sub_process_group)
+            _synchronize(s)
+        return
 
     if sub_process_group is not None:
+        if shape_cache is not None:
+            # Send the tensor shapes only if they changed.
+            _send_layout(_message_layout(tensor_list), src_rank,
+                         sub_process_group, s, shape_cache, backend)
         for tensor in tensor_list:
-            assert tensor.is_cuda
-            temp = list(tensor.shape)
-            # Send tensor shape.
-            while (len(temp)<10):
-                temp.append(0)
-            
-            tensor_shape = torch.tensor(temp, dtype=torch.int)
-
-            #print("sent tensor size why", tensor.size())
-            #print("sent tensor_shape ", tensor_shape)
-
-            if backend == NCCL:
-                tensor_shape = tensor_shape.cuda()
-
-            with torch.cuda.stream(s):
-                dist.broadcast(tensor=tensor_shape, src=src_rank,
-                        group=sub_process_group)
-            s.synchronize()
+            assert tensor.is_cuda or not torch.cuda.is_available()
+            if shape_cache is None:
+                temp = list(tensor.shape)
+                # Send tensor shape.
+                while (len(temp)<10):
+                    temp.append(0)
+
+                tensor_shape = _scratch_tensor(
+                    scratch, 'shape', MAX_TENSOR_DIMS, torch.int, backend)
+                tensor_shape.copy_(torch.tensor(temp, dtype=torch.int))
+
+                #print("sent tensor size why", tensor.size())
+                #print("sent tensor_shape ", tensor_shape)
+
+                with torch.cuda.stream(s):
+                    dist.broadcast(tensor=tensor_shape, src=src_rank,
+                            group=sub_process_group)
+                _synchronize(s)
             # Send tensor.
             if tensor.dtype == torch.bool:
                 tensor = tensor.to(torch.int8)
@@ -758,7 +1907,8 @@ def _send(tensor_list, rank_list, training_tensor_dtypes, tensor_name, src_rank,
                             src=src_rank,
                             group=sub_process_group)
 
-            s.synchronize()
-            print("sent ", tensor.size(), " from ", src_rank)
+            _synchronize(s)
+            if LOG_MESSAGES:
+                print("sent ", tensor.size(), " from ", src_rank)
 
 
@@ -0,0 +1,165 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import json
+import time
+import torch
+
+"""
+Compression of the tensors exchanged between pipeline stages.
+
+A compression config is a JSON file that maps, for each direction, tensor
+names to codecs, with an optional "default":
+
+    {"forward": {"default": "bf16"},
+     "backward": {"default": "int8", "out12": "none"},
+     "block_size": 256}
+
+Codecs only apply to floating point tensors:
+  - none: sent as is.
+  - bf16, fp16: cast before sending, cast back to the original dtype on
+    receipt.
+  - int8: block-wise symmetric quantization, one fp32 scale per block of
+    block_size elements. The quantization error of every slot of a channel
+    is added back to the next tensor sent in that slot (error feedback).
+
+An encoded message starts with an int64 codec header
+[n, (codec, dtype, ndims, dims)*n], so receivers don't need the config.
+"""
+
+NONE = 'none'
+BF16 = 'bf16'
+FP16 = 'fp16'
+INT8 = 'int8'
+CODECS = [NONE, BF16, FP16, INT8]
+CAST_DTYPES = {BF16: torch.bfloat16, FP16: torch.float16}
+DEFAULT_BLOCK_SIZE = 256
+
+MAX_TENSOR_DIMS = 10
+DTYPES = [torch.float32, torch.float16, torch.float64, torch.bfloat16,
+          torch.int64, torch.int32, torch.int16, torch.int8, torch.uint8,
+          torch.bool]
+
+
+def load_config(path):
+    config = json.load(open(path, 'r'))
+    for direction in ['forward', 'backward']:
+        for (tensor_name, codec) in config.get(direction, {}).items():
+            assert codec in CODECS, \
+                "Unknown codec %s for %s in %s" % (codec, tensor_name, path)
+    return config
+
+
+def codecs_for(config, tensor_names, backward):
+    """ Returns the codec of every tensor of a message. """
+    codecs = config.get('backward' if backward else 'forward', {})
+    default = codecs.get('default', NONE)
+    return [codecs.get(tensor_name, default) for tensor_name in tensor_names]
+
+
+class Compressor(object):
+    """ Encodes the messages sent on one channel, or decodes the messages
+    received on it, and keeps error-feedback residuals per message slot.
+    """
+    def __init__(self, codecs=None, block_size=DEFAULT_BLOCK_SIZE):
+        self.codecs = codecs if codecs is not None else []
+        self.block_size = block_size
+        self.residuals = {}
+        self.stats = {
+            'original_bytes': 0,
+            'wire_bytes': 0,
+            'encode_time': 0.0,
+            'decode_time': 0.0,
+        }
+
+    def codec(self, slot, tensor):
+        if slot >= len(self.codecs) or not tensor.is_floating_point():
+            return NONE
+        return self.codecs[slot]
+
+    def encode(self, tensor_list):
+        start_time = time.time()
+        header = [len(tensor_list)]
+        wire_tensors = []
+        for (slot, tensor) in enumerate(tensor_list):
+            codec = self.codec(slot, tensor)
+            assert tensor.dim() <= MAX_TENSOR_DIMS, tensor.shape
+            header.append(CODECS.index(codec))
+            header.append(DTYPES.index(tensor.dtype))
+            header.append(tensor.dim())
+            header.extend(tensor.shape)
+            header.extend([0] * (MAX_TENSOR_DIMS - tensor.dim()))
+
+            if codec == NONE:
+                wire_tensors.append(tensor)
+            elif codec in CAST_DTYPES:
+                wire_tensors.append(tensor.detach().to(CAST_DTYPES[codec]))
+            else:
+                wire_tensors.extend(self.quantize(slot, tensor.detach()))
+            self.stats['original_bytes'] += \
+                tensor.element_size() * tensor.nelement()
+
+        header = torch.tensor(header, dtype=torch.int64,
+                              device=tensor_list[0].device
+                              if len(tensor_list) > 0 else None)
+        wire_tensors.insert(0, header)
+        for tensor in wire_tensors:
+            self.stats['wire_bytes'] += tensor.element_size() * tensor.nelement()
+        self.stats['encode_time'] += time.time() - start_time
+        return wire_tensors
+
+    def decode(self, wire_tensors):
+        start_time = time.time()
+        header = wire_tensors[0].tolist()
+        tensor_list = []
+        offset = 1
+        index = 1
+        for _ in range(header[0]):
+            codec = CODECS[header[offset]]
+            dtype = DTYPES[header[offset + 1]]
+            ndims = header[offset + 2]
+            shape = header[offset + 3:offset + 3 + ndims]
+            offset += 3 + MAX_TENSOR_DIMS
+
+            if codec == NONE:
+                tensor_list.append(wire_tensors[index])
+                index += 1
+            elif codec in CAST_DTYPES:
+                tensor_list.append(wire_tensors[index].to(dtype))
+                index += 1
+            else:
+                tensor_list.append(self.dequantize(
+                    wire_tensors[index], wire_tensors[index + 1], shape,
+                    dtype))
+                index += 2
+        self.stats['decode_time'] += time.time() - start_time
+        return tensor_list
+
+    def quantize(self, slot, tensor):
+        value = tensor.float()
+        residual = self.residuals.get(slot)
+        if residual is not None and residual.shape == value.shape:
+            value = value + residual
+
+        flat = value.reshape(-1)
+        padding = (-flat.numel()) % self.block_size
+        if padding > 0:
+            flat = torch.cat([flat, flat.new_zeros(padding)])
+        blocks = flat.view(-1, self.block_size)
+        scales = blocks.abs().max(dim=1)[0] / 127.0
+        scales = torch.where(scales > 0, scales, torch.ones_like(scales))
+        quantized = torch.round(blocks / scales.unsqueeze(1)).clamp_(
+            -127, 127).to(torch.int8)
+
+        dequantized = (quantized.float() * scales.unsqueeze(1)).view(-1)
+        self.residuals[slot] = \
+            value - dequantized[:value.numel()].view(value.shape)
+        return [quantized.view(-1), scales]
+
+    def dequantize(self, quantized, scales, shape, dtype):
+        numel = 1
+        for dim in shape:
+            numel *= dim
+        blocks = quantized.float().view(scales.numel(), -1)
+        value = (blocks * scales.unsqueeze(1)).view(-1)[:numel]
+        return value.view(shape).to(dtype)
@@ -0,0 +1,290 @@
+import argparse
+import importlib
+import json
+import os
+import time
+
+import torch
+import torch.distributed as dist
+
+import mpu
+from vpipe import CPM
+from vpipe import Stage
+
+"""
+Per-block profiler of vpipe model definitions.
+
+Instantiates the blocks of a model module (model_graph.py) one at a time,
+runs each on synthetic inputs at the given batch size and sequence length,
+and writes one entry per block:
+
+  - forward_time, backward_time: seconds per pass.
+  - recompute_time: extra backward time of the block when checkpointed.
+  - optimizer_time: seconds per Adam step over the block's parameters.
+  - parameter_bytes.
+  - output_bytes: tensors a stage ending at the block sends downstream.
+  - saved_bytes: memory allocated by the forward pass and still held at its
+    end (activations saved for the backward pass, and the outputs).
+  - peak_bytes: peak memory of the forward and backward passes, above the
+    memory held before them.
+
+The profile also has the bytes of every tensor the blocks write
+(tensor_bytes), for model_graph.ModelGraph.set_tensor_bytes().
+
+Runs on CPU by default; --device cuda profiles on the current GPU. CPU
+memory comes from the autograd profiler (profile_memory), GPU memory from
+the caching allocator. The blocks are profiled without model parallelism
+(mp_size 1); pipeline_simulator.py scales the profile to the model-parallel
+size of a configuration.
+
+    python layer_profiler.py --module large_8 --batch_size 4 \
+        --seq_length 1024 --output large_8_profile.json
+"""
+
+# Inputs of the model, fed by the data loader rather than by a block.
+MODEL_INPUTS = ['out0', 'out1', 'out2']
+
+
+def synthetic_inputs(batch_size, seq_length, device):
+    """ Token ids, position ids and the causal attention mask. """
+    return {
+        'out0': torch.zeros((batch_size, seq_length), dtype=torch.long,
+                            device=device),
+        'out1': torch.arange(seq_length, dtype=torch.long, device=device)
+                     .unsqueeze(0).repeat(batch_size, 1),
+        'out2': torch.tril(torch.ones((seq_length, seq_length),
+                                      device=device)).unsqueeze(0).unsqueeze(1),
+    }
+
+
+def tensor_bytes(tensors):
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+class MemoryMeter(object):
+    """ Memory allocated while running a function: what is still held when
+    it returns, and the peak, both relative to the memory held before it.
+    """
+    def __init__(self, device):
+        self.device = device
+
+    def measure(self, fn):
+        if self.device.type == 'cuda':
+            synchronize(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+            start = torch.cuda.memory_allocated(self.device)
+            result = fn()
+            synchronize(self.device)
+            held = torch.cuda.memory_allocated(self.device) - start
+            peak = torch.cuda.max_memory_allocated(self.device) - start
+            return result, held, peak
+
+        with torch.autograd.profiler.profile(profile_memory=True) as prof:
+            result = fn()
+        # Replay the allocations and frees of every operator in order.
+        held = 0
+        peak = 0
+        for event in sorted(prof.function_events,
+                            key=lambda event: event.cpu_interval.start):
+            held += event.self_cpu_memory_usage
+            peak = max(peak, held)
+        return result, held, peak
+
+
+class BlockProfiler(object):
+    def __init__(self, args, device):
+        self.args = args
+        self.device = device
+        self.meter = MemoryMeter(device)
+
+    def stage(self, declares, calculation, inputs, outputs, fraction):
+        stage = Stage(inputs, outputs, declares, calculation, fraction)
+        stage.to(self.device)
+        if self.args.fp16:
+            stage.half()
+        return stage
+
+    def timed(self, fn):
+        synchronize(self.device)
+        start_time = time.time()
+        result = fn()
+        synchronize(self.device)
+        return result, time.time() - start_time
+
+    def run(self, stage, input_tensors):
+        """ Returns the mean forward and backward times of stage, and the
+        outputs of its last forward pass. """
+        forward_time = 0.0
+        backward_time = 0.0
+        num_iterations = self.args.num_warmup_iterations + \
+            self.args.num_iterations
+        for iteration in range(num_iterations):
+            stage.zero_grad()
+            outputs, elapsed_forward = self.timed(lambda: stage(*input_tensors))
+            _, elapsed_backward = self.timed(lambda: self.backward(outputs))
+            if iteration >= self.args.num_warmup_iterations:
+                forward_time += elapsed_forward
+                backward_time += elapsed_backward
+        return (forward_time / self.args.num_iterations,
+                backward_time / self.args.num_iterations, outputs)
+
+    def backward(self, outputs):
+        outputs = [output for output in outputs if output.requires_grad]
+        if len(outputs) > 0:
+            torch.autograd.backward(outputs,
+                                    [torch.ones_like(output) for output in outputs])
+
+    def profile(self, block_id, declares, calculation, inputs, outputs,
+                tensors):
+        input_tensors = []
+        for name in inputs:
+            tensor = tensors[name].detach()
+            if tensor.is_floating_point() and name not in MODEL_INPUTS:
+                tensor.requires_grad_()
+            input_tensors.append(tensor)
+
+        stage = self.stage(declares, calculation, inputs, outputs, [])
+        forward_time, backward_time, output_tensors = self.run(stage,
+                                                               input_tensors)
+
+        # Same block and parameters, checkpointed as vpipe.Stage does with a
+        # recompute ratio.
+        checkpointed = self.stage(declares, calculation, inputs, outputs, [1])
+        checkpointed.load_state_dict(stage.state_dict())
+        _, checkpointed_backward_time, _ = self.run(checkpointed,
+                                                    input_tensors)
+        del checkpointed
+
+        optimizer = torch.optim.Adam(stage.parameters())
+        optimizer_time = 0.0
+        if len(optimizer.param_groups[0]['params']) > 0:
+            # The first step allocates the optimizer state.
+            optimizer.step()
+            _, optimizer_time = self.timed(optimizer.step)
+        del optimizer
+
+        stage.zero_grad()
+        # Memory held between the forward and the backward pass, and the
+        # peak over both.
+        forward_outputs, saved_bytes, forward_peak = self.meter.measure(
+            lambda: stage(*input_tensors))
+        _, _, backward_peak = self.meter.measure(
+            lambda: self.backward(forward_outputs))
+        del forward_outputs
+
+        for (name, tensor) in zip(outputs, output_tensors):
+            tensors[name] = tensor.detach()
+        parameter_bytes = tensor_bytes(stage.parameters())
+        recompute_time = max(checkpointed_backward_time - backward_time, 0.0)
+        print("Block %d: forward %.4f s, backward %.4f s, recompute %.4f s, "
+              "parameters %.1f MB, saved activations %.1f MB" % (
+                  block_id, forward_time, backward_time, recompute_time,
+                  parameter_bytes / 1e6, saved_bytes / 1e6))
+        return {
+            'forward_time': forward_time,
+            'backward_time': backward_time,
+            'recompute_time': recompute_time,
+            'optimizer_time': optimizer_time,
+            'parameter_bytes': parameter_bytes,
+            'saved_bytes': saved_bytes,
+            'peak_bytes': max(forward_peak, saved_bytes + backward_peak),
+        }
+
+
+def profile_model(args, device):
+    """ Returns the profile of every block, and the bytes of every tensor
+    the blocks write. """
+    module = importlib.import_module(args.module)
+    model = CPM(module.get_declares(), module.get_caculations())
+    model.generate_layer_blocks()
+    graph = model.graph
+    num_blocks = graph.num_blocks
+
+    tensors = synthetic_inputs(args.batch_size, args.seq_length, device)
+    if args.fp16:
+        tensors['out2'] = tensors['out2'].half()
+    profiler = BlockProfiler(args, device)
+    blocks = []
+    tensor_sizes = {}
+    for block_id in range(num_blocks):
+        declares, calculation, inputs, outputs = graph.stage(block_id,
+                                                             block_id + 1)
+        block = profiler.profile(block_id, declares, calculation, inputs,
+                                 outputs, tensors)
+        for name in outputs:
+            tensor_sizes[name] = tensor_bytes([tensors[name]])
+        if block_id == num_blocks - 1:
+            # The output of the model, read by the loss.
+            sent = [graph.output]
+        else:
+            # A stage ending here sends what later blocks read, except the
+            # inputs of the model, which come from the data loader.
+            sent = graph.boundary(block_id + 1)
+            # Free the tensors no later block reads.
+            for name in list(tensors.keys()):
+                if name not in sent and name not in graph.inputs:
+                    del tensors[name]
+        block['block'] = block_id
+        block['layers'] = graph.blocks[block_id].layer_ids
+        block['output_bytes'] = sum(tensor_sizes[name] for name in sent)
+        blocks.append(block)
+    return blocks, tensor_sizes
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Profile the blocks of a vpipe model definition')
+    parser.add_argument('--module', '-m', required=True, type=str,
+                        help='model module (e.g. large_8)')
+    parser.add_argument('--batch_size', '-b', default=1, type=int,
+                        help='microbatch size')
+    parser.add_argument('--seq_length', default=696, type=int,
+                        help='sequence length')
+    parser.add_argument('--device', default='cpu', type=str,
+                        help='device to profile on (cpu, cuda, cuda:1, ...)')
+    parser.add_argument('--fp16', action='store_true',
+                        help='profile in half precision (GPU only)')
+    parser.add_argument('--num_iterations', default=5, type=int,
+                        help='timed iterations per block')
+    parser.add_argument('--num_warmup_iterations', default=2, type=int,
+                        help='untimed iterations per block')
+    parser.add_argument('--master_port', default=12355, type=int,
+                        help='port of the single-process process group')
+    parser.add_argument('--output', required=True, type=str,
+                        help='path of the JSON profile')
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    assert not args.fp16 or device.type == 'cuda', \
+        "--fp16 needs --device cuda"
+    if device.type == 'cuda':
+        torch.cuda.set_device(device)
+    # The model-parallel layers need (one-rank) process groups.
+    os.environ.setdefault('MASTER_ADDR', 'localhost')
+    os.environ.setdefault('MASTER_PORT', str(args.master_port))
+    dist.init_process_group('gloo', rank=0, world_size=1)
+    mpu.initialize_model_parallel(1, backend='gloo')
+
+    blocks, tensor_sizes = profile_model(args, device)
+    profile = {
+        'module': args.module,
+        'batch_size': args.batch_size,
+        'seq_length': args.seq_length,
+        'mp_size': 1,
+        'device': str(device),
+        'fp16': args.fp16,
+        'blocks': blocks,
+        'tensor_bytes': tensor_sizes,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(profile, f, indent=2)
+    print("Wrote the profile of %d blocks to %s" % (len(blocks), args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -32,9 +32,19 @@ import itertools
 import math
 from data_utils.tokenization_gpt2 import GPT2Tokenizer
 from mpu.cross_entropy import vocab_parallel_cross_entropy
+import model_graph
+import pipeline_config
+import shape_inference
+from vpipe import CPM
 
 sys.path.append("..")
+import communication
+import compression
+import repartition
 import runtime
+import runtime_utilities
+import schedules
+import tracing
 import lamb
 import sgd
 import adam
@@ -102,12 +112,74 @@ parser.add_argument('--num_ranks_in_server', default=1, type=int,
                     
 parser.add_argument('--cuda_sync', '-c', action='store_true',
                     help='cuda synchronize')
+parser.add_argument('--cache_tensor_shapes', action='store_true',
+                    help='negotiate inter-stage tensor shapes once per channel '
+                         'instead of sending them with every message')
+parser.add_argument('--pack_tensors', action='store_true',
+                    help='send all tensors of a microbatch as one contiguous '
+                         'buffer with a single collective')
+parser.add_argument('--recv_buffer_pool', action='store_true',
+                    help='receive inter-stage tensors into buffers recycled '
+                         'across microbatches')
+parser.add_argument('--p2p_transport', default='broadcast', type=str,
+                    choices=['broadcast', 'isend'],
+                    help='transport for inter-stage tensors: broadcasts on '
+                         'two-rank process groups, or tagged isend/irecv on '
+                         'the default group (gloo only)')
+parser.add_argument('--queue_capacity', default=None, type=int,
+                    help='maximum number of messages in each communication '
+                         'queue (default: pipeline depth of the stage, '
+                         '0: unbounded)')
+parser.add_argument('--shm_transport', action='store_true',
+                    help='exchange inter-stage tensors between ranks on the '
+                         'same server through shared memory (gloo only)')
+parser.add_argument('--compression_config', default=None, type=str,
+                    help='JSON file with per-tensor codecs for inter-stage '
+                         'activations and gradients (none|bf16|fp16|int8)')
+parser.add_argument('--comm_engine', action='store_true',
+                    help='drive all inter-stage channels from one thread with '
+                         'asynchronous collectives instead of one helper '
+                         'thread per channel (implies --pack_tensors)')
+parser.add_argument('--telemetry_freq', default=128, type=int,
+                    help='collect per-stage forward/backward times every N '
+                         'microbatches on the last stage (0: never)')
+parser.add_argument('--trace_dir', default=None, type=str,
+                    help='record compute and communication spans of every '
+                         'microbatch and write them to <trace_dir>/trace.<rank>.json')
+parser.add_argument('--derive_tensors', action='store_true',
+                    help='rebuild the position ids and the causal attention '
+                         'mask on every stage instead of sending them')
 
 # Recompute tensors from forward pass, instead of saving them.
 parser.add_argument('--recompute', action='store_true',
                     help='Recompute tensors in backward pass')
 parser.add_argument('--sync_mode', type=str, choices=['asp', 'bsp'],
                     required=True, help='synchronization mode')
+parser.add_argument('--schedule', type=str, default=None,
+                    choices=schedules.SCHEDULES,
+                    help='pipeline schedule (default: 1f1b-flush with bsp, '
+                         '1f1b with asp)')
+parser.add_argument('--microbatches_per_flush', default=32, type=int,
+                    help='microbatches between optimizer steps of the '
+                         'gpipe and 1f1b-flush schedules')
+parser.add_argument('--repartition_freq', default=0, type=int,
+                    help='check the balance of the stages every N flushes, '
+                         'and move blocks between stages if they stay '
+                         'imbalanced (0: never; gpipe and 1f1b-flush only)')
+parser.add_argument('--repartition_threshold', default=0.1, type=float,
+                    help='imbalance (slowest stage time / mean stage time - 1) '
+                         'above which stages are rebalanced')
+parser.add_argument('--repartition_patience', default=2, type=int,
+                    help='number of imbalanced checks in a row before '
+                         'rebalancing')
+parser.add_argument('--shape_cache', default=None, type=str,
+                    help='file caching the tensor shapes of a model and '
+                         'partition across launches (default: no cache)')
+parser.add_argument('--shard_local_init_seed', default=None, type=int,
+                    help='initialize the model-parallel weights from a '
+                         'counter-based RNG with this seed: every rank only '
+                         'generates its partition, and the weights are the '
+                         'same for any model-parallel size')
 # Macrobatching reduces the number of weight versions to save,
 # by not applying updates every minibatch.
 parser.add_argument('--macrobatch', action='store_true',
@@ -223,21 +295,41 @@ class CrossEntropyWrapper(nn.Module):
         loss = torch.mean(losses)
         return loss
 
-def get_shapes(args, training_tensor_shapes, dtypes, inputs_module_destinations):
-    criterion = CrossEntropyWrapper()
-    partition = json.load(open(args.partition, 'r'))
-    module = importlib.import_module(args.module)
-    model = module.model(criterion, partition["partition"], partition["recompute_ratio"])
+def causal_attention_mask(batch_size, seq_length):
+    # Same mask as CHIDDataset.collate, shared by all samples of a batch.
+    return torch.tril(torch.ones((seq_length, seq_length))).unsqueeze(0).unsqueeze(1)
 
-    for module_id, (stage, inputs, outputs) in enumerate(model[:-1]):  # Skip last layer (loss).
-        input_tensors = []
+def position_ids(batch_size, seq_length):
+    return torch.arange(seq_length, dtype=torch.long).unsqueeze(0).repeat(batch_size, 1)
+
+def stage_runtimes(r):
+    # The StageRuntime of every stage this rank runs.
+    if isinstance(r, runtime.InterleavedStageRuntime):
+        return r.chunks
+    return [r]
+
+def get_input_destinations(model, inputs_module_destinations):
+    for module_id, (_, inputs, outputs) in enumerate(model[:-1]):  # Skip last layer (loss).
         for module_input in inputs:
             if module_input in inputs_module_destinations:
                 inputs_module_destinations[module_input] = module_id
 
+def get_shapes(model, rank_modules, training_tensor_shapes, dtypes):
+    """ Shapes of the tensors of the model, from a forward pass through the
+    stages on synthetic inputs. """
+    # This rank only needs the shapes of the tensors up to its last stage.
+    # The stages of other ranks are built one at a time, and released.
+    last_module = len(model) - 2
+    if rank_modules is not None:
+        last_module = max(module_id for module_id in rank_modules
+                          if module_id < len(model) - 1)
+    for module_id, (descriptor, inputs, outputs) in enumerate(model[:last_module + 1]):
+        input_tensors = []
+        for module_input in inputs:
             input_tensor = torch.ones(tuple(training_tensor_shapes[module_input]),
                                       dtype=dtypes[module_input]).cuda()
             input_tensors.append(input_tensor)
+        stage = descriptor.build()
         stage.cuda()
         # PyTorch should not maintain metadata for a backward pass on
         # synthetic inputs. Without the following line, the runtime is
@@ -245,12 +337,133 @@ def get_shapes(args, training_tensor_shapes, dtypes, inputs_module_destinations)
         with torch.no_grad():
             output_tensors = stage(*tuple(input_tensors))
         stage.ctxs = []
+        if rank_modules is not None and module_id not in rank_modules:
+            del stage
+            descriptor.release()
         if not type(output_tensors) is tuple:
             output_tensors = [output_tensors]
         for output, output_tensor in zip(outputs,
                                          list(output_tensors)):
             training_tensor_shapes[output] = list(output_tensor.size())
             dtypes[output] = output_tensor.dtype
+        del output_tensors
+
+def infer_shapes(module, model, layers, rank_modules, mp_size, training_tensor_shapes, dtypes):
+    """ Shapes of the tensors of the model, from the shape cache, or
+    inferred from the declarations of its layers, or measured with
+    get_shapes(). """
+    # The model modules name the model inputs out0, out1 and out2 in their
+    # calculation, and input0, input1 and input2 in the runtime.
+    model_inputs = dict(("out%d" % i, "input%d" % i) for i in range(3))
+    input_shapes = dict((name, (list(training_tensor_shapes[input_name]), str(dtypes[input_name]).split('.')[-1]))
+                        for (name, input_name) in model_inputs.items())
+    declares, calculations = module.get_declares(), module.get_caculations()
+    key = shape_inference.cache_key(args.module, declares, calculations, input_shapes, layers, mp_size)
+    shape_cache = args.shape_cache
+    shapes = shape_inference.load_cached_shapes(shape_cache, key)
+    if shapes is None:
+        graph = model_graph.parse(declares, calculations)
+        shapes = shape_inference.infer_shapes(graph, input_shapes, mp_size)
+        if shapes is None:
+            get_shapes(model, rank_modules, training_tensor_shapes, dtypes)
+            shapes = dict((name, (training_tensor_shapes[name], str(dtypes[name]).split('.')[-1]))
+                          for (_, _, outputs) in model[:-1] for name in outputs
+                          if name in training_tensor_shapes)
+            # Only complete up to the last stage of this rank.
+            if rank_modules is not None:
+                return
+        shape_inference.save_cached_shapes(shape_cache, key, shapes)
+    for (name, (shape, dtype)) in shapes.items():
+        if name not in model_inputs:
+            training_tensor_shapes[name] = list(shape)
+            dtypes[name] = getattr(torch, dtype)
+
+def build_runtime(layers, recompute_ratio, runtime_class, runtime_kwargs):
+    """ Builds the model of a partition, and the runtime of this rank. """
+    training_tensor_shapes = {"input0": [1, 696], "input1": [1, 696], "input2": [1, 1, 696, 696],
+                              "target": [1, 696], "mask": [1, 696], "control":[1, 2]}
+    dtypes = {"input0": torch.int64, "input1": torch.int64,
+              "input2": torch.float32, "target": torch.int64, "mask": torch.float32, "control":torch.int}
+    inputs_module_destinations = {"input0": 0, "input1": 0, "input2": 0}
+
+    # Descriptors of the stages; only those of this rank are kept built.
+    criterion = CrossEntropyWrapper()
+    module = importlib.import_module(args.module)
+    model = module.model(criterion, layers, recompute_ratio)
+    rank_modules = pipeline_config.rank_modules(
+        runtime_kwargs['configuration_maps'], runtime_kwargs['rank'])
+    get_input_destinations(model, inputs_module_destinations)
+    infer_shapes(module, model, layers, rank_modules,
+                 runtime_kwargs['configuration_maps']['mp_size'] or 1,
+                 training_tensor_shapes, dtypes)
+
+    eval_tensor_shapes = {}
+    for key in training_tensor_shapes:
+        eval_tensor_shapes[key] = tuple(
+            training_tensor_shapes[key])
+        training_tensor_shapes[key] = tuple(
+            training_tensor_shapes[key])
+
+    r = runtime_class(
+        model=model,
+        training_tensor_shapes=training_tensor_shapes,
+        eval_tensor_shapes=eval_tensor_shapes,
+        training_tensor_dtypes=dtypes,
+        inputs_module_destinations=inputs_module_destinations,
+        **runtime_kwargs)
+
+    #######################
+    ## delete uneccessary module after forward tensor dimension profile
+    #######################
+    stages = [stage_runtime.stage for stage_runtime in stage_runtimes(r)]
+    for module_id, (stage, inputs, outputs) in enumerate(model[:-1]):  # Skip last layer (loss).
+        if module_id not in stages:
+            #print("delete stage: ", module_id)
+
+            del stage 
+            model[module_id] = None
+
+    ## empty cache
+    torch.cuda.empty_cache()
+    return r
+
+def build_optimizer(r, num_versions):
+    # TODO: make this configurable by args
+    use_adam_optimizer = True
+    if use_adam_optimizer:
+        optimizer = adam.AdamWithWeightStashing(
+            modules=r.modules(), master_parameters=r.master_parameters,
+            model_parameters=r.model_parameters, loss_scale=args.loss_scale,
+            num_versions=num_versions, lr=args.lr, betas=(0.9,0.997),
+            weight_decay=args.weight_decay, verbose_freq=args.verbose_frequency,
+            macrobatch=args.macrobatch)
+    else:
+        optimizer = sgd.SGDWithWeightStashing(
+            modules=r.modules(), master_parameters=r.master_parameters,
+            model_parameters=r.model_parameters, loss_scale=args.loss_scale,
+            num_versions=num_versions, lr=args.lr, momentum=args.momentum,
+            weight_decay=args.weight_decay, verbose_freq=args.verbose_frequency)
+    return optimizer
+
+def repartition_stage(r, optimizer, repartitioner, rebuild):
+    """ Called on every rank at a drain point: returns the runtime and
+    optimizer of this rank, rebuilt if the stages are rebalanced. """
+    layers = repartitioner.agree(r.telemetry_stats.stage_times())
+    if layers is None:
+        return r, optimizer
+    print("Repartitioning: %s -> %s" % (repartitioner.layers, layers))
+    recompute_ratio = [pipeline_config.resize_recompute_ratio(stage_recompute_ratio, num_blocks)
+                       for (stage_recompute_ratio, num_blocks) in zip(repartitioner.recompute_ratio, layers)]
+    state = repartition.parameter_state(r.modules(), optimizer.base_optimizer)
+    new_r, new_optimizer = rebuild(layers, recompute_ratio)
+    repartitioner.migrate(state, new_r.modules(), new_optimizer.base_optimizer,
+                          layers, recompute_ratio)
+    # Weight versions of the migrated parameters.
+    new_optimizer.initialize_queue()
+    new_optimizer.set_lr(optimizer.get_lr())
+    # The new runtime continues the epoch of the old one.
+    new_r.loader_iter = r.loader_iter
+    return new_r, new_optimizer
 
 def main():
     global args, best_prec1
@@ -259,64 +472,59 @@ def main():
     torch.cuda.set_device(args.local_rank)
     # os.environ["CUDA_VISIBLE_DEVICES"]=f"{args.local_rank}"
 
-    configuration_maps = {
-        'module_to_stage_map': None,
-        'stage_to_rank_map': None,
-        'stage_to_depth_map': None
-    }
-    if args.config_path is not None:
-        json_config_file = json.load(open(args.config_path, 'r'))
-        configuration_maps['module_to_stage_map'] = json_config_file.get("module_to_stage_map", None)
-        configuration_maps['stage_to_rank_map'] = json_config_file.get("stage_to_rank_map", None)
-        configuration_maps['stage_to_rank_map'] = {
-            int(k): v for (k, v) in configuration_maps['stage_to_rank_map'].items()}
-        configuration_maps['stage_to_depth_map'] = json_config_file.get("stage_to_depth_map", None)
-        configuration_maps['mp_size'] = json_config_file.get("mp_size", None)
+    configuration_maps = pipeline_config.load_configuration_maps(args.config_path)
 
     mp_size = configuration_maps['mp_size']
-    world_size = sum(len(v) for v in configuration_maps['stage_to_rank_map'].values()) * mp_size
+    # With interleaved virtual stages, ranks own several stages.
+    pipeline_ranks = pipeline_config.pipeline_ranks(configuration_maps)
+    world_size = len(pipeline_ranks) * mp_size
+    interleaved = len(configuration_maps['stage_to_rank_map']) > len(pipeline_ranks)
     # Initialize the distributed environment.
     os.environ['MASTER_ADDR'] = args.master_addr
     os.environ['MASTER_PORT'] = str(12345)
     GLOO = 'gloo'
     NCCL = 'nccl'
+    startup_timer = runtime_utilities.StartupTimer()
+    startup_timer.start('init_process_group')
     dist.init_process_group(args.distributed_backend, rank=args.rank, world_size=world_size)
+    startup_timer.stop('init_process_group')
     assert dist.get_world_size() == world_size
     print("Finished initializing process group; backend: %s, rank: %d, "
             "world_size: %d" % (GLOO, args.rank, world_size))
 
+    startup_timer.start('model-parallel groups')
     mpu.initialize_model_parallel(mp_size)
-
-    training_tensor_shapes = {"input0": [1, 696], "input1": [1, 696], "input2": [1, 1, 696, 696],
-                              "target": [1, 696], "mask": [1, 696], "control":[1, 100]}
-    dtypes = {"input0": torch.int64, "input1": torch.int64,
-              "input2": torch.float32, "target": torch.int64, "mask": torch.float32, "control":torch.int}
-    inputs_module_destinations = {"input0": 0, "input1": 0, "input2": 0}
-    target_tensor_names = {"target": torch.int64, "mask":torch.float32}
-    get_shapes(args, training_tensor_shapes, dtypes, inputs_module_destinations)
-
-    eval_tensor_shapes = {}
-    for key in training_tensor_shapes:
-        eval_tensor_shapes[key] = tuple(
-            training_tensor_shapes[key])
-        training_tensor_shapes[key] = tuple(
-            training_tensor_shapes[key])
-
-    criterion = CrossEntropyWrapper()
+    startup_timer.stop('model-parallel groups')
+    if args.shard_local_init_seed is not None:
+        mpu.set_shard_local_init(args.shard_local_init_seed)
+
+    tracer = None
+    if args.trace_dir is not None:
+        # All ranks leave the barrier at about the same time, which anchors
+        # their clocks when traces are merged.
+        tracer = tracing.Tracer(args.rank, stage=None)
+        dist.barrier()
+        tracer.set_anchor()
 
     # create stages of the model
-    partition = json.load(open(args.partition, 'r'))
-    module = importlib.import_module(args.module)
-    model = module.model(criterion, partition["partition"], partition["recompute_ratio"])
-
-    r = runtime.StageRuntime(
-        model=model, distributed_backend=args.distributed_backend,
+    layers, recompute_ratio = pipeline_config.load_partition(args.partition)
+
+    compression_config = None
+    if args.compression_config is not None:
+        compression_config = compression.load_config(args.compression_config)
+
+    derived_tensors = None
+    if args.derive_tensors:
+        derived_tensors = {"input1": position_ids,
+                           "input2": causal_attention_mask}
+
+    runtime_class = runtime.StageRuntime
+    if interleaved:
+        runtime_class = runtime.InterleavedStageRuntime
+    runtime_kwargs = dict(
+        distributed_backend=args.distributed_backend,
         fp16=args.fp16, loss_scale=args.loss_scale,
-        training_tensor_shapes=training_tensor_shapes,
-        eval_tensor_shapes=eval_tensor_shapes,
-        training_tensor_dtypes=dtypes,
-        inputs_module_destinations=inputs_module_destinations,
-        target_tensor_names=target_tensor_names,
+        target_tensor_names={"target": torch.int64, "mask":torch.float32},
         configuration_maps=configuration_maps,
         master_addr=args.master_addr,
         rank=args.rank, local_rank=args.local_rank,
@@ -324,21 +532,32 @@ def main():
         verbose_freq=args.verbose_frequency,
         model_type=runtime.CPM,
         enable_recompute=args.recompute,
-        cuda_sync=args.cuda_sync)
-
-
-    #######################
-    ## delete uneccessary module after forward tensor dimension profile
-    #######################
-    for module_id, (stage, inputs, outputs) in enumerate(model[:-1]):  # Skip last layer (loss).
-        if module_id != r.stage:
-            #print("delete stage: ", module_id)
-
-            del stage 
-            model[module_id] = None
-
-    ## empty cache
-    torch.cuda.empty_cache()
+        cuda_sync=args.cuda_sync,
+        cache_tensor_shapes=args.cache_tensor_shapes,
+        pack_tensors=args.pack_tensors,
+        recv_buffer_pool=args.recv_buffer_pool,
+        p2p_transport=args.p2p_transport,
+        queue_capacity=args.queue_capacity,
+        shm_transport=args.shm_transport,
+        compression_config=compression_config,
+        startup_timer=startup_timer,
+        derived_tensors=derived_tensors,
+        tracer=tracer,
+        telemetry_freq=args.telemetry_freq,
+        comm_engine=args.comm_engine)
+    link_process_groups = None
+    if args.repartition_freq > 0:
+        assert not interleaved and not args.fp16, \
+            "--repartition_freq doesn't support interleaved stages or --fp16"
+        assert args.telemetry_freq > 0, \
+            "--repartition_freq needs the stage times of --telemetry_freq"
+        # Rebuilt runtimes keep the groups of the links.
+        link_process_groups = communication.create_link_process_groups(
+            runtime.pipeline_links(configuration_maps['stage_to_rank_map'],
+                                   mp_size), args.rank)
+        runtime_kwargs['link_process_groups'] = link_process_groups
+    r = build_runtime(layers, recompute_ratio, runtime_class, runtime_kwargs)
+    startup_timer.print_stats()
 
 
 
@@ -347,6 +566,8 @@ def main():
     # num_stages needed to determine if current stage is the last stage
     # num_ranks needed to determine number of warmup_minibatches in case of pipelining
     args.stage = r.stage
+    if tracer is not None:
+        tracer.stage = r.stage
     args.num_stages = r.num_stages
     args.num_ranks = r.num_ranks
     if not is_first_stage():
@@ -368,21 +589,24 @@ def main():
         print("=> loaded checkpoint '{}' (epoch {})"
                 .format(checkpoint_file_path, checkpoint['epoch']))
 
-    # TODO: make this configurable by args
-    use_adam_optimizer = True
-    if use_adam_optimizer:
-        optimizer = adam.AdamWithWeightStashing(
-            modules=r.modules(), master_parameters=r.master_parameters,
-            model_parameters=r.model_parameters, loss_scale=args.loss_scale,
-            num_versions=num_versions, lr=args.lr, betas=(0.9,0.997),
-            weight_decay=args.weight_decay, verbose_freq=args.verbose_frequency,
-            macrobatch=args.macrobatch)
-    else:
-        optimizer = sgd.SGDWithWeightStashing(
-            modules=r.modules(), master_parameters=r.master_parameters,
-            model_parameters=r.model_parameters, loss_scale=args.loss_scale,
-            num_versions=num_versions, lr=args.lr, momentum=args.momentum,
-            weight_decay=args.weight_decay, verbose_freq=args.verbose_frequency)
+    optimizer = build_optimizer(r, num_versions)
+
+    repartitioner = None
+    if args.repartition_freq > 0:
+        module = importlib.import_module(args.module)
+        cpm = CPM(module.get_declares(), module.get_caculations())
+        cpm.generate_layer_blocks()
+        repartitioner = repartition.Repartitioner(
+            layers, recompute_ratio, cpm.block_layers(),
+            configuration_maps['stage_to_rank_map'], mp_size, args.rank,
+            link_process_groups, args.repartition_threshold,
+            args.repartition_patience)
+
+    def rebuild(layers, recompute_ratio):
+        # Runtime and optimizer of this rank for a new partition.
+        new_r = build_runtime(layers, recompute_ratio, runtime_class,
+                              dict(runtime_kwargs, startup_timer=None))
+        return new_r, build_optimizer(new_r, num_versions)
 
     if args.resume:
         optimizer.load_state_dict(checkpoint['optimizer'])
@@ -416,7 +640,8 @@ def main():
         if args.forward_only:
             validate(val_loader, r, epoch)
         else:
-            train(train_loader, r, optimizer, epoch)
+            r, optimizer = train(train_loader, r, optimizer, epoch,
+                                 repartitioner=repartitioner, rebuild=rebuild)
 
             # evaluate on validation set
             # prec1 = validate(val_loader, r, epoch)
@@ -434,9 +659,17 @@ def main():
                     'best_prec1': best_prec1,
                     'optimizer' : optimizer.state_dict()
                 }, args.checkpoint_dir, r.stage, epoch)
+                if repartitioner is not None and is_first_stage():
+                    # Resuming needs the partition the checkpoint was
+                    # saved with.
+                    pipeline_config.save_partition(
+                        os.path.join(args.checkpoint_dir, "partition.%d.json" % epoch),
+                        repartitioner.layers, repartitioner.recompute_ratio)
 
 
-def train(train_loader, r, optimizer, epoch):
+def train(train_loader, r, optimizer, epoch, repartitioner=None, rebuild=None):
+    """ Trains for an epoch; returns the runtime and optimizer, which
+    change if the stages were repartitioned. """
     batch_time = AverageMeter()
     losses = AverageMeter()
     top1 = AverageMeter()
@@ -446,6 +679,9 @@ def train(train_loader, r, optimizer, epoch):
     n = r.num_iterations(loader_size=len(train_loader))
     if args.num_minibatches is not None:
         n = min(n, args.num_minibatches)
+    if repartitioner is not None:
+        # Every stage drains at the same points.
+        n = min(n, len(train_loader) - 1)
 
     if not is_first_stage(): train_loader = None
     r.set_loader(train_loader)
@@ -459,111 +695,157 @@ def train(train_loader, r, optimizer, epoch):
     epoch_start_time = 0
     batch_start_time = 0
 
-    def pipelining(steps, print_freq, weight_stash=False):
-        nonlocal s, epoch_start_time, batch_start_time
-        # start num_warmup_minibatches forward passes
-        for i in range(num_warmup_minibatches):
-            r.run_forward()
-
-        for i in range(steps - num_warmup_minibatches):
-            s += 1
-            
-            # perform forward pass
-            r.run_forward()
-
-            if is_last_stage():
-                # measure accuracy and record loss
-                output, target, loss = r.output, r.target, r.loss.item()
-                losses.update(loss)
-
-                if s == warmup_steps:
-                    epoch_start_time = time.time()
-                    batch_start_time = time.time()
+    def optimizer_step(step):
+        start_time = time.time()
+        step()
+        if r.tracer is not None:
+            r.tracer.add_span("optimizer", "compute", start_time, time.time())
 
-                if s % print_freq == 0 and s > warmup_steps:
-                    # measure elapsed time
-                    batch_time.update((time.time() - batch_start_time)/print_freq)
-                    trans_time = ((time.time() - batch_start_time) / (print_freq *3600.0)) * float(n)
-
-                    batch_start_time = time.time()
-                    epoch_time = (time.time() - epoch_start_time) / 3600.0
-                    full_epoch_time = (epoch_time / float(s-warmup_steps)) * float(n)
+    def print_progress():
+        nonlocal s, epoch_start_time, batch_start_time
+        s += 1
+        if is_last_stage():
+            # measure accuracy and record loss
+            output, target, loss = r.output, r.target, r.loss.item()
+            losses.update(loss)
 
-                    print('Stage: [{0}] Epoch: [{1}][{2}/{3}]\t'
-                          'Time: {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
-                          'Epoch time [hr]: {epoch_time:.3f} ({full_epoch_time:.3f})\t'
-                          'Memory: {memory:.3f} ({cached_memory:.3f})\t'
-                          'Loss: {loss.val:.4f} ({loss.avg:.4f})\t'
-                          'Transient TP: {trans_time:.3f}'.format(
-                          args.stage, epoch, s, n, batch_time=batch_time,
-                          epoch_time=epoch_time, full_epoch_time=full_epoch_time,
-                          trans_time=trans_time,
-                          loss=losses, # top1=top1, top5=top5,
-                          memory=(float(torch.cuda.memory_allocated()) / 10**9),
-                          cached_memory=(float(torch.cuda.memory_cached()) / 10**9)))
-                    import sys; sys.stdout.flush()
-            else:
-                if s % print_freq == 0 and s > warmup_steps:
-                    print('Stage: [{0}] Epoch: [{1}][{2}/{3}]\tMemory: {memory:.3f} ({cached_memory:.3f})'.format(
-                          args.stage, epoch, s, n, memory=(float(torch.cuda.memory_allocated()) / 10**9),
-                          cached_memory=(float(torch.cuda.memory_cached()) / 10**9)))
-                    import sys; sys.stdout.flush()
+            if s == warmup_steps:
+                epoch_start_time = time.time()
+                batch_start_time = time.time()
 
-            # perform backward pass
-            if not weight_stash:
-                r.run_backward()
-            else:
-                if args.fp16:
-                    r.zero_grad()
-                else:
-                    optimizer.zero_grad()
-                optimizer.load_old_params()
-                r.run_backward()
-                optimizer.load_new_params()
-                optimizer.step()
-
-        # finish remaining backward passes
-        for i in range(num_warmup_minibatches):
-            s += 1
-            if not weight_stash:
-                r.run_backward()
-            else:
-                if args.fp16:
-                    r.zero_grad()
-                else:
-                    optimizer.zero_grad()
-                optimizer.load_old_params()
-                r.run_backward()
-                optimizer.load_new_params()
-                optimizer.step()
-
-        if not weight_stash:
-            optimizer.base_optimizer.step()
-            if args.fp16:
-                r.zero_grad()
-            else:
-                optimizer.zero_grad()
-
-    if args.sync_mode == BSP:
-        accumulation_steps = 32
-        n -= (n % accumulation_steps)
-        r.train(n)
-        r.set_loss_scale(4 / accumulation_steps)
-        print_freq = (args.print_freq // accumulation_steps) * accumulation_steps
+            if s % print_freq == 0 and s > warmup_steps:
+                # measure elapsed time
+                batch_time.update((time.time() - batch_start_time)/print_freq)
+                trans_time = ((time.time() - batch_start_time) / (print_freq *3600.0)) * float(n)
+
+                batch_start_time = time.time()
+                epoch_time = (time.time() - epoch_start_time) / 3600.0
+                full_epoch_time = (epoch_time / float(s-warmup_steps)) * float(n)
+
+                print('Stage: [{0}] Epoch: [{1}][{2}/{3}]\t'
+                      'Time: {batch_time.val:.3f} ({batch_time.avg:.3f})\t'
+                      'Epoch time [hr]: {epoch_time:.3f} ({full_epoch_time:.3f})\t'
+                      'Memory: {memory:.3f} ({cached_memory:.3f})\t'
+                      'Loss: {loss.val:.4f} ({loss.avg:.4f})\t'
+                      'Transient TP: {trans_time:.3f}'.format(
+                      args.stage, epoch, s, n, batch_time=batch_time,
+                      epoch_time=epoch_time, full_epoch_time=full_epoch_time,
+                      trans_time=trans_time,
+                      loss=losses, # top1=top1, top5=top5,
+                      memory=(float(torch.cuda.memory_allocated()) / 10**9),
+                      cached_memory=(float(torch.cuda.memory_cached()) / 10**9)))
+                import sys; sys.stdout.flush()
+        else:
+            if s % print_freq == 0 and s > warmup_steps:
+                print('Stage: [{0}] Epoch: [{1}][{2}/{3}]\tMemory: {memory:.3f} ({cached_memory:.3f})'.format(
+                      args.stage, epoch, s, n, memory=(float(torch.cuda.memory_allocated()) / 10**9),
+                      cached_memory=(float(torch.cuda.memory_cached()) / 10**9)))
+                import sys; sys.stdout.flush()
+
+    def zero_grad():
+        if args.fp16:
+            r.zero_grad()
+        else:
+            optimizer.zero_grad()
+
+    def stashed_backward():
+        # The backward pass of a microbatch uses the weights of its forward
+        # pass.
+        zero_grad()
+        optimizer.load_old_params()
+        r.run_backward()
+        optimizer.load_new_params()
+
+    def flush_step():
+        optimizer_step(optimizer.base_optimizer.step)
+        zero_grad()
+
+    schedule_name = args.schedule
+    if schedule_name is None:
+        schedule_name = schedules.ONE_F_ONE_B_FLUSH if args.sync_mode == BSP \
+            else schedules.ONE_F_ONE_B
+    if schedule_name == schedules.ONE_F_ONE_B:
+        assert repartitioner is None, \
+            "--repartition_freq needs a schedule with flushes"
+        schedule = schedules.get_schedule(schedule_name, n,
+                                          num_warmup_minibatches,
+                                          num_chunks=r.num_chunks)
+        r.train(n, schedule=schedule)
+        print_freq = args.print_freq
         warmup_steps = 5*print_freq
-        for t in range(n // accumulation_steps):
-            pipelining(accumulation_steps, print_freq)
+        r.run_schedule(schedule, lambda: optimizer_step(optimizer.step),
+                       backward=stashed_backward, forward_hook=print_progress)
     else:
-        r.train(n)
-        warmup_steps = 5*args.print_freq
-        pipelining(n, args.print_freq, weight_stash=True)
-
+        microbatches_per_flush = args.microbatches_per_flush
+        n -= (n % microbatches_per_flush)
+        print_freq = (args.print_freq // microbatches_per_flush) * microbatches_per_flush
+        warmup_steps = 5*print_freq
+        # With repartitioning, the epoch runs in segments of
+        # repartition_freq flushes; the pipeline drains between segments.
+        segment_size = n
+        if repartitioner is not None:
+            segment_size = args.repartition_freq * microbatches_per_flush
+        done = 0
+        while done < n:
+            num_microbatches = min(segment_size, n - done)
+            schedule = schedules.get_schedule(schedule_name, num_microbatches,
+                                              num_warmup_minibatches,
+                                              microbatches_per_flush,
+                                              num_chunks=r.num_chunks,
+                                              num_stages=r.num_stages)
+            r.train(num_microbatches, schedule=schedule)
+            r.set_loss_scale(4 / microbatches_per_flush)
+            r.run_schedule(schedule, flush_step, forward_hook=print_progress)
+            done += num_microbatches
+            if repartitioner is not None and done < n:
+                r.wait()
+                r, optimizer = repartition_stage(r, optimizer, repartitioner,
+                                                 rebuild)
 
     # wait for all helper threads to complete
     r.wait()
 
+    if r.tracer is not None:
+        r.tracer.save(args.trace_dir)
+    if is_last_stage() and args.telemetry_freq > 0:
+        r.telemetry_stats.print_stats()
+
+    for stage_runtime in stage_runtimes(r):
+        comm_handler = stage_runtime.comm_handler
+        if args.cache_tensor_shapes and comm_handler is not None:
+            handshake_stats = comm_handler.handshake_stats()
+            print("Shape handshakes: %d performed, %d skipped" % (
+                handshake_stats['performed'], handshake_stats['skipped']))
+        if comm_handler is not None:
+            buffer_pool_stats = comm_handler.buffer_pool_stats()
+            print("Receive buffers: %d allocated, %d reused" % (
+                buffer_pool_stats['allocated'], buffer_pool_stats['reused']))
+            if args.compression_config is not None:
+                compression_stats = comm_handler.compression_stats()
+                print("Compression: %d bytes saved, %.3f seconds encoding, "
+                      "%.3f seconds decoding" % (
+                          compression_stats['bytes_saved'],
+                          compression_stats['encode_time'],
+                          compression_stats['decode_time']))
+            if args.verbose_frequency > 0:
+                queue_stats = comm_handler.queue_stats()
+                for name in sorted(queue_stats):
+                    print("Queue %s: depth %d, high-water mark %d, "
+                          "add wait %.3f seconds, remove wait %.3f seconds" % (
+                              name, queue_stats[name]['depth'],
+                              queue_stats[name]['high_water_mark'],
+                              queue_stats[name]['add_wait_time'],
+                              queue_stats[name]['remove_wait_time']))
+                if comm_handler.comm_engine is not None:
+                    engine_stats = comm_handler.comm_engine.stats()
+                    for name in sorted(engine_stats):
+                        print("Channel %s: %d messages, at most %d in flight" % (
+                            name, engine_stats[name]['messages'],
+                            engine_stats[name]['max_in_flight']))
+
     print("Epoch %d: %.3f seconds" % (epoch, time.time() - epoch_start_time))
     print("Epoch start time: %.3f, epoch end time: %.3f" % (epoch_start_time, time.time()))
+    return r, optimizer
 
 
 def validate(val_loader, r, epoch):
@@ -584,6 +866,10 @@ def validate(val_loader, r, epoch):
     epoch_start_time = time.time()
 
     num_warmup_minibatches = r.num_warmup_minibatches
+    if isinstance(r, runtime.InterleavedStageRuntime):
+        # Chunks wait for acks from the chunks after them on other ranks,
+        # so microbatches are acked one at a time.
+        num_warmup_minibatches = 0
 
     with torch.no_grad():
         for i in range(num_warmup_minibatches):
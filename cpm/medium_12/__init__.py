@@ -1,6 +1,6 @@
 import sys
 sys.path.append("..")
-from vpipe import Stage
+from vpipe import StageDescriptor
 from vpipe import CPM
 
 def model(criterion, partition, recompute_ratio):
@@ -33,18 +33,18 @@ def model(criterion, partition, recompute_ratio):
         outputs.insert(0, previous_output)
 
     return [
-        (Stage(inputs[0], outputs[0], declares[0], calculations[0], recompute_ratio[0]), replace(inputs[0]), outputs[0]),
-        (Stage(inputs[1], outputs[1], declares[1], calculations[1], recompute_ratio[1]), replace(inputs[1]), outputs[1]),
-        (Stage(inputs[2], outputs[2], declares[2], calculations[2], recompute_ratio[2]), replace(inputs[2]), outputs[2]),
-        (Stage(inputs[3], outputs[3], declares[3], calculations[3], recompute_ratio[3]), replace(inputs[3]), outputs[3]),
-        (Stage(inputs[4], outputs[4], declares[4], calculations[4], recompute_ratio[4]), replace(inputs[4]), outputs[4]),
-        (Stage(inputs[5], outputs[5], declares[5], calculations[5], recompute_ratio[5]), replace(inputs[5]), outputs[5]),
-        (Stage(inputs[6], outputs[6], declares[6], calculations[6], recompute_ratio[6]), replace(inputs[6]), outputs[6]),
-        (Stage(inputs[7], outputs[7], declares[7], calculations[7], recompute_ratio[7]), replace(inputs[7]), outputs[7]),
-        (Stage(inputs[8], outputs[8], declares[8], calculations[8], recompute_ratio[8]), replace(inputs[8]), outputs[8]),
-        (Stage(inputs[9], outputs[9], declares[9], calculations[9], recompute_ratio[9]), replace(inputs[9]), outputs[9]),
-        (Stage(inputs[10], outputs[10], declares[10], calculations[10], recompute_ratio[10]), replace(inputs[10]), outputs[10]),
-        (Stage(inputs[11], outputs[11], declares[11], calculations[11], recompute_ratio[11]), replace(inputs[11]), outputs[11]),
+        (StageDescriptor(inputs[0], outputs[0], declares[0], calculations[0], recompute_ratio[0]), replace(inputs[0]), outputs[0]),
+        (StageDescriptor(inputs[1], outputs[1], declares[1], calculations[1], recompute_ratio[1]), replace(inputs[1]), outputs[1]),
+        (StageDescriptor(inputs[2], outputs[2], declares[2], calculations[2], recompute_ratio[2]), replace(inputs[2]), outputs[2]),
+        (StageDescriptor(inputs[3], outputs[3], declares[3], calculations[3], recompute_ratio[3]), replace(inputs[3]), outputs[3]),
+        (StageDescriptor(inputs[4], outputs[4], declares[4], calculations[4], recompute_ratio[4]), replace(inputs[4]), outputs[4]),
+        (StageDescriptor(inputs[5], outputs[5], declares[5], calculations[5], recompute_ratio[5]), replace(inputs[5]), outputs[5]),
+        (StageDescriptor(inputs[6], outputs[6], declares[6], calculations[6], recompute_ratio[6]), replace(inputs[6]), outputs[6]),
+        (StageDescriptor(inputs[7], outputs[7], declares[7], calculations[7], recompute_ratio[7]), replace(inputs[7]), outputs[7]),
+        (StageDescriptor(inputs[8], outputs[8], declares[8], calculations[8], recompute_ratio[8]), replace(inputs[8]), outputs[8]),
+        (StageDescriptor(inputs[9], outputs[9], declares[9], calculations[9], recompute_ratio[9]), replace(inputs[9]), outputs[9]),
+        (StageDescriptor(inputs[10], outputs[10], declares[10], calculations[10], recompute_ratio[10]), replace(inputs[10]), outputs[10]),
+        (StageDescriptor(inputs[11], outputs[11], declares[11], calculations[11], recompute_ratio[11]), replace(inputs[11]), outputs[11]),
         (criterion, outputs[11], ["loss"])
     ]
 
@@ -1,6 +1,6 @@
 import sys
 sys.path.append("..")
-from vpipe import Stage
+from vpipe import StageDescriptor
 from vpipe import CPM
 
 def model(criterion, partition, recompute_ratio):
@@ -33,9 +33,9 @@ def model(criterion, partition, recompute_ratio):
         outputs.insert(0, previous_output)
 
     return [
-        (Stage(inputs[0], outputs[0], declares[0], calculations[0], recompute_ratio[0]), replace(inputs[0]), outputs[0]),
-        (Stage(inputs[1], outputs[1], declares[1], calculations[1], recompute_ratio[1]), replace(inputs[1]), outputs[1]),
-        (Stage(inputs[2], outputs[2], declares[2], calculations[2], recompute_ratio[2]), replace(inputs[2]), outputs[2]),
+        (StageDescriptor(inputs[0], outputs[0], declares[0], calculations[0], recompute_ratio[0]), replace(inputs[0]), outputs[0]),
+        (StageDescriptor(inputs[1], outputs[1], declares[1], calculations[1], recompute_ratio[1]), replace(inputs[1]), outputs[1]),
+        (StageDescriptor(inputs[2], outputs[2], declares[2], calculations[2], recompute_ratio[2]), replace(inputs[2]), outputs[2]),
         (criterion, outputs[2], ["loss"])
     ]
 
@@ -0,0 +1,143 @@
+import itertools
+import re
+
+"""
+Dataflow graph of a vpipe model definition.
+
+A model module declares its layers ("self.layer11 = ...", one per line) and
+its calculation ("out11 = self.layer11(out10, out2)", one per line) as
+strings. parse() reads them once into a ModelGraph: one Node per
+calculation line, with the tensors it reads and writes, split into blocks
+after every residual connection (lines with a '+'), which are the units of
+a partition. The tensors every block reads from earlier blocks and writes
+are computed once too, so that the declarations, inputs and outputs of a
+stage, or the tensors crossing a stage boundary, take one pass over the
+interfaces of its blocks instead of regex scans of its lines.
+
+Doesn't depend on torch, so that offline tools can use it.
+"""
+
+TENSOR = re.compile(r'out\d+')
+LAYER = re.compile(r'self.layer([0-9]+)')
+
+
+class Node(object):
+    """ One line of the calculation: target = f(sources). """
+    def __init__(self, line):
+        self.line = line
+        names = TENSOR.findall(line)
+        self.target = names[0]
+        self.sources = names[1:]
+        m = LAYER.search(line)
+        self.layer_id = int(m.group(1)) if m is not None else None
+
+
+class Block(object):
+    """ Consecutive nodes, and their interface: the tensors they read before
+    writing them, the tensors they write, and their layers, in order. """
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.reads = []
+        self.writes = []
+        for node in nodes:
+            for name in node.sources:
+                if name not in self.writes and name not in self.reads:
+                    self.reads.append(name)
+            if node.target not in self.writes:
+                self.writes.append(node.target)
+        self.layer_ids = [node.layer_id for node in nodes
+                          if node.layer_id is not None]
+
+
+class ModelGraph(object):
+    def __init__(self, layers, blocks):
+        # Declaration line of every layer id.
+        self.layers = layers
+        self.blocks = blocks
+        self.num_blocks = len(blocks)
+
+        # Inputs of the model (fed by the data loader), and the first block
+        # writing and last block reading every tensor.
+        self.inputs = []
+        self.first_write = {}
+        self.last_read = {}
+        for (block_id, block) in enumerate(blocks):
+            for name in block.reads:
+                if name not in self.first_write and name not in self.inputs:
+                    self.inputs.append(name)
+                self.last_read[name] = block_id
+            for name in block.writes:
+                self.first_write.setdefault(name, block_id)
+        # Tensor the last line writes: the output of the model.
+        nodes = [node for block in blocks for node in block.nodes]
+        self.output = nodes[-1].target if len(nodes) > 0 else None
+        # Bytes of every tensor, if known (set_tensor_bytes()).
+        self.tensor_bytes = {}
+
+    def block_lines(self):
+        return [[node.line for node in block.nodes] for block in self.blocks]
+
+    def stage(self, start, end):
+        """ Returns the declarations, calculation (lines of every block),
+        inputs and outputs of the stage running blocks [start, end), as
+        vpipe.CPM.generate_stage does. """
+        declares = []
+        calculation = []
+        inputs = []
+        outputs = []
+        written = set()
+        read = set()
+        for block in self.blocks[start:end]:
+            calculation.append([node.line for node in block.nodes])
+            declares.extend(self.layers[layer_id]
+                            for layer_id in block.layer_ids)
+            for name in block.reads:
+                if name not in written and name not in read:
+                    inputs.append(name)
+                    read.add(name)
+            for name in block.writes:
+                if name not in written:
+                    outputs.append(name)
+                    written.add(name)
+        return declares, calculation, inputs, outputs
+
+    def boundary(self, block_id):
+        """ Tensors written before block block_id and read from it on: what a
+        stage ending before block_id sends downstream, besides the inputs of
+        the model. """
+        return [name for (name, first_write) in self.first_write.items()
+                if first_write < block_id and
+                self.last_read.get(name, -1) >= block_id]
+
+    def set_tensor_bytes(self, tensor_bytes):
+        """ Sizes of the tensors, e.g. the tensor_bytes of a profile
+        (layer_profiler.py). """
+        self.tensor_bytes = dict(tensor_bytes)
+
+    def boundary_bytes(self, block_id):
+        return sum(self.tensor_bytes[name]
+                   for name in self.boundary(block_id))
+
+    def partitions(self, num_stages):
+        """ Yields the number of blocks of every stage of every partition of
+        the model into num_stages contiguous, non-empty stages. """
+        for cuts in itertools.combinations(range(1, self.num_blocks),
+                                           num_stages - 1):
+            bounds = (0,) + cuts + (self.num_blocks,)
+            yield [bounds[i + 1] - bounds[i] for i in range(num_stages)]
+
+
+def parse(declares, calculations):
+    """ Returns the ModelGraph of the declaration and calculation strings of
+    a model module. """
+    layers = {}
+    for line in declares.split('\n'):
+        m = LAYER.search(line)
+        layers[int(m.group(1))] = line
+
+    blocks = [[]]
+    for line in calculations.split('\n'):
+        blocks[-1].append(Node(line))
+        if '+' in line:
+            blocks.append([])
+    return ModelGraph(layers, [Block(nodes) for nodes in blocks])
@@ -30,8 +30,10 @@ from .initialize import initialize_model_parallel
 from .initialize import model_parallel_is_initialized
 
 from .layers import ColumnParallelLinear
+from .layers import initialization_scope
 from .layers import ParallelEmbedding
 from .layers import RowParallelLinear
+from .layers import set_shard_local_init
 from .layers import VocabParallelEmbedding
 
 from .mappings import copy_to_model_parallel_region
@@ -27,8 +27,8 @@ _MODEL_PARALLEL_GROUP = None
 _DATA_PARALLEL_GROUP = None
 
 
-def initialize_model_parallel(mp_size):
-    # Build the model parallel groups.
+def initialize_model_parallel(mp_size, backend="nccl"):
+    # Build the model parallel groups (gloo groups to run on CPU).
     global _MODEL_PARALLEL_GROUP
     assert _MODEL_PARALLEL_GROUP is None, \
         'model parallel group is already initialized'
@@ -36,7 +36,7 @@ def initialize_model_parallel(mp_size):
     rank = torch.distributed.get_rank()
     for i in range(world_size // mp_size):
         ranks = range(i * mp_size, (i + 1) * mp_size)
-        group = torch.distributed.new_group(ranks, backend="nccl")
+        group = torch.distributed.new_group(ranks, backend=backend)
         if i == (rank // mp_size):
             print("MP Group", list(ranks))
             _MODEL_PARALLEL_GROUP = group
@@ -18,6 +18,8 @@
 # repo: https://github.com/pytorch/pytorch
 
 
+import contextlib
+import hashlib
 import math
 
 import torch
@@ -35,17 +37,138 @@ from .utils import divide
 from .utils import VocabUtility
 
 
+# Seed of the counter-based initialization of the parallel weights, or None
+# (set_shard_local_init()).
+_SHARD_LOCAL_INIT_SEED = None
+# Name of the weights being initialized (initialization_scope()), and the
+# number of weights initialized in it so far.
+_INIT_SCOPE = ''
+_INIT_SCOPE_COUNT = 0
+# Elements generated at a time by the counter-based initialization.
+_SHARD_INIT_CHUNK_SIZE = 1 << 22
+
+# splitmix64 constants, as signed 64-bit integers.
+_GOLDEN_GAMMA = 0x9E3779B97F4A7C15 - (1 << 64)
+_MIX_MULTIPLIER_1 = 0xBF58476D1CE4E5B9 - (1 << 64)
+_MIX_MULTIPLIER_2 = 0x94D049BB133111EB - (1 << 64)
+
+
+def set_shard_local_init(seed):
+    """Initialize the weights of the parallel layers from a counter-based
+    RNG keyed by seed, or as usual if seed is None.
+
+    Element i (row-major) of the full weight is then a function of the seed,
+    the name of the weight (initialization_scope()) and i only. Each
+    model-parallel rank generates only its partition, and the weights are
+    bitwise the same for any model-parallel size."""
+    global _SHARD_LOCAL_INIT_SEED
+    _SHARD_LOCAL_INIT_SEED = seed
+
+
+@contextlib.contextmanager
+def initialization_scope(name):
+    """Names the weights initialized inside: the n-th parallel weight
+    initialized in the scope gets the random stream (seed, name, n)."""
+    global _INIT_SCOPE, _INIT_SCOPE_COUNT
+    previous_scope = (_INIT_SCOPE, _INIT_SCOPE_COUNT)
+    _INIT_SCOPE, _INIT_SCOPE_COUNT = name, 0
+    try:
+        yield
+    finally:
+        _INIT_SCOPE, _INIT_SCOPE_COUNT = previous_scope
+
+
+def _next_init_key():
+    global _INIT_SCOPE_COUNT
+    digest = hashlib.sha1(('%d/%s/%d' % (
+        _SHARD_LOCAL_INIT_SEED, _INIT_SCOPE,
+        _INIT_SCOPE_COUNT)).encode('utf-8')).digest()
+    _INIT_SCOPE_COUNT += 1
+    return int.from_bytes(digest[:8], 'little') & ((1 << 63) - 1)
+
+
+def _init_std(init_method, output_size, input_size):
+    """Standard deviation of the zero-mean normal init_method draws a
+    (output_size, input_size) weight from, or None if unknown."""
+    if init_method is init.xavier_normal_:
+        return math.sqrt(2.0 / float(input_size + output_size))
+    return getattr(init_method, 'std', None)
+
+
+def _shift_right(x, bits):
+    # Logical shift of int64 tensors.
+    return (x >> bits) & ((1 << (64 - bits)) - 1)
+
+
+def _counter_normal(key, offsets):
+    """Standard normal samples, each a function of key and its offset only.
+
+    splitmix64 hashes key and the offsets into 52 random bits, mapped
+    exactly to (-1, 1); erfinv maps them to normal samples. Every step is
+    elementwise, so the value of an offset doesn't depend on the other
+    offsets generated with it."""
+    z = offsets * _GOLDEN_GAMMA + key
+    z = (z ^ _shift_right(z, 30)) * _MIX_MULTIPLIER_1
+    z = (z ^ _shift_right(z, 27)) * _MIX_MULTIPLIER_2
+    z = z ^ _shift_right(z, 31)
+    uniform = (_shift_right(z, 12) * 2 + 1 - (1 << 52)).double() * 2.0 ** -52
+    return torch.erfinv(uniform) * math.sqrt(2.0)
+
+
+def _counter_init(tensor, input_size, rows, columns, std, key):
+    """Fills tensor with the rows and columns of the counter-based
+    N(0, std) initialization of a weight with input_size columns."""
+    rows_per_chunk = max(1, _SHARD_INIT_CHUNK_SIZE // len(columns))
+    with torch.no_grad():
+        for start in range(0, len(rows), rows_per_chunk):
+            chunk_rows = rows[start:start + rows_per_chunk]
+            offsets = chunk_rows.unsqueeze(1) * input_size + \
+                columns.unsqueeze(0)
+            tensor[start:start + len(chunk_rows)].copy_(
+                _counter_normal(key, offsets) * std)
+
+
 def _initialize_affine_weight(weight, output_size, input_size,
                               per_partition_size, partition_dim, init_method,
                               stride=1, return_master_weight=False):
     """Initialize affine weight for model parallel.
 
     Build the master weight on all processes and scatter
-    the relevant chunk."""
-    # If we only use 1 process for model parallelism, bypass scatter.
+    the relevant chunk. With set_shard_local_init(), only the relevant
+    chunk is generated."""
     world_size = get_model_parallel_world_size()
+    rank = get_model_parallel_rank()
+    per_partition_per_stride_size = divide(per_partition_size, stride)
+
+    key = None
+    if _SHARD_LOCAL_INIT_SEED is not None:
+        std = _init_std(init_method, output_size, input_size)
+        if std is not None:
+            key = _next_init_key()
+    if key is not None and not return_master_weight:
+        # Rows (or columns) of the master weight in this partition: every
+        # world_size-th chunk of every stride.
+        indices = torch.cat([
+            torch.arange(chunk * per_partition_per_stride_size,
+                         (chunk + 1) * per_partition_per_stride_size)
+            for chunk in range(rank, world_size * stride, world_size)])
+        if partition_dim == 0:
+            rows, columns = indices, torch.arange(input_size)
+        else:
+            rows, columns = torch.arange(output_size), indices
+        _counter_init(weight, input_size, rows, columns, std, key)
+        return None
+
+    def initialize(tensor):
+        if key is not None:
+            _counter_init(tensor, input_size, torch.arange(output_size),
+                          torch.arange(input_size), std, key)
+        else:
+            init_method(tensor)
+
+    # If we only use 1 process for model parallelism, bypass scatter.
     if world_size == 1:
-        init_method(weight)
+        initialize(weight)
         if return_master_weight:
             return weight
         return None
@@ -54,13 +177,11 @@ def _initialize_affine_weight(weight, output_size, input_size,
     master_weight = torch.empty(output_size, input_size,
                                 dtype=weight.dtype,
                                 requires_grad=False)
-    init_method(master_weight)
+    initialize(master_weight)
 
     # Split and copy
-    per_partition_per_stride_size = divide(per_partition_size, stride)
     weight_list = torch.split(master_weight, per_partition_per_stride_size,
                               dim=partition_dim)
-    rank = get_model_parallel_rank()
     my_weight_list = weight_list[rank::world_size]
 
     with torch.no_grad():
@@ -32,6 +32,8 @@ def unscaled_init_method(sigma):
     """Init method based on N(0, sigma)."""
     def init_(tensor):
         return torch.nn.init.normal_(tensor, mean=0.0, std=sigma)
+    # For the counter-based initialization (layers.set_shard_local_init()).
+    init_.std = sigma
 
     return init_
 
@@ -41,6 +43,7 @@ def scaled_init_method(sigma, num_layers):
     std = sigma / math.sqrt(2.0 * num_layers)
     def init_(tensor):
         return torch.nn.init.normal_(tensor, mean=0.0, std=std)
+    init_.std = std
 
     return init_
 
@@ -0,0 +1,218 @@
+import argparse
+import json
+import sys
+
+sys.path.append("..")
+import pipeline_config
+import schedules
+from pipeline_simulator import GB, Link, StageModel
+
+"""
+Partition planner.
+
+Splits the blocks of a profile (layer_profiler.py) into contiguous pipeline
+stages, and picks the checkpointed segments of every stage, so that the
+slowest stage or boundary link is as fast as possible and every stage fits
+in its memory budget:
+
+    python partition_planner.py --profile large_8_profile.json \
+        --num_stages 8 --mp_size 4 --memory_budget 30 --bandwidth 10 \
+        --output large_8/planned.json
+
+The time of a stage is its forward and backward time per microbatch,
+including the recomputation of checkpointed segments; the time of a
+boundary is the transfer time of its activations. Both run concurrently in
+the runtime, so the pipeline runs at the pace of the slowest of them. The
+memory of a stage is estimated as pipeline_simulator.py does, with the
+number of microbatches in flight and stashed weight versions of the
+schedule.
+
+A stage either checkpoints all its blocks, in one or more segments
+(vpipe.Stage), or none. Stages that fit without checkpointing are never
+checkpointed, and checkpointed stages use the segments with the lowest
+memory. A dynamic program over (stage, first block) then finds the
+partition with the smallest bottleneck.
+"""
+
+
+class PartitionPlanner(object):
+    def __init__(self, args, profile):
+        self.args = args
+        self.link = Link(args)
+        self.blocks = profile['blocks']
+        self.num_blocks = len(self.blocks)
+        self.num_stages = args.num_stages
+        assert self.num_stages <= self.num_blocks, \
+            "%d blocks can't make %d stages" % (self.num_blocks,
+                                                self.num_stages)
+        self.scale = float(profile.get('mp_size', 1)) / args.mp_size
+
+        budgets = args.memory_budget
+        if budgets is None:
+            budgets = [float('inf')]
+        if len(budgets) == 1:
+            budgets = budgets * self.num_stages
+        assert len(budgets) == self.num_stages, \
+            "Give one memory budget, or one per stage"
+        self.budgets = [budget * GB for budget in budgets]
+
+        # Microbatches in flight and weight versions of every stage, with
+        # one rank per stage.
+        self.in_flight = []
+        self.num_versions = []
+        for stage in range(self.num_stages):
+            num_warmup = self.num_stages - 1 - stage
+            schedule = schedules.get_schedule(
+                args.schedule, args.microbatches_per_flush, num_warmup,
+                args.microbatches_per_flush)
+            self.in_flight.append(schedule.max_in_flight())
+            self.num_versions.append(num_warmup + 1)
+        self.candidates = {}
+
+    def input_bytes(self, start):
+        if start == 0:
+            return 0
+        return self.blocks[start - 1]['output_bytes']
+
+    def stage_candidates(self, start, end):
+        """ Returns the StageModel of blocks [start, end) without
+        checkpointing, and with every number of segments. """
+        if (start, end) not in self.candidates:
+            blocks = self.blocks[start:end]
+            input_bytes = self.input_bytes(start)
+            self.candidates[(start, end)] = [
+                (recompute_ratio, StageModel(None, blocks, input_bytes,
+                                             recompute_ratio, self.scale))
+                for recompute_ratio in [[]] + [
+                    pipeline_config.segment_sizes(len(blocks), num_segments)
+                    for num_segments in range(1, len(blocks) + 1)]]
+        return self.candidates[(start, end)]
+
+    def plan_stage(self, stage, start, end):
+        """ Returns (time, recompute ratio, StageModel) of the fastest way
+        to run blocks [start, end) as stage within its memory budget, or
+        None. """
+        best = None
+        for (recompute_ratio, stage_model) in \
+                self.stage_candidates(start, end):
+            memory = stage_model.peak_bytes(self.num_versions[stage],
+                                            self.in_flight[stage])
+            if memory > self.budgets[stage]:
+                continue
+            time = stage_model.forward_time + stage_model.backward_time
+            if best is None or (time, memory) < best[0]:
+                best = ((time, memory), recompute_ratio, stage_model)
+        if best is None:
+            return None
+        return best[0][0], best[1], best[2]
+
+    def boundary_time(self, start):
+        """ Time to send the activations entering block start, or their
+        gradients. """
+        return self.link.transfer_time(0, 1, self.input_bytes(start))
+
+    def plan(self):
+        """ Returns the bottleneck time, and the blocks and recompute ratio
+        of every stage. """
+        n = self.num_blocks
+        infinity = float('inf')
+        # bottleneck[s][j]: smallest bottleneck of s stages over blocks
+        # [0, j).
+        bottleneck = [[infinity] * (n + 1) for _ in range(self.num_stages + 1)]
+        choice = [[None] * (n + 1) for _ in range(self.num_stages + 1)]
+        bottleneck[0][0] = 0.0
+        for stage in range(self.num_stages):
+            # Leave at least one block to every later stage.
+            last_end = n - (self.num_stages - 1 - stage)
+            for start in range(stage, last_end):
+                if bottleneck[stage][start] == infinity:
+                    continue
+                previous = bottleneck[stage][start]
+                if stage > 0:
+                    previous = max(previous, self.boundary_time(start))
+                for end in range(start + 1, last_end + 1):
+                    if stage == self.num_stages - 1 and end != n:
+                        continue
+                    planned = self.plan_stage(stage, start, end)
+                    if planned is None:
+                        continue
+                    time = max(previous, planned[0])
+                    if time < bottleneck[stage + 1][end]:
+                        bottleneck[stage + 1][end] = time
+                        choice[stage + 1][end] = (start, planned[1])
+        if bottleneck[self.num_stages][n] == infinity:
+            return None
+
+        layers = []
+        recompute_ratio = []
+        end = n
+        for stage in range(self.num_stages, 0, -1):
+            start, stage_recompute_ratio = choice[stage][end]
+            layers.insert(0, end - start)
+            recompute_ratio.insert(0, stage_recompute_ratio)
+            end = start
+        return bottleneck[self.num_stages][n], layers, recompute_ratio
+
+    def print_plan(self, layers, recompute_ratio):
+        start = 0
+        for stage in range(self.num_stages):
+            end = start + layers[stage]
+            stage_model = StageModel(stage, self.blocks[start:end],
+                                     self.input_bytes(start),
+                                     recompute_ratio[stage], self.scale)
+            print("Stage %d: blocks %d-%d, segments %s, forward %.4f s, "
+                  "backward %.4f s, send %.4f s, memory %.3f GB" % (
+                      stage, start, end - 1, recompute_ratio[stage],
+                      stage_model.forward_time, stage_model.backward_time,
+                      self.link.transfer_time(0, 1, stage_model.output_bytes)
+                      if stage < self.num_stages - 1 else 0.0,
+                      stage_model.peak_bytes(self.num_versions[stage],
+                                             self.in_flight[stage]) / GB))
+            start = end
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Partition a profiled model into pipeline stages')
+    parser.add_argument('--profile', required=True, type=str,
+                        help='block profile written by layer_profiler.py')
+    parser.add_argument('--num_stages', required=True, type=int,
+                        help='number of pipeline stages')
+    parser.add_argument('--mp_size', default=1, type=int,
+                        help='model-parallel size of every stage')
+    parser.add_argument('--memory_budget', default=None, type=float, nargs='+',
+                        help='memory of a rank in GB, for all stages or one '
+                             'per stage (default: unlimited)')
+    parser.add_argument('--schedule', type=str, default=schedules.ONE_F_ONE_B_FLUSH,
+                        choices=schedules.SCHEDULES,
+                        help='schedule, which sets the microbatches in flight')
+    parser.add_argument('--microbatches_per_flush', default=32, type=int,
+                        help='microbatches between optimizer steps of the '
+                             'gpipe and 1f1b-flush schedules')
+    parser.add_argument('--bandwidth', default=10.0, type=float,
+                        help='link bandwidth between stages, in GB/s')
+    parser.add_argument('--latency', default=50.0, type=float,
+                        help='latency of a message, in microseconds')
+    parser.add_argument('--output', required=True, type=str,
+                        help='path of the partition file')
+    args = parser.parse_args()
+    # Stages are on different servers.
+    args.intra_server_bandwidth = None
+    args.num_ranks_in_server = 1
+
+    profile = json.load(open(args.profile, 'r'))
+    planner = PartitionPlanner(args, profile)
+    plan = planner.plan()
+    if plan is None:
+        print("No partition into %d stages fits the memory budget" %
+              args.num_stages)
+        sys.exit(1)
+    bottleneck, layers, recompute_ratio = plan
+    planner.print_plan(layers, recompute_ratio)
+    print("Bottleneck: %.4f seconds per microbatch" % bottleneck)
+    pipeline_config.save_partition(args.output, layers, recompute_ratio)
+    print("Wrote %s" % args.output)
+
+
+if __name__ == '__main__':
+    main()
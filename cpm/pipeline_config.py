@@ -0,0 +1,87 @@
+import itertools
+import json
+
+"""
+Loading of the partition (gpipe.json, vpipe.json, ...) and configuration
+(mp_conf.json, dp_conf.json, ...) files of a pipeline. Doesn't depend on
+torch, so that offline tools can read the same files as the runtime.
+"""
+
+
+def load_partition(path):
+    """ Returns the number of blocks and the recompute ratio of every
+    stage. With interleaved virtual stages, the partition lists the chunks
+    of every rank, e.g. [[4, 4], [4, 4], ...]; chunk c of rank i is virtual
+    stage c * (number of ranks) + i.
+    """
+    partition = json.load(open(path, 'r'))
+    layers, recompute_ratio = partition["partition"], partition["recompute_ratio"]
+    if len(layers) > 0 and isinstance(layers[0], list):
+        num_chunks = len(layers[0])
+        layers = [layers[i][c] for c in range(num_chunks) for i in range(len(layers))]
+        recompute_ratio = [recompute_ratio[i][c] for c in range(num_chunks)
+                           for i in range(len(recompute_ratio))]
+    return layers, recompute_ratio
+
+
+def save_partition(path, layers, recompute_ratio):
+    """ Writes a partition file in the format load_partition reads. """
+    with open(path, 'w') as f:
+        f.write('{\n    "partition": %s,\n    "recompute_ratio": %s\n}\n' % (
+            json.dumps(layers), json.dumps(recompute_ratio)))
+
+
+def segment_sizes(num_blocks, num_segments):
+    """ Splits num_blocks blocks into num_segments checkpointed segments of
+    about the same size, the larger ones last. """
+    size, remainder = divmod(num_blocks, num_segments)
+    return [size + int(i >= num_segments - remainder)
+            for i in range(num_segments)]
+
+
+def resize_recompute_ratio(recompute_ratio, num_blocks):
+    """ Returns the recompute ratio of a stage that now has num_blocks
+    blocks: as many checkpointed segments as before, if possible. """
+    if not isinstance(recompute_ratio, list) or len(recompute_ratio) == 0:
+        return recompute_ratio
+    return segment_sizes(num_blocks, min(len(recompute_ratio), num_blocks))
+
+
+def load_configuration_maps(path):
+    """ Returns the configuration maps of a configuration file, as
+    StageRuntime takes them. """
+    configuration_maps = {
+        'module_to_stage_map': None,
+        'stage_to_rank_map': None,
+        'stage_to_depth_map': None
+    }
+    if path is not None:
+        json_config_file = json.load(open(path, 'r'))
+        configuration_maps['module_to_stage_map'] = json_config_file.get("module_to_stage_map", None)
+        configuration_maps['stage_to_rank_map'] = json_config_file.get("stage_to_rank_map", None)
+        configuration_maps['stage_to_rank_map'] = {
+            int(k): v for (k, v) in configuration_maps['stage_to_rank_map'].items()}
+        configuration_maps['stage_to_depth_map'] = json_config_file.get("stage_to_depth_map", None)
+        configuration_maps['mp_size'] = json_config_file.get("mp_size", None)
+    return configuration_maps
+
+
+def pipeline_ranks(configuration_maps):
+    """ Returns the ranks of the pipeline, each once even if it runs
+    several interleaved virtual stages. """
+    return set(itertools.chain(*configuration_maps['stage_to_rank_map'].values()))
+
+
+def rank_modules(configuration_maps, rank):
+    """ Returns the ids of the modules (stages of the model, and the loss)
+    that rank runs, or None if it runs all of them. """
+    module_to_stage_map = configuration_maps['module_to_stage_map']
+    if module_to_stage_map is None:
+        return None
+    mp_size = configuration_maps['mp_size'] or 1
+    first_rank = rank - rank % mp_size
+    stages = [stage for (stage, ranks) in
+              configuration_maps['stage_to_rank_map'].items()
+              if first_rank in ranks]
+    return [module for (module, stage) in enumerate(module_to_stage_map)
+            if stage in stages]
@@ -0,0 +1,470 @@
+import argparse
+import collections
+import json
+import sys
+
+sys.path.append("..")
+import pipeline_config
+import schedules
+
+"""
+Discrete-event simulator of the pipeline runtime.
+
+Predicts the step time, bubble fraction and per-stage peak memory of a
+partition (gpipe.json, vpipe.json, ...) and configuration (mp_conf.json,
+dp_conf.json, ...) from a per-block profile, without GPUs:
+
+    python pipeline_simulator.py --partition large_8/vpipe.json \
+        --config large_8/mp_conf.json --profile large_8_profile.json \
+        --schedule 1f1b-flush --num_microbatches 128 --bandwidth 10
+
+Every worker (a rank of the pipeline, or a replica of a data-parallel
+stage) executes the instruction stream the runtime would run: the same
+schedules.Schedule, warmup microbatches and round-robin assignment of
+microbatches to replicas. Forward and backward passes start once the
+worker is free and their input has arrived; every (sender, receiver,
+direction) link carries one message at a time, like a helper thread, and
+overlaps with compute. Data-parallel replicas all-reduce their gradients at
+every backward pass, as DistributedDataParallel does.
+
+The profile is a JSON file with the batch size, sequence length and
+model-parallel size it was measured at, and one entry per block
+(vpipe.CPM.generate_layer_blocks) with forward_time, backward_time,
+recompute_time and optimizer_time (seconds), and parameter_bytes,
+output_bytes, saved_bytes and peak_bytes. layer_profiler.py writes it.
+Compute and parameters are assumed to scale linearly with the
+model-parallel size.
+"""
+
+GB = 1e9
+
+
+class StageModel(object):
+    """ Per-microbatch costs of one stage, from the profiles of its blocks.
+
+    recompute_ratio is either a list of checkpointed segment sizes, as
+    vpipe.Stage takes it (an empty list disables recomputation), or the
+    fraction of the blocks of the stage that are recomputed.
+    """
+    def __init__(self, stage, blocks, input_bytes, recompute_ratio, scale):
+        self.stage = stage
+        self.num_blocks = len(blocks)
+        segments = recompute_segments(recompute_ratio, len(blocks))
+        recomputed = sum(segments)
+
+        self.forward_time = scale * sum(block['forward_time']
+                                        for block in blocks)
+        self.backward_time = scale * (
+            sum(block['backward_time'] for block in blocks) +
+            sum(block.get('recompute_time', block['forward_time'])
+                for block in blocks[:recomputed]))
+        self.optimizer_time = scale * sum(block.get('optimizer_time', 0.0)
+                                          for block in blocks)
+        self.parameter_bytes = scale * sum(block['parameter_bytes']
+                                           for block in blocks)
+        self.output_bytes = blocks[-1]['output_bytes'] if blocks else \
+            input_bytes
+
+        # Activations kept for the backward pass of a microbatch: the
+        # received input, the inputs of checkpointed segments, and
+        # everything saved by blocks that aren't recomputed.
+        self.stashed_bytes = input_bytes
+        self.transient_bytes = max([block.get('peak_bytes', 0)
+                                    for block in blocks] + [0])
+        start = 0
+        for size in segments:
+            if start > 0:
+                self.stashed_bytes += blocks[start - 1]['output_bytes']
+            self.transient_bytes = max(
+                self.transient_bytes,
+                sum(block['saved_bytes']
+                    for block in blocks[start:start + size]))
+            start += size
+        self.stashed_bytes += sum(block['saved_bytes']
+                                  for block in blocks[recomputed:])
+
+    def held_bytes(self, num_versions, in_flight):
+        """ Parameters, gradients, Adam state and num_versions stashed
+        weight versions, plus the activations of the microbatches in
+        flight. """
+        return self.parameter_bytes * (4 + num_versions) + \
+            in_flight * self.stashed_bytes
+
+    def peak_bytes(self, num_versions, in_flight):
+        return self.held_bytes(num_versions, in_flight) + self.transient_bytes
+
+
+def recompute_segments(recompute_ratio, num_blocks):
+    """ Returns the sizes of the checkpointed segments of a stage, which
+    cover its first blocks. """
+    if isinstance(recompute_ratio, list):
+        assert len(recompute_ratio) == 0 or \
+            sum(recompute_ratio) == num_blocks, \
+            "Segments %s don't cover %d blocks" % (recompute_ratio,
+                                                   num_blocks)
+        return list(recompute_ratio)
+    num_recomputed = int(round(recompute_ratio * num_blocks))
+    return [num_recomputed] if num_recomputed > 0 else []
+
+
+class Link(object):
+    """ Time to send a message between two ranks. """
+    def __init__(self, args):
+        self.args = args
+
+    def same_server(self, rank, other_rank):
+        return rank // self.args.num_ranks_in_server == \
+            other_rank // self.args.num_ranks_in_server
+
+    def transfer_time(self, rank, other_rank, nbytes):
+        bandwidth = self.args.bandwidth
+        if self.same_server(rank, other_rank) and \
+                self.args.intra_server_bandwidth is not None:
+            bandwidth = self.args.intra_server_bandwidth
+        return self.args.latency * 1e-6 + nbytes / (bandwidth * GB)
+
+    def allreduce_time(self, ranks, nbytes):
+        # Ring all-reduce over the slowest link.
+        k = len(ranks)
+        if k == 1:
+            return 0.0
+        bandwidth = self.args.bandwidth
+        if self.args.intra_server_bandwidth is not None and all(
+                self.same_server(ranks[0], rank) for rank in ranks):
+            bandwidth = self.args.intra_server_bandwidth
+        return 2 * (k - 1) * (self.args.latency * 1e-6 +
+                              nbytes / k / (bandwidth * GB))
+
+
+class Worker(object):
+    def __init__(self, rank, stages, replica, schedule, num_versions):
+        self.rank = rank
+        # Stage of every chunk.
+        self.stages = stages
+        self.replica = replica
+        self.schedule = schedule
+        self.instructions = list(schedule.instructions())
+        self.num_versions = num_versions
+        self.next = 0
+        self.free_time = 0.0
+        self.busy_time = 0.0
+        self.in_flight = collections.defaultdict(int)
+        self.max_in_flight = collections.defaultdict(int)
+        # Backward pass waiting for the all-reduce of the other replicas.
+        self.blocked = False
+
+    def done(self):
+        return self.next == len(self.instructions)
+
+
+class PipelineSimulator(object):
+    def __init__(self, args, profile, layers, recompute_ratio,
+                 configuration_maps):
+        self.args = args
+        self.link = Link(args)
+        self.stage_to_rank_map = configuration_maps['stage_to_rank_map']
+        mp_size = configuration_maps.get('mp_size') or 1
+        self.num_stages = len(self.stage_to_rank_map)
+        assert len(layers) == self.num_stages, \
+            "The partition has %d stages, the configuration %d" % (
+                len(layers), self.num_stages)
+        blocks = profile['blocks']
+        assert sum(layers) <= len(blocks), \
+            "The partition has %d blocks, the profile %d" % (
+                sum(layers), len(blocks))
+        scale = float(profile.get('mp_size', 1)) / mp_size
+
+        self.stage_models = []
+        start = 0
+        input_bytes = 0
+        for stage in range(self.num_stages):
+            stage_model = StageModel(stage, blocks[start:start + layers[stage]],
+                                     input_bytes, recompute_ratio[stage],
+                                     scale)
+            self.stage_models.append(stage_model)
+            input_bytes = stage_model.output_bytes
+            start += layers[stage]
+
+        ranks = sorted(pipeline_config.pipeline_ranks(configuration_maps))
+        self.num_chunks = self.num_stages // len(ranks)
+        self.workers = self.make_workers(
+            ranks, configuration_maps.get('stage_to_depth_map'))
+
+    def replicas(self, stage):
+        return len(self.stage_to_rank_map[stage])
+
+    def num_warmup_minibatches(self, stage, stage_to_depth_map):
+        # As StageRuntime.initialize.
+        if stage_to_depth_map is not None:
+            return stage_to_depth_map[str(stage)]
+        num_warmup_minibatches = -1
+        for i in range(stage, self.num_stages):
+            num_warmup_minibatches += self.replicas(i)
+        return num_warmup_minibatches // self.replicas(stage)
+
+    def make_workers(self, ranks, stage_to_depth_map):
+        args = self.args
+        workers = []
+        if self.num_chunks > 1:
+            num_ranks = len(ranks)
+            for (position, rank) in enumerate(ranks):
+                stages = [chunk * num_ranks + position
+                          for chunk in range(self.num_chunks)]
+                for stage in stages:
+                    assert self.stage_to_rank_map[stage] == [rank], \
+                        "Interleaved stages need one rank per stage"
+                num_warmup = num_ranks - 1 - position
+                schedule = schedules.get_schedule(
+                    args.schedule, args.num_microbatches, num_warmup,
+                    args.microbatches_per_flush, num_chunks=self.num_chunks,
+                    num_stages=num_ranks)
+                workers.append(Worker(rank, stages, 0, schedule,
+                                      num_warmup + 1))
+            return workers
+
+        num_microbatches = args.num_microbatches * self.replicas(0)
+        for stage in range(self.num_stages):
+            num_warmup = self.num_warmup_minibatches(stage,
+                                                     stage_to_depth_map)
+            for (replica, rank) in enumerate(self.stage_to_rank_map[stage]):
+                n = num_microbatches // self.replicas(stage)
+                microbatches_per_flush = None
+                if args.schedule != schedules.ONE_F_ONE_B:
+                    microbatches_per_flush = args.microbatches_per_flush
+                    n -= n % microbatches_per_flush
+                schedule = schedules.get_schedule(
+                    args.schedule, n, num_warmup, microbatches_per_flush)
+                workers.append(Worker(rank, [stage], replica, schedule,
+                                      num_warmup + 1))
+        return workers
+
+    def worker_of(self, stage, microbatch):
+        """ Returns the worker running stage for a (global) microbatch, and
+        the index of the microbatch on that worker. """
+        k = self.replicas(stage)
+        return self.stage_workers[stage][microbatch % k], microbatch // k
+
+    def run(self):
+        self.stage_workers = collections.defaultdict(list)
+        for worker in self.workers:
+            for stage in worker.stages:
+                self.stage_workers[stage].append(worker)
+        # Arrival times of activations and gradients, keyed by
+        # (stage, global microbatch).
+        self.activations = {}
+        self.gradients = {}
+        self.link_free_time = collections.defaultdict(float)
+        # Replicas that finished the compute of a backward pass, keyed by
+        # (stage, local microbatch).
+        self.allreduces = collections.defaultdict(list)
+
+        while not all(worker.done() for worker in self.workers):
+            progress = False
+            for worker in self.workers:
+                while not worker.done() and not worker.blocked and \
+                        self.step(worker):
+                    progress = True
+            if not progress:
+                raise RuntimeError("Deadlock: no worker can run its next "
+                                   "instruction")
+        return self.report()
+
+    def global_microbatch(self, worker, stage, microbatch):
+        return microbatch * self.replicas(stage) + worker.replica
+
+    def send(self, worker, time, stage, microbatch, nbytes, backward):
+        """ Sends a message to the worker running stage and returns its
+        arrival time. """
+        other, _ = self.worker_of(stage, microbatch)
+        key = (worker.rank, other.rank, backward)
+        start_time = max(time, self.link_free_time[key])
+        end_time = start_time + self.link.transfer_time(worker.rank,
+                                                        other.rank, nbytes)
+        self.link_free_time[key] = end_time
+        return end_time
+
+    def step(self, worker):
+        """ Runs the next instruction of worker if its inputs are there;
+        returns whether it did. """
+        instruction = worker.instructions[worker.next]
+        if instruction.kind == schedules.FORWARD:
+            stage = worker.stages[instruction.chunk]
+            microbatch = self.global_microbatch(worker, stage,
+                                                instruction.microbatch)
+            ready_time = 0.0
+            if stage > 0:
+                if (stage, microbatch) not in self.activations:
+                    return False
+                ready_time = self.activations[(stage, microbatch)]
+            stage_model = self.stage_models[stage]
+            end_time = self.compute(worker, ready_time,
+                                    stage_model.forward_time)
+            if stage < self.num_stages - 1:
+                self.activations[(stage + 1, microbatch)] = self.send(
+                    worker, end_time, stage + 1, microbatch,
+                    stage_model.output_bytes, backward=False)
+            worker.in_flight[stage] += 1
+            worker.max_in_flight[stage] = max(worker.max_in_flight[stage],
+                                              worker.in_flight[stage])
+        elif instruction.kind == schedules.BACKWARD:
+            stage = worker.stages[instruction.chunk]
+            microbatch = self.global_microbatch(worker, stage,
+                                                instruction.microbatch)
+            ready_time = 0.0
+            if stage < self.num_stages - 1:
+                if (stage, microbatch) not in self.gradients:
+                    return False
+                ready_time = self.gradients[(stage, microbatch)]
+            end_time = self.compute(worker, ready_time,
+                                    self.stage_models[stage].backward_time)
+            worker.in_flight[stage] -= 1
+            self.finish_backward(worker, stage, instruction.microbatch,
+                                 end_time)
+            return True
+        elif instruction.kind == schedules.OPTIMIZER_STEP:
+            stage_time = sum(self.stage_models[stage].optimizer_time
+                             for stage in worker.stages)
+            self.compute(worker, 0.0, stage_time)
+        worker.next += 1
+        return True
+
+    def compute(self, worker, ready_time, duration):
+        start_time = max(worker.free_time, ready_time)
+        worker.free_time = start_time + duration
+        worker.busy_time += duration
+        return worker.free_time
+
+    def finish_backward(self, worker, stage, local_microbatch, end_time):
+        """ Sends the gradients of a backward pass upstream, once all
+        replicas of the stage all-reduced theirs. """
+        key = (stage, local_microbatch)
+        self.allreduces[key].append((worker, end_time))
+        replicas = self.stage_workers[stage]
+        if len(self.allreduces[key]) < len(replicas):
+            worker.blocked = True
+            return
+        done_time = max(time for (_, time) in self.allreduces[key])
+        done_time += self.link.allreduce_time(
+            [replica.rank for replica in replicas],
+            self.stage_models[stage].parameter_bytes)
+        for (replica, _) in self.allreduces.pop(key):
+            replica.free_time = done_time
+            replica.blocked = False
+            replica.next += 1
+            if stage > 0:
+                microbatch = self.global_microbatch(replica, stage,
+                                                    local_microbatch)
+                self.gradients[(stage - 1, microbatch)] = self.send(
+                    replica, done_time, stage - 1, microbatch,
+                    self.stage_models[stage - 1].output_bytes,
+                    backward=True)
+
+    def peak_memory(self, worker):
+        """ Memory held by the stages of worker, plus the largest transient
+        memory of any of them. """
+        memory = 0
+        for stage in worker.stages:
+            memory += self.stage_models[stage].held_bytes(
+                worker.num_versions, worker.max_in_flight[stage])
+        memory += max(self.stage_models[stage].transient_bytes
+                      for stage in worker.stages)
+        return memory
+
+    def report(self):
+        total_time = max(worker.free_time for worker in self.workers)
+        busy_time = sum(worker.busy_time for worker in self.workers)
+        num_microbatches = self.args.num_microbatches * self.replicas(0)
+        if self.args.schedule != schedules.ONE_F_ONE_B and \
+                self.num_chunks == 1:
+            num_microbatches -= num_microbatches % \
+                self.args.microbatches_per_flush
+        report = {
+            'schedule': self.args.schedule,
+            'num_microbatches': num_microbatches,
+            'total_time': total_time,
+            'time_per_microbatch': total_time / num_microbatches,
+            'bubble_fraction': 1.0 - busy_time / (len(self.workers) *
+                                                  total_time),
+            'workers': [],
+        }
+        if self.args.schedule != schedules.ONE_F_ONE_B:
+            report['step_time'] = total_time * \
+                self.args.microbatches_per_flush / num_microbatches
+        for worker in self.workers:
+            report['workers'].append({
+                'rank': worker.rank,
+                'stages': worker.stages,
+                'replica': worker.replica,
+                'forward_time': sum(self.stage_models[stage].forward_time
+                                    for stage in worker.stages),
+                'backward_time': sum(self.stage_models[stage].backward_time
+                                     for stage in worker.stages),
+                'utilization': worker.busy_time / total_time,
+                'max_in_flight': max(worker.max_in_flight.values()),
+                'peak_memory': self.peak_memory(worker),
+            })
+        return report
+
+
+def print_report(report, batch_size):
+    print("Schedule %s, %d microbatches: %.3f seconds, %.4f seconds per "
+          "microbatch (%.2f samples/s), bubble %.1f%%" % (
+              report['schedule'], report['num_microbatches'],
+              report['total_time'], report['time_per_microbatch'],
+              batch_size / report['time_per_microbatch'],
+              100.0 * report['bubble_fraction']))
+    if 'step_time' in report:
+        print("Step time (one flush): %.3f seconds" % report['step_time'])
+    for worker in report['workers']:
+        print("Rank %d (stages %s, replica %d): forward %.4f s, backward "
+              "%.4f s, utilization %.1f%%, at most %d microbatches in "
+              "flight, peak memory %.3f GB" % (
+                  worker['rank'], worker['stages'], worker['replica'],
+                  worker['forward_time'], worker['backward_time'],
+                  100.0 * worker['utilization'], worker['max_in_flight'],
+                  worker['peak_memory'] / GB))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Simulate a pipeline configuration from a block profile')
+    parser.add_argument('--partition', required=True, type=str,
+                        help='partition file (e.g. large_8/vpipe.json)')
+    parser.add_argument('--config', required=True, type=str,
+                        help='configuration file (e.g. large_8/mp_conf.json)')
+    parser.add_argument('--profile', required=True, type=str,
+                        help='block profile written by layer_profiler.py')
+    parser.add_argument('--schedule', type=str, default=schedules.ONE_F_ONE_B_FLUSH,
+                        choices=schedules.SCHEDULES, help='pipeline schedule')
+    parser.add_argument('--num_microbatches', default=128, type=int,
+                        help='microbatches fed to each replica of the first stage')
+    parser.add_argument('--microbatches_per_flush', default=32, type=int,
+                        help='microbatches between optimizer steps of the '
+                             'gpipe and 1f1b-flush schedules')
+    parser.add_argument('--bandwidth', default=10.0, type=float,
+                        help='link bandwidth between servers, in GB/s')
+    parser.add_argument('--intra_server_bandwidth', default=None, type=float,
+                        help='link bandwidth within a server, in GB/s '
+                             '(default: --bandwidth)')
+    parser.add_argument('--latency', default=50.0, type=float,
+                        help='latency of a message, in microseconds')
+    parser.add_argument('--num_ranks_in_server', default=1, type=int,
+                        help='number of ranks per server')
+    parser.add_argument('--output', default=None, type=str,
+                        help='path of the JSON report')
+    args = parser.parse_args()
+
+    profile = json.load(open(args.profile, 'r'))
+    layers, recompute_ratio = pipeline_config.load_partition(args.partition)
+    configuration_maps = pipeline_config.load_configuration_maps(args.config)
+    simulator = PipelineSimulator(args, profile, layers, recompute_ratio,
+                                  configuration_maps)
+    report = simulator.run()
+    print_report(report, profile.get('batch_size', 1))
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+import ast
+import hashlib
+import json
+import os
+
+"""
+Shapes and dtypes of the tensors of a vpipe model, without running it.
+
+infer_shapes() propagates the shapes of the model inputs through the
+calculation of a model_graph.ModelGraph, with a shape rule per layer class
+of the declarations (SHAPE_RULES) and per model-parallel mapping function
+(FUNCTION_RULES). It returns None if the model uses a layer or function
+without a rule; main_with_runtime.py then runs the stages instead.
+
+The shapes of a model can also be kept in a JSON cache file, keyed by the
+module, a hash of its declarations, calculation and input shapes and dtypes,
+the partition and the model-parallel size, so that later launches read them
+instead of inferring or measuring them again (--shape_cache). Dtypes are
+stored by name ("float32", "int64", ...). Doesn't depend on torch.
+"""
+
+FLOAT = 'float32'
+
+
+def embedding(args, kwargs, inputs):
+    (shape, _) = inputs[0]
+    embedding_dim = kwargs.get('embedding_dim', args[1] if len(args) > 1 else None)
+    return shape + [embedding_dim], FLOAT
+
+
+def same_as_input(args, kwargs, inputs):
+    return inputs[0]
+
+
+def linear(args, kwargs, inputs):
+    (shape, dtype) = inputs[0]
+    out_features = kwargs.get('out_features', args[1] if len(args) > 1 else None)
+    return shape[:-1] + [out_features], dtype
+
+
+# Shape and dtype of the output of a layer, from its constructor arguments
+# and the shapes and dtypes of its inputs.
+SHAPE_RULES = {
+    'VocabParallelEmbedding': embedding,
+    'Embedding': embedding,
+    'Dropout': same_as_input,
+    'FusedLayerNorm': same_as_input,
+    'LayerNorm': same_as_input,
+    'GPT2ParallelSelfAttention': same_as_input,
+    'GPT2ParallelMLP': same_as_input,
+    'Linear': linear,
+}
+
+
+def gather(mp_size, inputs):
+    (shape, dtype) = inputs[0]
+    return shape[:-1] + [shape[-1] * mp_size], dtype
+
+
+FUNCTION_RULES = {
+    'copy_to_model_parallel_region': lambda mp_size, inputs: inputs[0],
+    'gather_from_model_parallel_region': gather,
+}
+
+
+class UnknownShape(Exception):
+    pass
+
+
+def call_name(node):
+    if isinstance(node, ast.Attribute):
+        return node.attr
+    if isinstance(node, ast.Name):
+        return node.id
+    raise UnknownShape("Can't call %s" % ast.dump(node))
+
+
+def parse_declaration(line, mp_size):
+    """ Returns the layer id, class name and constructor arguments of a
+    declaration line ("self.layer6 = VocabParallelEmbedding(30000, 2560)").
+    """
+    assignment = ast.parse(line.strip()).body[0]
+    layer_id = int(assignment.targets[0].attr[len('layer'):])
+    call = assignment.value
+    # Arguments can call get_model_parallel_world_size().
+    names = {'get_model_parallel_world_size': lambda: mp_size}
+
+    def evaluate(node):
+        return eval(compile(ast.Expression(node), '<declaration>', 'eval'),
+                    {'__builtins__': {}}, names)
+    args = [evaluate(arg) for arg in call.args]
+    kwargs = dict((keyword.arg, evaluate(keyword.value))
+                  for keyword in call.keywords)
+    return layer_id, call_name(call.func), args, kwargs
+
+
+def infer_shapes(graph, input_shapes, mp_size):
+    """ Returns the shape and dtype of every tensor of graph, given those of
+    the model inputs ({name: (shape, dtype)}), or None. """
+    layers = {}
+    try:
+        for line in graph.layers.values():
+            layer_id, class_name, args, kwargs = parse_declaration(line,
+                                                                   mp_size)
+            layers[layer_id] = (class_name, args, kwargs)
+    except Exception as e:
+        print("Can't infer shapes from the declarations: %s" % e)
+        return None
+
+    tensors = dict((name, (list(shape), dtype))
+                   for (name, (shape, dtype)) in input_shapes.items())
+
+    def evaluate(node):
+        if isinstance(node, ast.Name):
+            if node.id not in tensors:
+                raise UnknownShape("%s is used before it is computed" %
+                                   node.id)
+            return tensors[node.id]
+        if isinstance(node, ast.BinOp):
+            # Residual connections: operands of the same shape.
+            return evaluate(node.left)
+        if isinstance(node, ast.Call):
+            inputs = [evaluate(arg) for arg in node.args]
+            if isinstance(node.func, ast.Attribute) and \
+                    node.func.attr.startswith('layer'):
+                class_name, args, kwargs = layers[int(
+                    node.func.attr[len('layer'):])]
+                if class_name not in SHAPE_RULES:
+                    raise UnknownShape("No shape rule for %s" % class_name)
+                return SHAPE_RULES[class_name](args, kwargs, inputs)
+            name = call_name(node.func)
+            if name not in FUNCTION_RULES:
+                raise UnknownShape("No shape rule for %s" % name)
+            return FUNCTION_RULES[name](mp_size, inputs)
+        raise UnknownShape("Can't evaluate %s" % ast.dump(node))
+
+    try:
+        for block in graph.blocks:
+            for node in block.nodes:
+                expression = ast.parse(node.line.strip()).body[0].value
+                shape, dtype = evaluate(expression)
+                if None in shape:
+                    raise UnknownShape("Unknown dimension in %s" % node.line)
+                tensors[node.target] = (shape, dtype)
+    except UnknownShape as e:
+        print("Can't infer shapes: %s" % e)
+        return None
+    return tensors
+
+
+def cache_key(module, declares, calculations, input_shapes, layers, mp_size):
+    """ Key of the shapes of a model: its module, a hash of its definition
+    and of the shapes and dtypes of its inputs, its partition and its
+    model-parallel size. """
+    definition = hashlib.sha1(json.dumps(
+        [declares, calculations, sorted(input_shapes.items())]).encode(
+            'utf-8')).hexdigest()
+    return "%s/%s/partition=%s/mp=%d" % (
+        module, definition, json.dumps(layers), mp_size)
+
+
+def load_cached_shapes(path, key):
+    """ Returns the cached {name: (shape, dtype name)} of key, or None. """
+    if path is None or not os.path.exists(path):
+        return None
+    try:
+        cache = json.load(open(path, 'r'))
+    except ValueError:
+        return None
+    if key not in cache:
+        return None
+    return dict((name, (shape, dtype))
+                for (name, [shape, dtype]) in cache[key].items())
+
+
+def save_cached_shapes(path, key, shapes):
+    """ Adds the shapes of key to the cache file. Ranks may write the same
+    file concurrently; the last write wins. """
+    if path is None:
+        return
+    cache = {}
+    if os.path.exists(path):
+        try:
+            cache = json.load(open(path, 'r'))
+        except ValueError:
+            pass
+    cache[key] = dict((name, [list(shape), dtype])
+                      for (name, (shape, dtype)) in shapes.items())
+    tmp_path = '%s.%d' % (path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, path)
@@ -1,51 +1,66 @@
-import torch
+import hashlib
+import os
 import re
+import tempfile
+from functools import partial
+
+import torch
 from apex.normalization.fused_layer_norm import FusedLayerNorm
 from mpu.layers import VocabParallelEmbedding
 from mpu.transformer import GPT2ParallelSelfAttention
 from mpu.transformer import GPT2ParallelMLP
 from mpu import copy_to_model_parallel_region, gather_from_model_parallel_region
 from mpu import get_model_parallel_world_size
+from mpu import initialization_scope
 
 import torch.utils.checkpoint as cp
 
+import model_graph
+
 class CPM():
     def __init__(self, declares, calculations):
         self.declares = declares
         self.calculations = calculations
 
     def generate_layer_blocks(self):
-        self.layers = {}
-        for layer in self.declares.split('\n'):
-            m = re.search(r'self.layer([0-9]+)', layer)
-            layer_id = int(m.group(1))
-            self.layers[layer_id] = layer
-
-        self.blocks = [[]]
-        for line in self.calculations.split('\n'):
-            self.blocks[-1].append(line)
-            if '+' in line:
-                self.blocks.append([])
+        self.graph = model_graph.parse(self.declares, self.calculations)
+        self.layers = self.graph.layers
+        self.blocks = self.graph.block_lines()
+
+    def block_layers(self):
+        # Ids of the layers of every block; the parameters of layer i are
+        # named "layer<i>.*" in the stage running the block.
+        return [block.layer_ids for block in self.graph.blocks]
 
     def generate_stage(self, start, end):
-        inputs = []
-        outputs = []
-        declare = []
-        calculation = []
-        for i in range(start, end):
-            calculation.append(self.blocks[i])
-            for line in self.blocks[i]:
-                m = re.search(r'self.layer([0-9]+)', line)
-                if m is not None:
-                    layer_id = int(m.group(1))
-                    declare.append(self.layers[layer_id])
-                out = re.findall(r'out\d+', line)
-                for arg in out[1:]:
-                    if arg not in outputs and arg not in inputs:
-                        inputs.append(arg)
-                if out[0] not in outputs:
-                    outputs.append(out[0])
-        return declare, calculation, inputs, outputs
+        return self.graph.stage(start, end)
+
+# Generated code of the stages, keyed by the hash of its source. The source
+# is also written to CODE_DIR, so that tracebacks and debuggers show it.
+CODE_DIR = os.environ.get('VPIPE_CODE_DIR',
+                          os.path.join(tempfile.gettempdir(), 'vpipe_stages'))
+_compiled = {}
+
+def compile_stage(source):
+    """ Compiles the source of a stage once per process, and returns the
+    names it defines. """
+    key = hashlib.sha1(source.encode('utf-8')).hexdigest()
+    if key not in _compiled:
+        path = os.path.join(CODE_DIR, 'stage_%s.py' % key)
+        try:
+            if not os.path.exists(path):
+                os.makedirs(CODE_DIR, exist_ok=True)
+                # Ranks sharing CODE_DIR may write the same file.
+                tmp_path = '%s.%d' % (path, os.getpid())
+                with open(tmp_path, 'w') as f:
+                    f.write(source)
+                os.replace(tmp_path, path)
+        except OSError:
+            path = '<vpipe stage %s>' % key
+        namespace = dict(globals())
+        exec(compile(source, path, 'exec'), namespace)
+        _compiled[key] = namespace
+    return _compiled[key]
 
 class Stage(torch.nn.Module):
     def __init__(self, inputs, outputs, declares, calcus, fraction):
@@ -54,37 +69,19 @@ class Stage(torch.nn.Module):
         # print("{} {} {}".format(inputs, outputs, fraction), flush = True)
         self.dummy = torch.ones(1, dtype=torch.float32, requires_grad=True)
 
-        exec('\n'.join(declares))
+        for declare in declares:
+            # Weights are named after their layer ("self.layer11") for the
+            # counter-based initialization (mpu.set_shard_local_init()).
+            with initialization_scope(declare.split('=')[0].strip()):
+                exec(declare)
 
         if len(fraction) > 0:
             assert sum(fraction) == len(calcus)
 
-        if len(fraction) == 1:
-            no_cp_ = ["{} = args[{}]".format(name, i) for i, name in enumerate(inputs)]
-
-            cp_ = sum(calcus, [])
-            cp_return = []
-            for output in outputs:
-                if output not in inputs:
-                    cp_return.append(output)
-
-            cp_input = ', '.join(inputs)
-            cp_return = ', '.join(cp_return)
-            no_cp_.append(self.cp_forward(cp_, 0, cp_input + ", dummy", cp_return))
-            no_cp_.append("self.__class__.func0 = func0")
-            no_cp_.append("%s = cp.checkpoint(self.func0, %s, self.dummy)" % (cp_return, cp_input))
-
-            no_cp_.append("self.out = ({},)".format(', '.join(outputs)))
-
-            self.no_cp = '\n'.join(no_cp_)
-        elif len(fraction) == 0:
-            self.cp = "assert 1 == 0"
-            no_cp_ = sum(calcus, [])
-
-            no_cp_ = ["{} = args[{}]".format(name, i) for i, name in enumerate(inputs)] + no_cp_
-            no_cp_.append("self.out = ({},)".format(', '.join(outputs)))
-
-            self.no_cp = '\n'.join(no_cp_)
+        functions = []
+        no_cp_ = ["{} = args[{}]".format(name, i) for i, name in enumerate(inputs)]
+        if len(fraction) == 0:
+            no_cp_ += sum(calcus, [])
         else:
             cp_list = []
             start = 0
@@ -107,42 +104,65 @@ class Stage(torch.nn.Module):
                 cp_inputs_list.append(cp_inputs)
                 cp_outputs_list.append(cp_outputs)
 
-            no_cp_ = ["{} = args[{}]".format(name, i) for i, name in enumerate(inputs)]
-
             for i, cp_ in enumerate(cp_list):
                 cp_inputs = cp_inputs_list.pop(0)
                 cp_outputs = cp_outputs_list.pop(0)
 
                 required_outputs = set(outputs)
-                for inputs in cp_inputs_list:
-                    required_outputs |= set(inputs)
+                for later_inputs in cp_inputs_list:
+                    required_outputs |= set(later_inputs)
 
+                # In the order of cp_outputs, so that the source (and its
+                # hash) is the same in every process.
                 cp_return = []
-                for output in required_outputs:
-                    if output in cp_outputs:
+                for output in cp_outputs:
+                    if output in required_outputs:
                         cp_return.append(output)
 
                 cp_input = ', '.join(cp_inputs)
                 cp_return = ', '.join(cp_return)
 
+                # The first segment also takes the dummy tensor, so that its
+                # outputs require grad even if its inputs don't.
                 if i == 0:
-                    no_cp_.append(self.cp_forward(cp_, i, cp_input + ", dummy", cp_return))
-                    no_cp_.append("self.__class__.func%d = func%d" % (i, i))
-                    no_cp_.append("%s = cp.checkpoint(self.func%d, %s, self.dummy)" % (cp_return, i, cp_input))
+                    functions.append(self.cp_forward(cp_, i, cp_input + ", dummy", cp_return))
+                    no_cp_.append("%s = cp.checkpoint(partial(func%d, self), %s, self.dummy)" % (cp_return, i, cp_input))
                 else:
-                    no_cp_.append(self.cp_forward(cp_, i, cp_input, cp_return))
-                    no_cp_.append("self.__class__.func%d = func%d" % (i, i))
-                    no_cp_.append("%s = cp.checkpoint(self.func%d, %s)" % (cp_return, i, cp_input))
+                    functions.append(self.cp_forward(cp_, i, cp_input, cp_return))
+                    no_cp_.append("%s = cp.checkpoint(partial(func%d, self), %s)" % (cp_return, i, cp_input))
 
-            no_cp_.append("self.out = ({},)".format(', '.join(outputs)))
-            self.no_cp = '\n'.join(no_cp_)
+        no_cp_.append("return ({},)".format(', '.join(outputs)))
+        functions.append("def forward(self, *args):\n\t" + '\n\t'.join(no_cp_))
+        self.source = '\n\n'.join(functions) + '\n'
+        self.generated_forward = compile_stage(self.source)['forward']
 
     def forward(self, *args):
-        exec(self.no_cp)
-        return self.out
+        return self.generated_forward(self, *args)
 
     def cp_forward(self, cp, idx, cp_input, cp_return):
         f = "def func%d(self, %s):\n\t" % (idx, cp_input)
         f += '\n\t'.join(cp)
         f += '\n\treturn %s' % cp_return
-        return f
\ No newline at end of file
+        return f
+
+class StageDescriptor(object):
+    """ Arguments of a Stage, which is only built (build()) on the ranks that
+    run it, instead of building every stage of the model on every rank. """
+    def __init__(self, inputs, outputs, declares, calcus, fraction):
+        # The model modules rename the inputs of the model (replace())
+        # after making the descriptor; the Stage needs the original names.
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.declares = declares
+        self.calcus = calcus
+        self.fraction = fraction
+        self.stage = None
+
+    def build(self):
+        if self.stage is None:
+            self.stage = Stage(self.inputs, self.outputs, self.declares,
+                               self.calcus, self.fraction)
+        return self.stage
+
+    def release(self):
+        self.stage = None
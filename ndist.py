@@ -2,40 +2,59 @@ import torch
 import torch.distributed as dist
 import time
 
-import redis
+import sequencer
 
-import logging 
+import logging
 
 log = logging.getLogger("ndist.py")
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s [%(name)s] [%(levelname)s] %(message)s', datefmt='%m-%d %H:%M:%S')
 
-TIMESTAMP='timestamp'
+REDIS = 'redis'
+TCP = 'tcp'
+LOCAL = 'local'
 
 class AsyncNCCLDist:
-
-    
-    def __init__(self, master=False):
+    """ Broadcasts issued in the same global order on every rank, so that
+    helper threads can issue NCCL collectives concurrently without
+    deadlocking. Tickets come from a sequencer backend: Redis (default), a
+    sequencer.SequencerServer over TCP, or threads of this process.
+    """
+
+    def __init__(self, master=False, backend=REDIS, host='localhost',
+                 port=6379, db=0):
            # instance variable unique to each instance
 
         self.group_mapping = {}
-        self.key_count = {}
-        self.stream_seq = 1
+        self.tag_mapping = {}
         self.master = master
-        self.initialize('localhost', 6379, 0)
+        self.sequencer = None
+        self.broadcast_time = 0.0
+        self.wait_time = 0.0
+        self.initialize(backend, host, port, db)
 
 
-    def initialize(self, host, port, db):
+    def initialize(self, backend, host, port, db):
 
         log.info("Initializing...")
-        self.db = redis.Redis(host=host, port=port, db=db)
-        if self.master:
-            self.db.flushdb()
-            self.db.set("MASTER", 'go')
+        if backend == REDIS:
+            ticket_backend = sequencer.RedisBackend(host, port, db,
+                                                    master=self.master)
+        elif backend == TCP:
+            if self.master:
+                self.server = sequencer.SequencerServer('0.0.0.0', port)
+                self.server.start()
+            ticket_backend = sequencer.TCPBackend(host, port)
         else:
-            while not self.db.exists("MASTER"):
-                time.sleep(0.001)
-        log.info("Redis client inited.")
-        self.db.set(TIMESTAMP, '0')
+            assert backend == LOCAL, backend
+            ticket_backend = sequencer.LocalBackend()
+        self.ticket_backend = ticket_backend
+        log.info("Sequencer client inited (%s).", backend)
+
+    def init_sequencer(self):
+        # Needs the rank, known once the process group is initialized.
+        if self.sequencer is None:
+            self.sequencer = sequencer.Sequencer(self.ticket_backend,
+                                                 dist.get_rank())
 
 
     def init_process_group(self, backend, rank, world_size):
@@ -45,75 +64,62 @@ class AsyncNCCLDist:
     def new_group(self, rank_list):
 
         group = dist.new_group(rank_list)
+        self.init_sequencer()
         #print("group"+str(group))
-        self.group_mapping[id(group)] = rank_list
+        self.group_mapping[id(group)] = sorted(rank_list)
         return group
 
     def tagged_new_group(self, rank_list, tag):
 
         group = dist.new_group(rank_list)
+        self.init_sequencer()
         #print("group"+str(id(group)))
-        self.group_mapping[id(group)] = rank_list
+        self.group_mapping[id(group)] = sorted(rank_list)
         self.tag_mapping[id(group)] = tag
         return group
 
-
-    def broadcast(self, tensor, group, src):
-
+    def group_key(self, group, src):
+        # Tagged groups identify the thread using them, untagged groups
+        # must only be used by one thread.
         rank_list = self.group_mapping[id(group)]
+        key = "ranks" + ",".join(str(rank) for rank in rank_list) + \
+            "src" + str(src)
         if id(group) in self.tag_mapping:
-            ## if the group is tagged, then identifiy a unique thread with this tag
-            uni_key = "tag"+str(self.tage_mapping[id(group)])+str(rank_list.sort()+"src"+str(src))
-        else:
-            key = 'tensor'+str(tensor.size())+str(rank_list.sort())
-            if key in self.key_count:
-                self.key_count[key] += 1
-            else:
-                self.key_count[key] = 0
-            uni_key = key+str(self.key_count[key])
-
-        # if no key exists then assign a key in redis db
-        self.db.setnx(uni_key, 0)
-        # thread safe increase by 1, return current key
-        ready_count = self.db.incr(uni_key)
-        log.debug("ready_count for %s: %s", uni_key, ready_count)
-
-        stamp = 0 
-
-        # if ready_count equals to the total ranks in this operation
-        if ready_count >= len(rank_list):        
-            # get an unique logical clock 
-            stamp = self.db.incr(TIMESTAMP)
-            # publish the ready message with timestamp
-            log.debug('publish %s', stamp)
-            self.db.set(uni_key+'stamp', stamp)
-            # clean the key
-            self.db.delete(uni_key)
-            log.debug('Publisher go for %s with logical stamp %s', uni_key, stamp)
+            key = "tag" + str(self.tag_mapping[id(group)]) + key
+        return key
 
-        else:
+    def broadcast(self, tensor, group, src):
+        return self.broadcast_coalesced([tensor], group, src)[0]
 
-            while not self.db.exists(uni_key+'stamp'):
-                #print("stuch unikey stamp")
-                time.sleep(0.001)
-                # message = sub.get_message()
-                # if message:
-            stamp = int(self.db.get(uni_key+'stamp'))
-            log.debug('Subscriber go for %s with logical stamp %s', uni_key, stamp)
-        
-
-        while True:
-            if stamp == self.stream_seq:
-                break
-            else:
-                #print("stuck stamp")
-                time.sleep(0.001)
-
-        log.debug("ndist broadcast go with logical stamp %d", stamp)
-        rt = dist.broadcast(tensor=tensor, group=group, src=src)
-
-        #torch.cuda.synchronize()
-        log.debug("ndist broadcast finish with logical stamp %d", stamp)
-        self.stream_seq+=1
-
-        return rt
+    def broadcast_coalesced(self, tensors, group, src):
+        """ Broadcasts a burst of tensors back to back, with one check-in
+        for all their tickets.
+        """
+        rank_list = self.group_mapping[id(group)]
+        start_time = time.time()
+        stamps = self.sequencer.acquire(self.group_key(group, src),
+                                        rank_list, count=len(tensors))
+        rts = []
+        for (tensor, stamp) in zip(tensors, stamps):
+            self.sequencer.wait_turn(stamp)
+            wait_end_time = time.time()
+            log.debug("ndist broadcast go with logical stamp %d", stamp)
+            try:
+                rts.append(dist.broadcast(tensor=tensor, group=group, src=src))
+            finally:
+                self.sequencer.complete(stamp)
+            log.debug("ndist broadcast finish with logical stamp %d", stamp)
+            self.wait_time += wait_end_time - start_time
+            self.broadcast_time += time.time() - wait_end_time
+            start_time = time.time()
+        return rts
+
+    def stats(self):
+        if self.sequencer is None:
+            return {}
+        return {
+            'checkins': self.sequencer.num_checkins,
+            'tickets': self.sequencer.num_tickets,
+            'wait_time': self.wait_time,
+            'broadcast_time': self.broadcast_time,
+        }
@@ -0,0 +1,133 @@
+import argparse
+import json
+import os
+import time
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+import ndist
+
+"""
+Latency of broadcasts ordered by ndist.AsyncNCCLDist, compared with plain
+dist.broadcast calls on the same group.
+
+All ranks join one group; rank 0 broadcasts bursts of `--burst` tensors.
+Sequenced broadcasts are measured one ticket per broadcast and one ticket
+per burst (broadcast_coalesced). Rank 0 hosts the TCP sequencer unless
+--sequencer redis is given.
+
+    python ndist_benchmark.py --backend nccl --num_processes 2
+"""
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    index = min(int(fraction * len(values)), len(values) - 1)
+    return values[index]
+
+
+def run_mode(mode, nd, group, tensors, num_warmup, num_iterations):
+    latencies = []
+    for i in range(num_warmup + num_iterations):
+        dist.barrier()
+        start_time = time.time()
+        if mode == 'plain':
+            for tensor in tensors:
+                dist.broadcast(tensor=tensor, group=group, src=0)
+        elif mode == 'sequenced':
+            for tensor in tensors:
+                nd.broadcast(tensor, group, 0)
+        else:
+            nd.broadcast_coalesced(tensors, group, 0)
+        if tensors[0].is_cuda:
+            torch.cuda.synchronize()
+        if i >= num_warmup:
+            latencies.append((time.time() - start_time) / len(tensors))
+    return latencies
+
+
+def run(rank, args):
+    os.environ['MASTER_ADDR'] = args.master_addr
+    os.environ['MASTER_PORT'] = str(args.master_port)
+    if args.backend == 'nccl':
+        torch.cuda.set_device(rank % torch.cuda.device_count())
+        device = torch.device('cuda', torch.cuda.current_device())
+    else:
+        device = torch.device('cpu')
+
+    if args.sequencer == ndist.TCP:
+        nd = ndist.AsyncNCCLDist(master=rank == 0, backend=ndist.TCP,
+                                 host=args.master_addr,
+                                 port=args.sequencer_port)
+    else:
+        nd = ndist.AsyncNCCLDist(master=rank == 0, backend=ndist.REDIS,
+                                 host=args.sequencer_host,
+                                 port=args.sequencer_port)
+    ndist.log.setLevel('INFO')
+    nd.init_process_group(args.backend, rank=rank,
+                          world_size=args.num_processes)
+    group = nd.new_group(list(range(args.num_processes)))
+
+    results = []
+    for size in args.sizes:
+        tensors = [torch.ones(size, dtype=torch.float32, device=device)
+                   for _ in range(args.burst)]
+        for mode in ['plain', 'sequenced', 'coalesced']:
+            latencies = run_mode(mode, nd, group, tensors, args.num_warmup,
+                                 args.num_iterations)
+            result = {
+                'mode': mode,
+                'size': size,
+                'burst': args.burst,
+                'latency_p50_us': percentile(latencies, 0.5) * 1e6,
+                'latency_p90_us': percentile(latencies, 0.9) * 1e6,
+                'latency_p99_us': percentile(latencies, 0.99) * 1e6,
+            }
+            results.append(result)
+            if rank == 0:
+                print(json.dumps(result), flush=True)
+
+    if rank == 0:
+        print(json.dumps(nd.stats()), flush=True)
+        if args.output is not None:
+            with open(args.output, 'w') as f:
+                json.dump({'backend': args.backend,
+                           'sequencer': args.sequencer,
+                           'num_processes': args.num_processes,
+                           'results': results}, f, indent=2)
+    dist.barrier()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark sequenced broadcasts against dist.broadcast')
+    parser.add_argument("--backend", type=str, default='nccl',
+                        help="Backend")
+    parser.add_argument("--num_processes", type=int, default=2,
+                        help="Number of local processes")
+    parser.add_argument("--master_addr", type=str, default='localhost',
+                        help="IP address of master")
+    parser.add_argument('-p', "--master_port", type=int, default=12347,
+                        help="Port used to communicate tensors")
+    parser.add_argument("--sequencer", type=str, default=ndist.TCP,
+                        choices=[ndist.TCP, ndist.REDIS],
+                        help="Sequencer backend")
+    parser.add_argument("--sequencer_host", type=str, default='localhost',
+                        help="Redis host")
+    parser.add_argument("--sequencer_port", type=int, default=6380,
+                        help="Port of the TCP sequencer or Redis server")
+    parser.add_argument("--sizes", type=int, nargs='+',
+                        default=[1000, 100000, 10000000],
+                        help="Tensor sizes, in elements")
+    parser.add_argument("--burst", type=int, default=4,
+                        help="Tensors broadcast back to back")
+    parser.add_argument("--num_warmup", type=int, default=5,
+                        help="Untimed bursts")
+    parser.add_argument("--num_iterations", type=int, default=50,
+                        help="Timed bursts")
+    parser.add_argument("--output", type=str, default=None,
+                        help="Path of the JSON report")
+
+    args = parser.parse_args()
+    mp.spawn(run, args=(args,), nprocs=args.num_processes)
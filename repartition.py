@@ -0,0 +1,240 @@
+import torch
+import torch.distributed as dist
+
+"""
+Online repartitioning of a pipeline.
+
+The last stage aggregates the forward and backward times of every stage
+(runtime_utilities.TelemetryStats). At drain points, where no microbatch
+is in flight and the helper threads finished, the Repartitioner checks the
+imbalance between stages; after `patience` imbalanced checks in a row, it
+moves blocks between neighbouring stages, towards the faster ones. The
+decision is broadcast from the last stage so that every rank agrees on
+the new partition. Every rank then rebuilds its stage for the new partition
+and migrate() moves the parameters and optimizer state of the blocks that
+changed stages over the two-rank groups of the links between stages.
+
+Needs one rank per stage and no interleaved stages: every rank then runs the
+same number of microbatches, and a block only ever moves across one link.
+"""
+
+# Optimizer state of a parameter that moves with it (torch.optim.Adam).
+OPTIMIZER_STATE = ['exp_avg', 'exp_avg_sq']
+
+
+class Repartitioner(object):
+    """ Partition of the pipeline of this rank, and the decisions to change
+    it.
+
+    layers and recompute_ratio are the current partition, in the format of
+    the partition file. block_layers lists the layer ids of every block, and
+    link_process_groups the groups created for the links of the pipeline
+    (communication.create_link_process_groups()).
+    """
+    def __init__(self, layers, recompute_ratio, block_layers,
+                 stage_to_rank_map, mp_size, rank, link_process_groups,
+                 threshold, patience):
+        self.layers = list(layers)
+        self.recompute_ratio = list(recompute_ratio)
+        self.block_layers = block_layers
+        self.num_stages = len(stage_to_rank_map)
+        for stage in range(self.num_stages):
+            assert len(stage_to_rank_map[stage]) == 1, \
+                "Repartitioning needs one rank per stage"
+        assert len(set(stage_to_rank_map[stage][0]
+                       for stage in range(self.num_stages))) == \
+            self.num_stages, "Repartitioning doesn't support interleaved stages"
+        self.rank = rank
+        delta = rank % mp_size
+        self.stage_ranks = [stage_to_rank_map[stage][0] + delta
+                            for stage in range(self.num_stages)]
+        self.stage = self.stage_ranks.index(rank)
+        # The last stage of the first model-parallel partition decides.
+        self.decider_rank = stage_to_rank_map[self.num_stages - 1][0]
+        self.link_process_groups = link_process_groups
+        self.threshold = threshold
+        self.patience = patience
+        self.num_imbalanced_checks = 0
+        self.num_repartitions = 0
+
+    def block_owners(self, layers):
+        """ Returns the stage of every block. """
+        owners = []
+        for (stage, num_blocks) in enumerate(layers):
+            owners.extend([stage] * num_blocks)
+        return owners
+
+    def imbalance(self, stage_times):
+        """ How much slower the slowest stage is than the average one. """
+        times = [fwd_time + bwd_time for (fwd_time, bwd_time) in stage_times]
+        mean_time = sum(times) / len(times)
+        if mean_time == 0:
+            return 0.0
+        return max(times) / mean_time - 1
+
+    def propose(self, stage_times):
+        """ Returns the partition after moving blocks from the slowest stages
+        to their neighbours while that shortens the slowest stage, or None.
+        Every link moves at most one block. Stage times are split evenly
+        among the blocks of a stage.
+        """
+        layers = list(self.layers)
+        times = [fwd_time + bwd_time for (fwd_time, bwd_time) in stage_times]
+        block_times = [time / num_blocks
+                       for (time, num_blocks) in zip(times, layers)]
+        moved_links = set()
+        while True:
+            slowest = times.index(max(times))
+            best = None
+            for neighbour in [slowest - 1, slowest + 1]:
+                link = min(slowest, neighbour)
+                if neighbour < 0 or neighbour >= self.num_stages or \
+                        link in moved_links or layers[slowest] == 1:
+                    continue
+                new_time = max(times[slowest] - block_times[slowest],
+                               times[neighbour] + block_times[slowest])
+                if new_time < times[slowest] and \
+                        (best is None or new_time < best[0]):
+                    best = (new_time, neighbour)
+            if best is None:
+                break
+            neighbour = best[1]
+            times[slowest] -= block_times[slowest]
+            times[neighbour] += block_times[slowest]
+            layers[slowest] -= 1
+            layers[neighbour] += 1
+            moved_links.add(min(slowest, neighbour))
+        if layers == self.layers:
+            return None
+        return layers
+
+    def check(self, stage_times):
+        """ Returns a new partition if the stages were imbalanced for
+        patience checks in a row, or None. Called on the deciding rank.
+        """
+        imbalance = self.imbalance(stage_times)
+        if imbalance <= self.threshold:
+            self.num_imbalanced_checks = 0
+            return None
+        self.num_imbalanced_checks += 1
+        print("Stage imbalance %.3f (check %d of %d)" % (
+            imbalance, self.num_imbalanced_checks, self.patience))
+        if self.num_imbalanced_checks < self.patience:
+            return None
+        self.num_imbalanced_checks = 0
+        return self.propose(stage_times)
+
+    def agree(self, stage_times):
+        """ Returns the new partition decided by the deciding rank, or None,
+        on every rank. stage_times are the stage times seen by this rank
+        (only those of the deciding rank matter).
+        """
+        decision = torch.zeros(self.num_stages, dtype=torch.int64).cuda()
+        if self.rank == self.decider_rank:
+            layers = self.check(stage_times)
+            if layers is not None:
+                decision.copy_(torch.tensor(layers, dtype=torch.int64))
+        dist.broadcast(decision, src=self.decider_rank)
+        layers = decision.tolist()
+        if sum(layers) == 0:
+            return None
+        return layers
+
+    def moved_layer_prefixes(self, layers, link):
+        """ Returns the parameter name prefixes of the layers that move
+        across link (between stages link and link + 1), and whether they move
+        downstream. """
+        prefixes = []
+        downstream = None
+        for (block, (old_owner, new_owner)) in enumerate(
+                zip(self.block_owners(self.layers), self.block_owners(layers))):
+            if old_owner == new_owner:
+                continue
+            assert abs(old_owner - new_owner) == 1, \
+                "Block %d moves from stage %d to stage %d" % (
+                    block, old_owner, new_owner)
+            if min(old_owner, new_owner) != link:
+                continue
+            downstream = new_owner > old_owner
+            prefixes.extend("layer%d." % layer_id
+                            for layer_id in self.block_layers[block])
+        return prefixes, downstream
+
+    def migrate(self, state, modules, optimizer, layers, recompute_ratio):
+        """ Moves this rank to a new partition. state holds the parameters
+        and optimizer state of the old stage (parameter_state()); modules and
+        optimizer (a torch.optim.Adam) are those of the new stage, whose
+        parameters get their values.
+        """
+        parameters = named_parameters(modules)
+        step = None
+        for (_, parameter_state) in state.values():
+            if 'step' in parameter_state:
+                step = parameter_state['step']
+                break
+
+        for (name, parameter) in parameters.items():
+            if name in state:
+                (old_parameter, parameter_state) = state[name]
+                parameter.data.copy_(old_parameter.data)
+                if len(parameter_state) > 0:
+                    optimizer.state[parameter] = parameter_state
+
+        # Links in order, so that no two ranks wait for each other.
+        for link in range(self.num_stages - 1):
+            if self.stage not in [link, link + 1]:
+                continue
+            prefixes, downstream = self.moved_layer_prefixes(layers, link)
+            if len(prefixes) == 0:
+                continue
+            upstream_rank = self.stage_ranks[link]
+            downstream_rank = self.stage_ranks[link + 1]
+            group = self.link_process_groups[
+                (link, upstream_rank, downstream_rank)]['forward']
+            src_rank = upstream_rank if downstream else downstream_rank
+            sending = self.rank == src_rank
+            names = state.keys() if sending else parameters.keys()
+            names = sorted(name for name in names
+                           if any(name.startswith(prefix)
+                                  for prefix in prefixes))
+            for name in names:
+                if sending:
+                    (parameter, parameter_state) = state[name]
+                    tensors = [parameter.data] + [
+                        parameter_state.get(key, torch.zeros_like(parameter))
+                        for key in OPTIMIZER_STATE]
+                else:
+                    parameter = parameters[name]
+                    tensors = [parameter.data] + [
+                        torch.zeros_like(parameter) for _ in OPTIMIZER_STATE]
+                for tensor in tensors:
+                    dist.broadcast(tensor, src=src_rank, group=group)
+                if not sending and step is not None:
+                    parameter_state = {'step': step}
+                    for (key, tensor) in zip(OPTIMIZER_STATE, tensors[1:]):
+                        parameter_state[key] = tensor
+                    optimizer.state[parameter] = parameter_state
+            print("Moved %d parameters %s stage %d" % (
+                len(names), "to" if sending else "from",
+                link + 1 if self.stage == link else link))
+
+        self.layers = list(layers)
+        self.recompute_ratio = list(recompute_ratio)
+        self.num_repartitions += 1
+
+
+def named_parameters(modules):
+    parameters = {}
+    for module in modules:
+        for (name, parameter) in module.named_parameters():
+            assert name not in parameters, \
+                "Parameter %s is in two modules of the stage" % name
+            parameters[name] = parameter
+    return parameters
+
+
+def parameter_state(modules, optimizer):
+    """ Returns the parameters of modules and their optimizer state, keyed
+    by parameter name. """
+    return dict((name, (parameter, optimizer.state.get(parameter, {})))
+                for (name, parameter) in named_parameters(modules).items())
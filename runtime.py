@@ -9,6 +9,7 @@ import torch.distributed as dist
 
 import communication
 import runtime_utilities
+import schedules
 
 from fp16 import FP16_Module
 
@@ -26,6 +27,10 @@ class ModulesWithDependencies:
         self._all_input_names = []
         self._all_output_names = []
         for (module, input_names, output_names) in modules_with_dependencies:
+            # Stages of the model can be descriptors (vpipe.StageDescriptor),
+            # built only by the ranks that run them.
+            if hasattr(module, 'build'):
+                module = module.build()
             self._modules.append(module)
             self._all_input_names.append(input_names)
             self._all_output_names.append(output_names)
@@ -56,7 +61,13 @@ class StageRuntime:
                  training_tensor_dtypes, inputs_module_destinations,
                  target_tensor_names, configuration_maps, master_addr,
                  rank, local_rank, num_ranks_in_server, verbose_freq,
-                 model_type, enable_recompute=False, cuda_sync=False):
+                 model_type, enable_recompute=False, cuda_sync=False,
+                 cache_tensor_shapes=False, pack_tensors=False,
+                 recv_buffer_pool=False, p2p_transport="broadcast",
+                 queue_capacity=None, shm_transport=False,
+                 compression_config=None, startup_timer=None,
+                 derived_tensors=None, tracer=None, telemetry_freq=128,
+                 comm_engine=False, chunk=0, link_process_groups=None):
         # Metadata needed for forward and backward pass within this stage.
         self.tensors = []
         self.gradients = {}
@@ -68,6 +79,27 @@ class StageRuntime:
         self.training_tensor_dtypes = training_tensor_dtypes
         self.model_type = model_type
         self.target_tensor_names = target_tensor_names
+        self.cache_tensor_shapes = cache_tensor_shapes
+        self.pack_tensors = pack_tensors
+        self.recv_buffer_pool = recv_buffer_pool
+        self.p2p_transport = p2p_transport
+        self.queue_capacity = queue_capacity
+        self.shm_transport = shm_transport
+        self.compression_config = compression_config
+        self.startup_timer = startup_timer
+        # Tensors that every stage can rebuild from (batch size, sequence
+        # length) are not sent between stages: name -> function of
+        # (batch_size, seq_length) returning the tensor.
+        self.derived_tensors = derived_tensors if derived_tensors is not None else {}
+        self.derived_tensor_cache = {}
+        self.tracer = tracer
+        self.telemetry_freq = telemetry_freq
+        self.comm_engine = comm_engine
+        self.telemetry = None
+        # With interleaved virtual stages, this runtime runs the chunk-th
+        # stage of the rank; see InterleavedStageRuntime.
+        self.chunk = chunk
+        self.link_process_groups = link_process_groups
 
         self.initialize(model, inputs_module_destinations, configuration_maps,
                         master_addr, rank, local_rank, num_ranks_in_server)
@@ -75,6 +107,8 @@ class StageRuntime:
         self.verbose_freq = verbose_freq
         self.forward_only = False
 
+        self.telemetry_stats = runtime_utilities.TelemetryStats(
+            self.num_stages)
         self.forward_stats = runtime_utilities.RuntimeStats(forward=True)
         self.backward_stats = runtime_utilities.RuntimeStats(forward=False)
 
@@ -128,11 +162,12 @@ class StageRuntime:
         mp_size = configuration_maps['mp_size']
 
         delta = rank - rank // mp_size * mp_size
-        import copy
-        stage_to_rank_map_copy = copy.deepcopy(stage_to_rank_map)
-        for stage in stage_to_rank_map:
-            for i in range(len(stage_to_rank_map[stage])):
-                stage_to_rank_map[stage][i] += delta
+        # The chunks of interleaved stages share configuration_maps, so the
+        # ranks of this model-parallel partition go to a new map.
+        stage_to_rank_map_copy = stage_to_rank_map
+        stage_to_rank_map = dict(
+            (stage, [stage_rank + delta for stage_rank in ranks])
+            for (stage, ranks) in stage_to_rank_map.items())
 
         if module_to_stage_map is None:
             # If IP addresses not specified, resort to all layers on
@@ -146,6 +181,7 @@ class StageRuntime:
             self.num_ranks_in_previous_stage = 0
             self.num_ranks_in_next_stage = 0
             self.num_stages = 1
+            self.num_chunks = 1
             self.num_ranks_in_stage = 1
             self.num_warmup_minibatches = 0
             self.comm_handler = None
@@ -157,17 +193,19 @@ class StageRuntime:
             for module in range(len(module_to_stage_map)):
                 stage_to_module_map[module_to_stage_map[module]].append(module)
 
-            rank_to_stage_map = {}
-            for stage in stage_to_rank_map:
+            # With interleaved virtual stages, a rank owns several stages.
+            rank_to_stages_map = collections.defaultdict(list)
+            for stage in sorted(stage_to_rank_map):
                 for rank in stage_to_rank_map[stage]:
-                    rank_to_stage_map[rank] = stage
+                    rank_to_stages_map[rank].append(stage)
 
             # Now, use this mapping to determine the modules contained in
             # each stage.
-            assert 0 <= self.rank < len(rank_to_stage_map) * mp_size
-            self.num_ranks = len(rank_to_stage_map) * mp_size
+            assert 0 <= self.rank < len(rank_to_stages_map) * mp_size
+            self.num_ranks = len(rank_to_stages_map) * mp_size
             self.num_stages = len(stage_to_module_map)
-            self.stage = rank_to_stage_map[self.rank]
+            self.num_chunks = len(rank_to_stages_map[self.rank])
+            self.stage = rank_to_stages_map[self.rank][self.chunk]
             self.rank_in_stage = stage_to_rank_map[self.stage].index(self.rank)
             self.num_ranks_in_stage = len(stage_to_rank_map[self.stage])
             self.num_ranks_in_first_stage = len(stage_to_rank_map[0])
@@ -193,9 +231,9 @@ class StageRuntime:
                 self.num_warmup_minibatches = stage_to_depth_map[
                     str(self.stage)]
             else:
-                self.num_warmup_minibatches = self.num_ranks // mp_size - 1
-                for i in range(self.stage):
-                    self.num_warmup_minibatches -= len(
+                self.num_warmup_minibatches = -1
+                for i in range(self.stage, self.num_stages):
+                    self.num_warmup_minibatches += len(
                         stage_to_rank_map[i])
                 self.num_warmup_minibatches = self.num_warmup_minibatches // \
                     self.num_ranks_in_stage
@@ -213,7 +251,17 @@ class StageRuntime:
                 num_ranks_in_server=num_ranks_in_server,
                 world_size=self.num_ranks,
                 fp16=self.fp16,
-                backend=self.distributed_backend)
+                backend=self.distributed_backend,
+                cache_tensor_shapes=self.cache_tensor_shapes,
+                pack_tensors=self.pack_tensors,
+                recv_buffer_pool=self.recv_buffer_pool,
+                p2p_transport=self.p2p_transport,
+                queue_capacity=self.queue_capacity,
+                shm_transport=self.shm_transport,
+                compression_config=self.compression_config,
+                tracer=self.tracer,
+                comm_engine=self.comm_engine,
+                link_process_groups=self.chunk_link_process_groups())
 
             for i in range(len(model)-1):
                 for tensor_name in model[i][2]:
@@ -221,6 +269,8 @@ class StageRuntime:
                         if module_to_stage_map[i] == \
                             module_to_stage_map[i+1]:
                             continue
+                        if tensor_name in self.derived_tensors:
+                            continue
                         # For now, assume that each stage is served by only
                         # a single machine.
                         if module_to_stage_map[i+1] == self.stage:
@@ -231,6 +281,8 @@ class StageRuntime:
                                 stage_to_rank_map[module_to_stage_map[i+1]]
 
             for model_inputs in inputs_module_destinations.keys():
+                if model_inputs in self.derived_tensors:
+                    continue
                 destination_stage = module_to_stage_map[
                     inputs_module_destinations[model_inputs]]
                 if destination_stage > self.stage:
@@ -253,6 +305,8 @@ class StageRuntime:
                 modules[i] = FP16_Module(modules[i])
 
         # Initialize all groups in the same order on every worker.
+        if self.startup_timer is not None:
+            self.startup_timer.start('data-parallel groups')
         if stage_to_rank_map is not None:
             groups = []
             for stage in range(self.num_stages):
@@ -273,6 +327,8 @@ class StageRuntime:
             group = groups[self.stage]
         else:
             group = None
+        if self.startup_timer is not None:
+            self.startup_timer.stop('data-parallel groups')
 
         # self.modules_with_dependencies contains a list of PyTorch
         # modules, along with a list of user-defined input and output
@@ -323,6 +379,8 @@ class StageRuntime:
 
 
         if self.comm_handler is not None:
+            if self.startup_timer is not None:
+                self.startup_timer.start('pipeline groups')
             self.comm_handler.initialize(
                 self.receive_ranks,
                 self.send_ranks,
@@ -333,6 +391,35 @@ class StageRuntime:
                 self.num_ranks_in_stage,
                 self.ranks_in_previous_stage,
                 self.ranks_in_next_stage)
+            if self.startup_timer is not None:
+                self.startup_timer.stop('pipeline groups')
+
+    def chunk_link_process_groups(self):
+        """ Returns the groups of the links of this stage, keyed by
+        (connected rank, whether the connected rank is upstream), or None
+        if the communication handler creates its own groups. Interleaved
+        virtual stages, and runtimes rebuilt after a repartitioning, use
+        groups created once for every link of the pipeline.
+        """
+        if self.num_chunks == 1 and self.link_process_groups is None:
+            return None
+        assert self.link_process_groups is not None, \
+            "Interleaved stages are run by InterleavedStageRuntime"
+        assert self.num_ranks_in_stage == 1, \
+            "Interleaved stages can't be replicated"
+        assert len(set(self.ranks_in_previous_stage) &
+                   set(self.ranks_in_next_stage)) == 0, \
+            "Interleaved stages need at least 3 ranks in the pipeline"
+        chunk_link_process_groups = {}
+        for upstream_rank in self.ranks_in_previous_stage:
+            chunk_link_process_groups[(upstream_rank, True)] = \
+                self.link_process_groups[
+                    (self.stage - 1, upstream_rank, self.rank)]
+        for downstream_rank in self.ranks_in_next_stage:
+            chunk_link_process_groups[(downstream_rank, False)] = \
+                self.link_process_groups[
+                    (self.stage, self.rank, downstream_rank)]
+        return chunk_link_process_groups
 
     @property
     def target(self):
@@ -374,18 +461,34 @@ class StageRuntime:
         for i in range(len(modules)):
             modules[i].zero_grad()
 
-    def train(self, num_iterations):
+    def setup_telemetry(self, pipeline_depth):
+        # Forward messages queued or in flight on the send channel hold at
+        # most two pipeline depths of telemetry tensors.
+        self.telemetry = runtime_utilities.Telemetry(
+            self.num_stages, self.stage if self.stage is not None else 0,
+            num_buffers=2 * pipeline_depth + 2)
+
+    def train(self, num_iterations, schedule=None):
+        """ Prepares an epoch of num_iterations microbatches. If the
+        epoch runs a schedules.Schedule, the pipeline depth is the number of
+        microbatches the schedule keeps in flight.
+        """
         self.tensors = []
         self.gradients = {}
         self.control = []
         self.tensor_shapes = self.training_tensor_shapes
         self.forward_only = False
+        pipeline_depth = self.num_warmup_minibatches + 1
+        if schedule is not None:
+            pipeline_depth = schedule.max_in_flight()
+        self.setup_telemetry(pipeline_depth)
 
         self.forward_minibatch_id = 0
         self.backward_minibatch_id = 0
 
         if self.comm_handler is not None:
             self.comm_handler.set_tensor_shapes(self.tensor_shapes)
+            self.comm_handler.set_pipeline_depth(pipeline_depth)
             self.comm_handler.start_helper_threads(
                 num_iterations, forward_only=False)
 
@@ -396,6 +499,8 @@ class StageRuntime:
     def eval(self, num_iterations):
         self.tensors = []
         self.gradients = {}
+        self.control = []
+        self.setup_telemetry(self.num_warmup_minibatches + 1)
         self.tensor_shapes = self.eval_tensor_shapes
         self.tensor_shapes["ack"] = (1,)
         self.forward_only = True
@@ -405,6 +510,8 @@ class StageRuntime:
 
         if self.comm_handler is not None:
             self.comm_handler.set_tensor_shapes(self.tensor_shapes)
+            self.comm_handler.set_pipeline_depth(
+                self.num_warmup_minibatches + 1)
             self.comm_handler.start_helper_threads(
                 num_iterations, forward_only=True)
 
@@ -427,6 +534,8 @@ class StageRuntime:
     def receive_tensors_forward(self):
         if self.forward_only and len(self.tensors) > 0:
             self.tensors.pop(0)
+            if self.comm_handler is not None:
+                self.comm_handler.release_buffers()
         self.tensors.append({})
         if len(self.control) > 5: ## ?? 
             self.control.pop(0)
@@ -534,10 +643,40 @@ class StageRuntime:
                     #     (self.tensors[-1][input_name].element_size() *
                     #     self.tensors[-1][input_name].nelement())
 
+            if len(self.derived_tensors) > 0:
+                self.derive_tensors(self.tensors[-1])
+
             # Used to track where to receive forward from.
             self.comm_handler.increment_messaging_index(
                 sending=False)
 
+    def derive_tensors(self, tensors):
+        """ Rebuilds the derived tensors this stage consumes. Batch size and
+        sequence length are the first two dimensions of the first received
+        tensor; rebuilt tensors are cached per (batch size, sequence length).
+        """
+        reference_names = [name for name in self.receive_ranks
+                           if name != "control"]
+        assert len(reference_names) > 0, \
+            "Derived tensors need a received tensor to read shapes from"
+        reference_shape = tensors[reference_names[0]].shape
+        batch_size, seq_length = reference_shape[0], reference_shape[1]
+        for tensor_name in self.derived_tensors:
+            if not self.modules_with_dependencies.is_input_tensor(tensor_name):
+                continue
+            key = (tensor_name, batch_size, seq_length)
+            if key not in self.derived_tensor_cache:
+                tensor = self.derived_tensors[tensor_name](
+                    batch_size, seq_length)
+                if tensor_name in self.training_tensor_dtypes:
+                    tensor = tensor.to(
+                        dtype=self.training_tensor_dtypes[tensor_name])
+                self.derived_tensor_cache[key] = tensor.cuda()
+            tensors[tensor_name] = self.derived_tensor_cache[key]
+            self.forward_stats.stats['derived_tensors_size'] += \
+                (tensors[tensor_name].element_size() *
+                 tensors[tensor_name].nelement())
+
     def send_tensors_forward(self):
         # Send all required tensors downstream.
         # for output_name in self.send_ranks:
@@ -714,7 +853,10 @@ class StageRuntime:
         """Run forward pass.
         """
         # Receive tensors from previous worker.
+        receive_start_time = time.time()
         self.receive_tensors_forward()
+        self.forward_stats.stats['receive_tensors'] += \
+            time.time() - receive_start_time
         tensors = self.tensors[-1]
 
         #Receive forward stats from the previous worker 
@@ -727,37 +869,26 @@ class StageRuntime:
         if self.cuda_sync:
             torch.cuda.synchronize()
         self.fwd_time = time.time()-start_time
-
-        # Set control message
-        
-        fwd_list = None
-        if self.control[-1]["forward_receive"] is not None:
-            fwd_list = self.control[-1]["forward_receive"].tolist()[-1]
-            flag = 0
-            while True:
-                if fwd_list[flag]==0:
-                    break
-                flag += 1
-
-            fwd_list[flag] = int(self.fwd_time * 1000000)
-            fwd_list[flag+1] = int(self.bwd_time * 1000000)
+        self.forward_stats.stats['compute_time'] += self.fwd_time
+        if self.tracer is not None:
+            self.tracer.add_span("forward %d" % self.forward_minibatch_id,
+                                 "compute", start_time,
+                                 start_time + self.fwd_time)
+
+        # Set control message: every telemetry_freq microbatches, each stage
+        # adds its times to the telemetry received from upstream, and the
+        # last stage aggregates them.
+        if self.telemetry_freq > 0 and runtime_utilities.telemetry_sampled(
+                self.forward_minibatch_id, self.num_ranks_in_stage,
+                self.rank_in_stage, self.telemetry_freq):
+            telemetry_tensor = self.telemetry.forward_tensor(
+                self.control[-1]["forward_receive"], self.fwd_time,
+                self.bwd_time)
+            if self.is_criterion:
+                self.telemetry_stats.update(telemetry_tensor)
         else:
-            fwd_list = [int(0)]*100
-            fwd_list[0] = int(self.fwd_time * 1000000)
-            fwd_list[1] = int(self.bwd_time * 1000000)
-
-        self.control[-1]["forward_send"]=torch.Tensor([fwd_list]).type(torch.int).cuda()
-
-        if self.is_criterion and self.forward_minibatch_id % 128 == 0:
-            print("Last stage execution time stats: ")
-            timelist = self.control[-1]["forward_send"].tolist()[0]
-            i = 0
-            while True:
-                if timelist[i] == 0:
-                    break
-                else:
-                    print("Stage "+str(int(i/2))+" fwd time: "+"%.3f" % (float(timelist[i])/1000000)+" bwd time: "+"%.3f" % (float(timelist[i+1])/1000000))
-                    i += 2
+            telemetry_tensor = self.telemetry.empty_tensor
+        self.control[-1]["forward_send"] = telemetry_tensor
 
             ### print("Repartition disabled")
 
@@ -767,7 +898,10 @@ class StageRuntime:
         #print(self.control[-1]["forward_send"])
 
         # Send tensors forward.
+        send_start_time = time.time()
         self.send_tensors_forward()
+        self.forward_stats.stats['send_tensors'] += \
+            time.time() - send_start_time
         if self.verbose_freq > 0 and self.forward_minibatch_id % self.verbose_freq == 0:
             self.forward_stats.print_stats()
         self.forward_stats.reset_stats()
@@ -847,7 +981,10 @@ class StageRuntime:
         #         else:
         #             module.pre_backward()
         # Receive input gradients needed for backward pass.
+        receive_start_time = time.time()
         self.receive_tensors_backward()
+        self.backward_stats.stats['receive_tensors'] += \
+            time.time() - receive_start_time
 
         #print("backward receive")
         #print(self.control[-1]["backward_receive"])
@@ -927,6 +1064,11 @@ class StageRuntime:
         if self.cuda_sync:
             torch.cuda.synchronize()
         self.bwd_time = time.time()-bwd_start_time
+        self.backward_stats.stats['compute_time'] += self.bwd_time
+        if self.tracer is not None:
+            self.tracer.add_span("backward %d" % self.backward_minibatch_id,
+                                 "compute", bwd_start_time,
+                                 bwd_start_time + self.bwd_time)
 
         if self.model_type == TRANSFORMER:
             self._rescale(tensors["ntokens"].size(0))
@@ -941,13 +1083,20 @@ class StageRuntime:
                 self.gradients[input_name] = input_gradients[input_name]
 
 
-        self.control[-1]["backward_send"]=torch.zeros([1,100],dtype=torch.int).cuda()
+        self.control[-1]["backward_send"] = self.telemetry.empty_tensor
         #print("backward send")
         #print(self.control[-1]["backward_send"])
 
 
         # Send output gradients.
+        send_start_time = time.time()
         self.send_tensors_backward()
+        self.backward_stats.stats['send_tensors'] += \
+            time.time() - send_start_time
+        if self.comm_handler is not None and len(self.receive_ranks) == 0:
+            # No gradients are sent upstream to wait for, so the buffers of
+            # this microbatch can be recycled right away.
+            self.comm_handler.release_buffers()
         if self.verbose_freq > 0 and self.backward_minibatch_id % self.verbose_freq == 0:
             self.backward_stats.print_stats()
         self.backward_stats.reset_stats()
@@ -976,6 +1125,33 @@ class StageRuntime:
                 grads.append(p.grad.data)
         return grads
 
+    def run_schedule(self, schedule, optimizer_step, backward=None,
+                     forward_hook=None):
+        """ Executes the instruction stream of a schedules.Schedule.
+        Microbatches are received, and their backward passes run, in order.
+
+        optimizer_step is called for every optimizer step instruction;
+        backward, if given, replaces run_backward() (e.g. to swap stashed
+        weights in), and forward_hook is called after every forward pass.
+        """
+        if backward is None:
+            backward = self.run_backward
+        for instruction in schedule.instructions():
+            if instruction.kind == schedules.FORWARD:
+                assert instruction.microbatch == self.forward_minibatch_id
+                self.run_forward()
+                if forward_hook is not None:
+                    forward_hook()
+            elif instruction.kind == schedules.BACKWARD:
+                assert instruction.microbatch == self.backward_minibatch_id
+                backward()
+            elif instruction.kind == schedules.OPTIMIZER_STEP:
+                optimizer_step()
+            else:
+                assert instruction.kind == schedules.FLUSH
+                assert len(self.tensors) == 0, \
+                    "%d microbatches in flight at a flush" % len(self.tensors)
+
     def run_ack(self):
         # No need for ack if running on a single worker.
         if self.rank is None:
@@ -1029,3 +1205,175 @@ class StageRuntime:
                       / float(self.num_ranks_in_first_stage)
 
         return adjusted_lr
+
+
+def pipeline_links(stage_to_rank_map, mp_size):
+    """ Returns every link of the pipeline, as (upstream stage, upstream
+    rank, downstream rank), in the same order on every rank. """
+    links = []
+    for delta in range(mp_size):
+        for stage in range(len(stage_to_rank_map) - 1):
+            for upstream_rank in stage_to_rank_map[stage]:
+                for downstream_rank in stage_to_rank_map[stage + 1]:
+                    links.append((stage, upstream_rank + delta,
+                                  downstream_rank + delta))
+    return links
+
+
+class InterleavedStageRuntime(object):
+    """ Runs the interleaved virtual stages of a rank, one StageRuntime per
+    chunk. With num_stages ranks in the pipeline, chunk c of the rank at
+    pipeline position i is virtual stage c * num_stages + i, so
+    stage_to_rank_map lists every rank once per chunk.
+
+    Takes the keyword arguments of StageRuntime. stage and num_stages are
+    the pipeline position of the rank and the number of ranks in the
+    pipeline, so that the first stage feeds the data and the last stage
+    computes the loss, as with StageRuntime.
+    """
+    def __init__(self, **kwargs):
+        configuration_maps = kwargs['configuration_maps']
+        stage_to_rank_map = configuration_maps['stage_to_rank_map']
+        mp_size = configuration_maps['mp_size']
+        num_virtual_stages = len(stage_to_rank_map)
+        ranks = set(itertools.chain(*stage_to_rank_map.values()))
+        self.num_stages = len(ranks)
+        assert num_virtual_stages % self.num_stages == 0, \
+            "%d virtual stages can't be split among %d ranks" % (
+                num_virtual_stages, self.num_stages)
+        self.num_chunks = num_virtual_stages // self.num_stages
+
+        link_process_groups = communication.create_link_process_groups(
+            pipeline_links(stage_to_rank_map, mp_size), kwargs['rank'])
+
+        self.chunks = []
+        for chunk in range(self.num_chunks):
+            self.chunks.append(StageRuntime(
+                chunk=chunk, link_process_groups=link_process_groups,
+                **kwargs))
+        self.stage = self.chunks[0].stage
+        for (chunk, chunk_runtime) in enumerate(self.chunks):
+            assert chunk_runtime.stage == \
+                chunk * self.num_stages + self.stage, \
+                "Rank %d doesn't own virtual stages %d, %d, ..." % (
+                    kwargs['rank'], self.stage, self.stage + self.num_stages)
+        self.num_ranks = self.chunks[0].num_ranks
+        self.rank_in_stage = 0
+        # Warmup microbatches of the pipeline of ranks; the interleaved
+        # schedule derives its own warmup from them.
+        self.num_warmup_minibatches = self.num_stages - 1 - self.stage
+        self.tracer = kwargs.get('tracer')
+
+    @property
+    def master_parameters(self):
+        return list(itertools.chain(
+            *[chunk.master_parameters for chunk in self.chunks]))
+
+    @property
+    def model_parameters(self):
+        if self.chunks[0].model_parameters is None:
+            return None
+        return list(itertools.chain(
+            *[chunk.model_parameters for chunk in self.chunks]))
+
+    @property
+    def output(self):
+        return self.chunks[-1].output
+
+    @property
+    def loss(self):
+        return self.chunks[-1].loss
+
+    @property
+    def target(self):
+        return self.chunks[-1].target
+
+    @property
+    def telemetry_stats(self):
+        return self.chunks[-1].telemetry_stats
+
+    def modules(self):
+        return list(itertools.chain(
+            *[chunk.modules() for chunk in self.chunks]))
+
+    def parameters(self):
+        return itertools.chain(*[chunk.parameters() for chunk in self.chunks])
+
+    def state_dict(self):
+        state_dict = collections.OrderedDict()
+        for (i, chunk) in enumerate(self.chunks):
+            state_dict["chunk%d" % i] = chunk.state_dict()
+        return state_dict
+
+    def load_state_dict(self, state_dict):
+        for (i, chunk) in enumerate(self.chunks):
+            chunk.load_state_dict(state_dict["chunk%d" % i])
+
+    def zero_grad(self):
+        for chunk in self.chunks:
+            chunk.zero_grad()
+
+    def train(self, num_iterations, schedule=None):
+        for chunk in self.chunks:
+            chunk.train(num_iterations, schedule=schedule)
+
+    def eval(self, num_iterations):
+        for chunk in self.chunks:
+            chunk.eval(num_iterations)
+
+    def set_loader(self, loader):
+        # Only virtual stage 0 reads the data.
+        for chunk in self.chunks:
+            chunk.set_loader(loader if chunk.stage == 0 else None)
+
+    def set_loss_scale(self, loss_scale):
+        for chunk in self.chunks:
+            chunk.set_loss_scale(loss_scale)
+
+    def num_iterations(self, loader_size):
+        return self.chunks[0].num_iterations(loader_size)
+
+    def run_forward(self):
+        """ Runs the forward pass of the next microbatch through all
+        chunks, one after the other (used in evaluation).
+        """
+        for chunk in self.chunks:
+            chunk.run_forward()
+
+    def run_ack(self):
+        # The last virtual stage acks first.
+        for chunk in reversed(self.chunks):
+            chunk.run_ack()
+
+    def run_schedule(self, schedule, optimizer_step, backward=None,
+                     forward_hook=None):
+        """ Executes the instruction stream of a
+        schedules.InterleavedSchedule. forward_hook is called after the
+        forward pass of a microbatch through the last chunk.
+        """
+        assert backward is None, \
+            "Interleaved stages don't support weight stashing"
+        for instruction in schedule.instructions():
+            if instruction.kind == schedules.FORWARD:
+                chunk = self.chunks[instruction.chunk]
+                assert instruction.microbatch == chunk.forward_minibatch_id
+                chunk.run_forward()
+                if forward_hook is not None and \
+                        instruction.chunk == self.num_chunks - 1:
+                    forward_hook()
+            elif instruction.kind == schedules.BACKWARD:
+                chunk = self.chunks[instruction.chunk]
+                assert instruction.microbatch == chunk.backward_minibatch_id
+                chunk.run_backward()
+            elif instruction.kind == schedules.OPTIMIZER_STEP:
+                optimizer_step()
+            else:
+                assert instruction.kind == schedules.FLUSH
+                for chunk in self.chunks:
+                    assert len(chunk.tensors) == 0, \
+                        "%d microbatches in flight at a flush" % len(
+                            chunk.tensors)
+
+    def wait(self):
+        for chunk in self.chunks:
+            chunk.wait()
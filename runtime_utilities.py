@@ -1,6 +1,10 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT license.
 
+import collections
+import time
+import torch
+
 class RuntimeStats:
     def __init__(self, forward):
         self.stats = {
@@ -9,6 +13,7 @@ class RuntimeStats:
             'send_tensors_size': 0,
             'receive_tensors': 0.0,
             'receive_tensors_size': 0,
+            'derived_tensors_size': 0,
         }
         self.forward = forward
 
@@ -19,10 +24,113 @@ class RuntimeStats:
             print("Backward Stats:")
         for i in sorted(self.stats):
             units = 'seconds'
-            if i == 'receive_tensors_size' or i == 'send_tensors_size':
+            if i.endswith('_size'):
                 units = 'bytes'
             print("\t %s %.3f %s" % (i, self.stats[i], units))
 
     def reset_stats(self):
         for i in self.stats.keys():
-            self.stats[i] = 0.0
\ No newline at end of file
+            self.stats[i] = 0.0
+
+
+class Telemetry:
+    """ Forward and backward times of every stage, carried downstream in
+    the control slot of forward messages as a [num_stages, 2] int32 tensor of
+    microseconds.
+
+    Tensors are preallocated: each stage copies the tensor it received into
+    one of its own and writes its row in place, without synchronizing with
+    the device. A tensor is reused once num_buffers newer ones were handed
+    out, which must exceed the number of messages that can be queued or in
+    flight on the forward send channel.
+    """
+    def __init__(self, num_stages, stage, num_buffers):
+        self.stage = stage
+        self.buffers = [torch.zeros([num_stages, 2], dtype=torch.int32).cuda()
+                        for _ in range(num_buffers)]
+        self.index = 0
+        # Sent in the control slot of messages that carry no telemetry:
+        # backward messages, and forward messages that aren't sampled.
+        self.empty_tensor = torch.zeros([num_stages, 2],
+                                        dtype=torch.int32).cuda()
+
+    def forward_tensor(self, received, fwd_time, bwd_time):
+        tensor = self.buffers[self.index]
+        self.index = (self.index + 1) % len(self.buffers)
+        if received is not None:
+            tensor.copy_(received.view(tensor.shape), non_blocking=True)
+        tensor[self.stage, 0] = int(fwd_time * 1000000)
+        tensor[self.stage, 1] = int(bwd_time * 1000000)
+        return tensor
+
+
+def telemetry_sampled(forward_minibatch_id, num_ranks_in_stage, rank_in_stage,
+                      telemetry_freq):
+    """ Whether a stage replica samples telemetry for its microbatch
+    forward_minibatch_id. Replicas of a stage take microbatches round-robin,
+    so sampling on the global microbatch id makes every stage sample the same
+    microbatches, whatever its number of replicas.
+    """
+    global_minibatch_id = forward_minibatch_id * num_ranks_in_stage + \
+        rank_in_stage
+    return global_minibatch_id % telemetry_freq == 0
+
+
+class TelemetryStats:
+    """ Rolling forward and backward times of every stage, over the last
+    `window` telemetry samples received by the last stage.
+    """
+    def __init__(self, num_stages, window=100):
+        self.num_stages = num_stages
+        self.samples = collections.deque(maxlen=window)
+
+    def update(self, telemetry_tensor):
+        # Only synchronization point of the telemetry channel.
+        sample = telemetry_tensor.tolist()
+        # A row that no stage filled in (an upstream stage didn't sample the
+        # microbatch) would drag the means towards zero.
+        if any(fwd_time == 0 and bwd_time == 0
+               for (fwd_time, bwd_time) in sample[:-1]):
+            return
+        self.samples.append(sample)
+
+    def stage_times(self):
+        """ Returns [(mean fwd time, mean bwd time)] per stage, in seconds. """
+        times = []
+        for stage in range(self.num_stages):
+            fwd_times = [sample[stage][0] for sample in self.samples]
+            bwd_times = [sample[stage][1] for sample in self.samples]
+            if len(self.samples) == 0:
+                times.append((0.0, 0.0))
+                continue
+            times.append((sum(fwd_times) / len(fwd_times) / 1000000.,
+                          sum(bwd_times) / len(bwd_times) / 1000000.))
+        return times
+
+    def print_stats(self):
+        print("Stage execution time stats (last %d samples):" %
+              len(self.samples))
+        for (stage, (fwd_time, bwd_time)) in enumerate(self.stage_times()):
+            print("\t Stage %d fwd time: %.3f bwd time: %.3f" % (
+                stage, fwd_time, bwd_time))
+
+
+class StartupTimer:
+    """ Wall-clock time spent in each phase of worker startup. """
+    def __init__(self):
+        self.phases = []
+        self.start_times = {}
+
+    def start(self, phase):
+        self.start_times[phase] = time.time()
+
+    def stop(self, phase):
+        self.phases.append(
+            (phase, time.time() - self.start_times.pop(phase)))
+
+    def print_stats(self):
+        print("Startup Stats:")
+        for (phase, elapsed_time) in self.phases:
+            print("\t %s %.3f seconds" % (phase, elapsed_time))
+        print("\t total %.3f seconds" % sum(
+            elapsed_time for (_, elapsed_time) in self.phases))
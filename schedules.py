@@ -0,0 +1,241 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import collections
+
+"""
+Pipeline schedules.
+
+A schedule emits the instruction stream of one stage: forward and backward
+passes of microbatches, optimizer steps, and flushes (points where no
+microbatch is in flight). StageRuntime.run_schedule() executes the stream.
+
+  - gpipe: forward passes of all microbatches of a flush, then their
+    backward passes, then an optimizer step.
+  - 1f1b-flush: warmup forward passes, then one forward and one backward
+    pass at a time, then the remaining backward passes and an optimizer
+    step. Same bubble as gpipe, but at most (number of warmup
+    microbatches + 1) microbatches are in flight instead of all of them.
+  - 1f1b: 1f1b without flushes (PipeDream): an optimizer step follows every
+    backward pass, and weights are stashed so that a microbatch's backward
+    pass uses the weights of its forward pass.
+
+With interleaved virtual stages, every rank runs num_chunks chunks of the
+model, and chunk c of the rank at pipeline position i is virtual stage
+c * num_stages + i. gpipe and 1f1b-flush then interleave the chunks
+(Megatron-LM's interleaved schedule): a rank runs the forward passes of
+num_stages microbatches on one chunk, then on the next chunk, and so on,
+which divides the bubble by about num_chunks.
+"""
+
+FORWARD = 'forward'
+BACKWARD = 'backward'
+OPTIMIZER_STEP = 'optimizer_step'
+FLUSH = 'flush'
+
+GPIPE = 'gpipe'
+ONE_F_ONE_B = '1f1b'
+ONE_F_ONE_B_FLUSH = '1f1b-flush'
+SCHEDULES = [GPIPE, ONE_F_ONE_B, ONE_F_ONE_B_FLUSH]
+
+Instruction = collections.namedtuple('Instruction',
+                                     ['kind', 'microbatch', 'chunk'])
+
+
+def forward(microbatch, chunk=0):
+    return Instruction(FORWARD, microbatch, chunk)
+
+
+def backward(microbatch, chunk=0):
+    return Instruction(BACKWARD, microbatch, chunk)
+
+
+def optimizer_step():
+    return Instruction(OPTIMIZER_STEP, None, None)
+
+
+def flush():
+    return Instruction(FLUSH, None, None)
+
+
+class Schedule(object):
+    """ Instruction stream of one stage over num_microbatches microbatches.
+    num_warmup_microbatches is the number of forward passes the stage runs
+    ahead of its first backward pass in 1F1B.
+    """
+    weight_stashing = False
+
+    def __init__(self, num_microbatches, num_warmup_microbatches,
+                 microbatches_per_flush=None):
+        self.num_microbatches = num_microbatches
+        self.num_warmup_microbatches = num_warmup_microbatches
+        if microbatches_per_flush is None:
+            microbatches_per_flush = num_microbatches
+        self.microbatches_per_flush = microbatches_per_flush
+
+    def num_flushes(self):
+        assert self.num_microbatches % self.microbatches_per_flush == 0, \
+            "%d microbatches don't divide into flushes of %d" % (
+                self.num_microbatches, self.microbatches_per_flush)
+        return self.num_microbatches // self.microbatches_per_flush
+
+    def max_in_flight(self):
+        """ Maximum number of microbatches whose forward pass ran and whose
+        backward pass didn't, at any point of the stream.
+        """
+        raise NotImplementedError()
+
+    def instructions(self):
+        raise NotImplementedError()
+
+
+class GPipeSchedule(Schedule):
+    def max_in_flight(self):
+        return self.microbatches_per_flush
+
+    def instructions(self):
+        for flush_id in range(self.num_flushes()):
+            first = flush_id * self.microbatches_per_flush
+            microbatches = range(first, first + self.microbatches_per_flush)
+            for microbatch in microbatches:
+                yield forward(microbatch)
+            for microbatch in microbatches:
+                yield backward(microbatch)
+            yield optimizer_step()
+            yield flush()
+
+
+class OneFOneBFlushSchedule(Schedule):
+    def max_in_flight(self):
+        return min(self.num_warmup_microbatches + 1,
+                   self.microbatches_per_flush)
+
+    def instructions(self):
+        num_warmup = min(self.num_warmup_microbatches,
+                         self.microbatches_per_flush)
+        for flush_id in range(self.num_flushes()):
+            first = flush_id * self.microbatches_per_flush
+            last = first + self.microbatches_per_flush
+            for microbatch in range(first, first + num_warmup):
+                yield forward(microbatch)
+            for microbatch in range(first + num_warmup, last):
+                yield forward(microbatch)
+                yield backward(microbatch - num_warmup)
+            for microbatch in range(last - num_warmup, last):
+                yield backward(microbatch)
+            yield optimizer_step()
+            yield flush()
+
+
+class OneFOneBSchedule(Schedule):
+    weight_stashing = True
+
+    def max_in_flight(self):
+        return self.num_warmup_microbatches + 1
+
+    def instructions(self):
+        num_warmup = min(self.num_warmup_microbatches, self.num_microbatches)
+        for microbatch in range(num_warmup):
+            yield forward(microbatch)
+        for microbatch in range(num_warmup, self.num_microbatches):
+            yield forward(microbatch)
+            yield backward(microbatch - num_warmup)
+            yield optimizer_step()
+        for microbatch in range(self.num_microbatches - num_warmup,
+                                self.num_microbatches):
+            yield backward(microbatch)
+            yield optimizer_step()
+
+
+class InterleavedSchedule(Schedule):
+    """ 1f1b-flush (or gpipe, if all_warmup is set) over num_chunks chunks
+    per rank. num_warmup_microbatches is the number of warmup microbatches of
+    the non-interleaved pipeline, num_stages - 1 - the pipeline position of
+    the rank.
+    """
+    def __init__(self, num_microbatches, num_warmup_microbatches,
+                 microbatches_per_flush, num_chunks, num_stages,
+                 all_warmup=False):
+        Schedule.__init__(self, num_microbatches, num_warmup_microbatches,
+                          microbatches_per_flush)
+        assert self.microbatches_per_flush % num_stages == 0, \
+            "Interleaved schedules need a multiple of %d microbatches per " \
+            "flush" % num_stages
+        self.num_chunks = num_chunks
+        self.num_stages = num_stages
+        self.all_warmup = all_warmup
+
+    def virtual_microbatch(self, k, forward):
+        """ Returns the (microbatch, chunk) of the k-th forward or
+        backward pass of a flush.
+        """
+        group_size = self.num_stages * self.num_chunks
+        chunk = (k % group_size) // self.num_stages
+        if not forward:
+            chunk = self.num_chunks - 1 - chunk
+        microbatch = (k // group_size) * self.num_stages + k % self.num_stages
+        return microbatch, chunk
+
+    def max_in_flight(self):
+        """ Maximum number of microbatches in flight on any one chunk. """
+        in_flight = [0] * self.num_chunks
+        max_in_flight = 0
+        for instruction in self.instructions():
+            if instruction.kind == FORWARD:
+                in_flight[instruction.chunk] += 1
+                max_in_flight = max(max_in_flight,
+                                    in_flight[instruction.chunk])
+            elif instruction.kind == BACKWARD:
+                in_flight[instruction.chunk] -= 1
+        return max_in_flight
+
+    def instructions(self):
+        total = self.microbatches_per_flush * self.num_chunks
+        if self.all_warmup or self.microbatches_per_flush == self.num_stages:
+            num_warmup = total
+        else:
+            num_warmup = min(2 * self.num_warmup_microbatches +
+                             (self.num_chunks - 1) * self.num_stages, total)
+        for flush_id in range(self.num_flushes()):
+            first = flush_id * self.microbatches_per_flush
+            def forward_pass(k):
+                microbatch, chunk = self.virtual_microbatch(k, forward=True)
+                return forward(first + microbatch, chunk)
+            def backward_pass(k):
+                microbatch, chunk = self.virtual_microbatch(k, forward=False)
+                return backward(first + microbatch, chunk)
+            for k in range(num_warmup):
+                yield forward_pass(k)
+            for k in range(total - num_warmup):
+                yield forward_pass(num_warmup + k)
+                yield backward_pass(k)
+            for k in range(total - num_warmup, total):
+                yield backward_pass(k)
+            yield optimizer_step()
+            yield flush()
+
+
+def get_schedule(name, num_microbatches, num_warmup_microbatches,
+                 microbatches_per_flush=None, num_chunks=1, num_stages=None):
+    """ Returns the schedule of a stage. Ranks running num_chunks > 1
+    interleaved chunks out of a pipeline of num_stages ranks get an
+    InterleavedSchedule.
+    """
+    if num_chunks > 1:
+        assert name in [GPIPE, ONE_F_ONE_B_FLUSH], \
+            "Schedule %s doesn't support interleaved stages" % name
+        if microbatches_per_flush is None:
+            microbatches_per_flush = num_microbatches
+        return InterleavedSchedule(num_microbatches, num_warmup_microbatches,
+                                   microbatches_per_flush, num_chunks,
+                                   num_stages, all_warmup=name == GPIPE)
+    if name == GPIPE:
+        schedule_class = GPipeSchedule
+    elif name == ONE_F_ONE_B_FLUSH:
+        schedule_class = OneFOneBFlushSchedule
+    else:
+        assert name == ONE_F_ONE_B, "Unknown schedule %s" % name
+        schedule_class = OneFOneBSchedule
+        microbatches_per_flush = None
+    return schedule_class(num_microbatches, num_warmup_microbatches,
+                          microbatches_per_flush)
@@ -0,0 +1,218 @@
+import json
+import socket
+import socketserver
+import threading
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+"""
+Global ordering of collectives, used by ndist.AsyncNCCLDist.
+
+Blocking collectives issued from several threads deadlock if two ranks issue
+them in different orders. Every collective therefore takes a ticket: the
+members of its group check in under a key unique to (group, call index), and
+the last member to arrive atomically draws the next stamp of every member
+from that member's counter. Tickets are thus drawn in one global order, and
+each rank issues its collectives in the order of its own stamps, 1, 2, ...,
+which is that global order restricted to the rank. Stamps of a rank have no
+gaps, so a rank knows which collective comes next even if its ticket is
+still on its way.
+
+A burst of collectives on one group (e.g. the tensors of one message) can
+take all its tickets in a single check-in.
+
+Tickets are handed out by a pluggable backend:
+  - LocalBackend: threads of one process.
+  - TCPBackend: a SequencerServer, run by one of the ranks or standalone
+    (python sequencer.py --port 6380).
+  - RedisBackend: a Redis server.
+Waiting for a ticket always blocks (condition variable, socket read or
+BLPOP), it never polls.
+"""
+
+TIMESTAMP = 'timestamp'
+MASTER = 'MASTER'
+
+
+class LocalBackend(object):
+    """ Hands out tickets to threads of this process. """
+    def __init__(self):
+        self.cv = threading.Condition()
+        self.next_stamps = {}
+        self.pending = {}
+
+    def ticket(self, key, ranks, rank, count):
+        """ Blocks until all ranks checked in under key, and returns the
+        first of count consecutive stamps reserved for rank.
+        """
+        with self.cv:
+            entry = self.pending.setdefault(
+                key, {'arrived': 0, 'taken': 0, 'stamps': None})
+            entry['arrived'] += 1
+            assert entry['arrived'] <= len(ranks), \
+                "Too many ranks checked in for %s" % key
+            if entry['arrived'] == len(ranks):
+                entry['stamps'] = {}
+                for member in ranks:
+                    entry['stamps'][member] = self.next_stamps.get(member, 1)
+                    self.next_stamps[member] = \
+                        entry['stamps'][member] + count
+                self.cv.notify_all()
+            while entry['stamps'] is None:
+                self.cv.wait()
+            entry['taken'] += 1
+            if entry['taken'] == len(ranks):
+                del self.pending[key]
+            return entry['stamps'][rank]
+
+
+class _TicketHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            request = json.loads(line.decode())
+            stamp = self.server.backend.ticket(
+                request['key'], request['ranks'], request['rank'],
+                request['count'])
+            self.wfile.write(("%d\n" % stamp).encode())
+            self.wfile.flush()
+
+
+class SequencerServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """ Hands out tickets to TCPBackend clients; one thread per
+    connection.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host, port):
+        self.backend = LocalBackend()
+        socketserver.TCPServer.__init__(self, (host, port), _TicketHandler)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+class TCPBackend(object):
+    """ Takes tickets from a SequencerServer. Every thread has its own
+    connection, since a ticket request blocks until the other members of
+    the group arrive.
+    """
+    def __init__(self, host, port):
+        self.address = (host, port)
+        self.local = threading.local()
+
+    def connection(self):
+        if not hasattr(self.local, 'file'):
+            sock = socket.create_connection(self.address)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.local.socket = sock
+            self.local.file = sock.makefile('rwb')
+        return self.local.file
+
+    def ticket(self, key, ranks, rank, count):
+        f = self.connection()
+        f.write((json.dumps({'key': key, 'ranks': ranks, 'rank': rank,
+                             'count': count}) + "\n").encode())
+        f.flush()
+        line = f.readline()
+        assert line, "Sequencer server closed the connection"
+        return int(line)
+
+
+class RedisBackend(object):
+    """ Takes tickets from a Redis server. The last member to check in
+    draws the stamps of all members in one transaction and pushes them to
+    the other members, which wait on them with BLPOP.
+    """
+    def __init__(self, host, port, db, master=False):
+        assert redis is not None, "RedisBackend requires the redis package"
+        self.db = redis.Redis(host=host, port=port, db=db)
+        if master:
+            self.db.flushdb()
+            self.db.rpush(MASTER, 'go')
+        else:
+            # Blocks until the master is up, and leaves the token in place
+            # for the other workers.
+            self.db.brpoplpush(MASTER, MASTER)
+
+    def ticket(self, key, ranks, rank, count):
+        arrived = self.db.incr(key)
+        if arrived == len(ranks):
+            pipeline = self.db.pipeline(transaction=True)
+            for member in ranks:
+                pipeline.incrby("%s:%d" % (TIMESTAMP, member), count)
+            next_stamps = pipeline.execute()
+            stamps = dict((member, next_stamp - count + 1) for
+                          (member, next_stamp) in zip(ranks, next_stamps))
+            self.db.delete(key)
+            for member in ranks:
+                if member != rank:
+                    self.db.rpush("%s:stamp:%d" % (key, member),
+                                  stamps[member])
+            return stamps[rank]
+        _, stamp = self.db.blpop("%s:stamp:%d" % (key, rank))
+        return int(stamp)
+
+
+class Sequencer(object):
+    """ Orders the collectives of this rank by their global stamps.
+
+    Collectives on one group must be issued by one thread at a time, in the
+    same order on every member; groups used concurrently by several threads
+    need distinct keys (e.g. tagged groups).
+    """
+    def __init__(self, backend, rank):
+        self.backend = backend
+        self.rank = rank
+        self.lock = threading.Lock()
+        self.cv = threading.Condition()
+        self.call_counts = {}
+        self.next_stamp = 1
+        self.num_tickets = 0
+        self.num_checkins = 0
+
+    def acquire(self, group_key, ranks, count=1):
+        """ Takes count consecutive tickets for the next collectives on the
+        group of ranks, in one check-in, and returns their stamps.
+        """
+        with self.lock:
+            index = self.call_counts.get(group_key, 0)
+            self.call_counts[group_key] = index + count
+            self.num_checkins += 1
+            self.num_tickets += count
+        stamp = self.backend.ticket("%s:%d" % (group_key, index),
+                                    sorted(ranks), self.rank, count)
+        return list(range(stamp, stamp + count))
+
+    def wait_turn(self, stamp):
+        """ Blocks until all collectives of this rank with smaller stamps
+        completed.
+        """
+        with self.cv:
+            while self.next_stamp != stamp:
+                self.cv.wait()
+
+    def complete(self, stamp):
+        with self.cv:
+            assert self.next_stamp == stamp, (self.next_stamp, stamp)
+            self.next_stamp += 1
+            self.cv.notify_all()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Collective sequencer server')
+    parser.add_argument("--host", type=str, default='0.0.0.0',
+                        help="Address to listen on")
+    parser.add_argument("--port", type=int, default=6380,
+                        help="Port to listen on")
+    args = parser.parse_args()
+    server = SequencerServer(args.host, args.port)
+    print("Sequencer listening on %s:%d" % (args.host, args.port))
+    server.serve_forever()
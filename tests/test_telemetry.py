@@ -0,0 +1,44 @@
+import sys
+import os
+import unittest
+
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+import runtime_utilities
+
+
+def sampled_microbatches(num_ranks_in_stage, telemetry_freq, num_microbatches):
+    """ Global ids of the microbatches a stage samples, with microbatch g run
+    by replica g % num_ranks_in_stage as its microbatch
+    g // num_ranks_in_stage. """
+    return set(
+        minibatch_id * num_ranks_in_stage + rank_in_stage
+        for rank_in_stage in range(num_ranks_in_stage)
+        for minibatch_id in range(num_microbatches // num_ranks_in_stage)
+        if runtime_utilities.telemetry_sampled(
+            minibatch_id, num_ranks_in_stage, rank_in_stage, telemetry_freq))
+
+
+class TelemetryTest(unittest.TestCase):
+    def test_uneven_replication_samples_same_microbatches(self):
+        # medium_dp/dp_conf.json: stages of 1, 1 and 2 replicas.
+        for replicas in [[1, 1, 2], [2, 3], [1, 4]]:
+            sampled = [sampled_microbatches(num_ranks_in_stage, 8, 96)
+                       for num_ranks_in_stage in replicas]
+            for stage_sampled in sampled:
+                self.assertEqual(stage_sampled, set(range(0, 96, 8)))
+
+    def test_stats_skip_rows_never_filled(self):
+        stats = runtime_utilities.TelemetryStats(3)
+        stats.update(torch.tensor([[1000, 2000], [3000, 4000],
+                                   [5000, 6000]], dtype=torch.int32))
+        # The first stage didn't sample this microbatch.
+        stats.update(torch.tensor([[0, 0], [3000, 4000], [5000, 6000]],
+                                  dtype=torch.int32))
+        self.assertEqual(len(stats.samples), 1)
+        self.assertEqual(stats.stage_times()[0], (0.001, 0.002))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,26 +1,88 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT license.
 
+import collections
 import threading
+import time
 
 """
 Implementation of a thread-safe queue with one producer and one consumer.
+
+If the queue has a capacity, add() blocks while the queue is full. The queue
+tracks its high-water mark and the time producer and consumer spend blocked.
 """
 class Queue:
-    def __init__(self):
-        self.queue = []
+    def __init__(self, capacity=None):
+        self.queue = collections.deque()
+        self.capacity = capacity
         self.cv = threading.Condition()
+        self.reset_stats()
+
+    def set_capacity(self, capacity):
+        self.cv.acquire()
+        self.capacity = capacity
+        self.cv.notify_all()
+        self.cv.release()
 
     def add(self, tensor):
         self.cv.acquire()
+        if self.capacity is not None and len(self.queue) >= self.capacity:
+            start_time = time.time()
+            while len(self.queue) >= self.capacity:
+                self.cv.wait()
+            self.add_wait_time += time.time() - start_time
         self.queue.append(tensor)
-        self.cv.notify()
+        self.num_adds += 1
+        self.high_water_mark = max(self.high_water_mark, len(self.queue))
+        self.cv.notify_all()
         self.cv.release()
 
     def remove(self):
         self.cv.acquire()
-        while len(self.queue) == 0:
-            self.cv.wait()
-        tensor = self.queue.pop(0)
+        if len(self.queue) == 0:
+            start_time = time.time()
+            while len(self.queue) == 0:
+                self.cv.wait()
+            self.remove_wait_time += time.time() - start_time
+        tensor = self.queue.popleft()
+        self.cv.notify_all()
         self.cv.release()
         return tensor
+
+    def try_remove(self):
+        """ Returns (True, oldest element) without blocking, or
+        (False, None) if the queue is empty.
+        """
+        self.cv.acquire()
+        if len(self.queue) == 0:
+            self.cv.release()
+            return (False, None)
+        tensor = self.queue.popleft()
+        self.cv.notify_all()
+        self.cv.release()
+        return (True, tensor)
+
+    def has_room(self):
+        self.cv.acquire()
+        has_room = self.capacity is None or len(self.queue) < self.capacity
+        self.cv.release()
+        return has_room
+
+    def reset_stats(self):
+        self.num_adds = 0
+        self.high_water_mark = 0
+        self.add_wait_time = 0.0
+        self.remove_wait_time = 0.0
+
+    def stats(self):
+        self.cv.acquire()
+        stats = {
+            'depth': len(self.queue),
+            'capacity': self.capacity,
+            'num_adds': self.num_adds,
+            'high_water_mark': self.high_water_mark,
+            'add_wait_time': self.add_wait_time,
+            'remove_wait_time': self.remove_wait_time,
+        }
+        self.cv.release()
+        return stats
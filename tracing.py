@@ -0,0 +1,199 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT license.
+
+import argparse
+import collections
+import json
+import os
+import threading
+import time
+
+"""
+Tracing of the pipeline runtime.
+
+Every worker records spans in wall-clock time: forward, backward and
+optimizer steps from the main thread, and one span per message from the
+communication helper threads, with the time the message was enqueued and
+dequeued, the time its collective started and ended, its size and its peer.
+Each worker writes its events to <trace_dir>/trace.<rank>.json.
+
+Clocks are aligned on an anchor, the time every worker leaves a barrier
+right after the process group is created. The merge tool shifts the events
+of every rank by its anchor and writes a single Chrome trace, which can be
+opened in chrome://tracing or https://ui.perfetto.dev:
+
+    python tracing.py merge trace_dir/trace.*.json -o pipeline_trace.json
+"""
+
+
+def message_bytes(message):
+    """ Returns the size of a message, a tensor or a list of tensors. """
+    if isinstance(message, (list, tuple)):
+        return sum(message_bytes(tensor) for tensor in message)
+    return message.element_size() * message.nelement()
+
+
+class Tracer(object):
+    """ Spans recorded by one worker. Spans can be recorded from any
+    thread.
+    """
+    def __init__(self, rank, stage):
+        self.rank = rank
+        self.stage = stage
+        self.anchor = None
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def set_anchor(self):
+        self.anchor = time.time()
+
+    def add_span(self, name, category, start_time, end_time, args=None):
+        span = {
+            'name': name,
+            'cat': category,
+            'start': start_time,
+            'end': end_time,
+            'thread': threading.current_thread().name,
+        }
+        if args is not None:
+            span['args'] = args
+        with self.lock:
+            self.spans.append(span)
+
+    def span(self, name, category):
+        return TraceSpan(self, name, category)
+
+    def channel(self, tensor_name, peer, backward, sending):
+        return ChannelTrace(self, tensor_name, peer, backward, sending)
+
+    def save(self, trace_dir):
+        if not os.path.isdir(trace_dir):
+            os.makedirs(trace_dir, exist_ok=True)
+        path = os.path.join(trace_dir, "trace.%d.json" % self.rank)
+        with self.lock:
+            spans = list(self.spans)
+        with open(path, 'w') as f:
+            json.dump({'rank': self.rank, 'stage': self.stage,
+                       'anchor': self.anchor, 'spans': spans}, f)
+        print("Wrote %d trace events to %s" % (len(spans), path))
+
+
+class TraceSpan(object):
+    """ Context manager recording the span of a block. """
+    def __init__(self, tracer, name, category):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+
+    def __enter__(self):
+        self.start_time = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer.add_span(self.name, self.category, self.start_time,
+                             time.time())
+        return False
+
+
+class ChannelTrace(object):
+    """ Messages in flight on one communication queue.
+
+    The producer of the queue calls enqueued() right before adding a message
+    and the consumer calls dequeued() right after removing it, so records
+    are matched to messages by their order. The helper thread fills in the
+    collective times and size of the message, and whichever side handles
+    the message last calls finish().
+    """
+    def __init__(self, tracer, tensor_name, peer, backward, sending):
+        self.tracer = tracer
+        self.tensor_name = tensor_name
+        self.peer = peer
+        self.direction = "backward" if backward else "forward"
+        self.sending = sending
+        self.records = collections.deque()
+        self.num_messages = 0
+
+    def enqueued(self, **fields):
+        fields['enqueue'] = time.time()
+        self.records.append(fields)
+
+    def dequeued(self):
+        record = self.records.popleft()
+        record['dequeue'] = time.time()
+        return record
+
+    def finish(self, record, **fields):
+        record.update(fields)
+        start_time = record.get('start', record['enqueue'])
+        end_time = record.get('end', record['dequeue'])
+        name = "%s %s %s" % ("send" if self.sending else "recv",
+                             self.direction, self.tensor_name)
+        args = {
+            'peer': self.peer,
+            'message': self.num_messages,
+            'bytes': record.get('bytes', 0),
+            'enqueue': record['enqueue'],
+            'dequeue': record['dequeue'],
+        }
+        self.num_messages += 1
+        self.tracer.add_span(name, "communication", start_time, end_time,
+                             args)
+
+
+def merge(paths, output):
+    """ Merges per-rank traces into one Chrome trace. Timestamps are in
+    microseconds since the anchor; every rank is a process, every thread of
+    a rank a thread.
+    """
+    events = []
+    for path in sorted(paths):
+        trace = json.load(open(path, 'r'))
+        rank = trace['rank']
+        anchor = trace['anchor']
+        if anchor is None:
+            anchor = min([span['start'] for span in trace['spans']] or [0.0])
+            print("%s has no anchor, aligning on its first event" % path)
+        events.append({'ph': 'M', 'name': 'process_name', 'pid': rank,
+                       'args': {'name': "rank %d (stage %s)" % (
+                           rank, trace['stage'])}})
+        events.append({'ph': 'M', 'name': 'process_sort_index', 'pid': rank,
+                       'args': {'sort_index': rank}})
+        thread_ids = {}
+        for span in trace['spans']:
+            if span['thread'] not in thread_ids:
+                thread_ids[span['thread']] = len(thread_ids)
+                events.append({'ph': 'M', 'name': 'thread_name', 'pid': rank,
+                               'tid': thread_ids[span['thread']],
+                               'args': {'name': span['thread']}})
+            args = dict(span.get('args', {}))
+            for key in ['enqueue', 'dequeue']:
+                if key in args:
+                    args[key] = (args[key] - anchor) * 1e6
+            events.append({
+                'ph': 'X',
+                'name': span['name'],
+                'cat': span['cat'],
+                'pid': rank,
+                'tid': thread_ids[span['thread']],
+                'ts': (span['start'] - anchor) * 1e6,
+                'dur': (span['end'] - span['start']) * 1e6,
+                'args': args,
+            })
+    with open(output, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    print("Wrote %d events from %d ranks to %s" % (len(events), len(paths),
+                                                   output))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Merge per-rank pipeline traces into a Chrome trace')
+    subparsers = parser.add_subparsers(dest='command')
+    merge_parser = subparsers.add_parser('merge')
+    merge_parser.add_argument('paths', nargs='+',
+                              help="Per-rank traces (trace.<rank>.json)")
+    merge_parser.add_argument('-o', '--output', default='pipeline_trace.json',
+                              help="Path of the merged trace")
+    args = parser.parse_args()
+    assert args.command == 'merge', "Usage: tracing.py merge <traces> -o <output>"
+    merge(args.paths, args.output)